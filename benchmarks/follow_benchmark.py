@@ -0,0 +1,132 @@
+"""Lag of `EventScanner.follow` behind a synthetic chain mining new blocks.
+
+The chain is served over HTTP on localhost and mines a block every `--block-time`
+seconds. After a backfill up to the head, the scanner follows the chain
+either polling the head (`HeadPoller`) or subscribed to the new heads of the chain.
+For every update we measure the seconds from mining its last block to the
+consumer getting it. For example::
+
+    python -m benchmarks.follow_benchmark --block-time 1 --blocks 30 --json follow.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from typing import Callable
+
+from web3 import Web3
+from web3.providers.rpc import HTTPProvider
+
+from benchmarks.scanner_benchmark import POOL_ADDRESSES, _counting_state
+from benchmarks.synthetic_node import SyntheticChain, SyntheticNode
+from src.contracts.batch_rpc import BatchRPCTransport
+from src.contracts.event_scanner import EventScanner
+from src.contracts.follow import HeadPoller
+from src.contracts.scan_metrics import ScanMetrics
+from src.utils.project_paths import DOC_PATH
+
+MODES = ("poll", "subscribe")
+
+
+def run_mode(mode: str, blocks: int, block_time: float, density: float, latency: float, confirmations: int,
+             start_head: int = 5000, seed: int = 0) -> dict:
+    """Follow `blocks` new blocks with one head source."""
+    chain = SyntheticChain(POOL_ADDRESSES, head=start_head, capacity=start_head + blocks, density=density, seed=seed)
+    node = SyntheticNode(chain, latency=latency, seed=seed)
+    server, url = node.serve()
+    stop = threading.Event()
+    try:
+        provider = HTTPProvider(url)
+        provider.middlewares.clear()
+        w3 = Web3(provider)
+        with open(os.path.join(DOC_PATH, "abi.json")) as f:
+            contract = w3.eth.contract(abi=json.load(f))
+        metrics = ScanMetrics()
+        state = _counting_state()
+        scanner = EventScanner(w3, contract, state,
+                               [contract.events.Staked, contract.events.Unstaked, contract.events.Transfer],
+                               {"address": POOL_ADDRESSES[0]}, combine_event_queries=True,
+                               batch_transport=BatchRPCTransport(url), metrics=metrics)
+
+        # Backfill, then follow from where it ended
+        scanner.scan(1, start_head - confirmations, progress_callback=lambda *args: None)
+        node.reset_stats()
+
+        lags = []
+        last_block = start_head + blocks - confirmations
+
+        def _consumer(update):
+            lags.append(time.time() - chain.mined_at[update.end_block])
+            if update.end_block >= last_block:
+                stop.set()
+
+        if mode == "poll":
+            # Started knowing the block time, as a long-running follow would have learned it
+            head_source = HeadPoller(scanner.get_head_block, block_time=block_time,
+                                     min_interval=min(0.5, block_time / 4), metrics=metrics)
+        else:
+            head_source = chain
+
+        chain.start_mining(block_time, stop)
+        # Give up if the follow falls behind badly
+        timer = threading.Timer(blocks * block_time * 3 + 30, stop.set)
+        timer.start()
+        started = time.time()
+        updates = scanner.follow(_consumer, confirmations=confirmations, head_source=head_source, stop=stop)
+        seconds = time.time() - started
+        timer.cancel()
+    finally:
+        stop.set()
+        server.shutdown()
+        server.server_close()
+
+    stats = node.stats()
+    return {
+        "updates": updates,
+        "events": state.events,
+        "seconds": seconds,
+        "completed": bool(lags) and state.last_scanned_block >= last_block,
+        "lag_median_seconds": statistics.median(lags) if lags else None,
+        "lag_p95_seconds": sorted(lags)[int(0.95 * (len(lags) - 1))] if lags else None,
+        "lag_max_seconds": max(lags) if lags else None,
+        "head_polls_per_block": metrics.get("scanner_head_polls_total") / blocks,
+        "rpc_calls_per_block": sum(stats["calls"].values()) / blocks,
+        "calls": stats["calls"],
+    }
+
+
+def run_benchmark(modes, blocks: int, block_time: float, density: float, latency: float, confirmations: int,
+                  seed: int, log: Callable = print) -> dict:
+    results = {}
+    for mode in modes:
+        results[mode] = result = run_mode(mode, blocks, block_time, density, latency, confirmations, seed=seed)
+        log(f"{mode:<10} {result['updates']:>5} updates  lag median {result['lag_median_seconds']:.3f} s "
+            f"p95 {result['lag_p95_seconds']:.3f} s max {result['lag_max_seconds']:.3f} s  "
+            f"{result['head_polls_per_block']:.1f} polls/block {result['rpc_calls_per_block']:.1f} calls/block")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--blocks", type=int, default=30, help="Blocks mined while following")
+    parser.add_argument("--block-time", type=float, default=1.0, help="Seconds between mined blocks")
+    parser.add_argument("--density", type=float, default=0.5, help="Events per block")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--confirmations", type=int, default=0, help="Blocks the follow stays behind the head")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.modes, args.blocks, args.block_time, args.density, args.latency,
+                            args.confirmations, args.seed)
+    if args.json:
+        with open(args.json, "wt") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
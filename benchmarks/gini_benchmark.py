@@ -0,0 +1,313 @@
+"""Wall time and memory of the Gini/Lorenz engines across holder counts and dtypes.
+
+Every case (engine, distribution, dtype, holders) runs in its own process on
+the same heavy-tailed balances, so the peak RSS is that of the case alone.
+For example::
+
+    python -m benchmarks.gini_benchmark --holders 1e3 1e5 1e7 --json gini.json
+    python -m benchmarks.gini_benchmark --holders 1e3 1e5 1e7 --compare gini.json
+
+Reports per case the best and the median wall time, the peak memory traced by
+tracemalloc (NumPy buffers included), the peak RSS, and two allocation
+counters: the garbage collector's young generation collections, which grow
+with the number of Python objects created, and the net number of memory blocks
+still allocated by the interpreter after the call. The Gini coefficient of
+every case is recorded too, so engines disagreeing with each other show up.
+
+Balances are generated as float64 token amounts, as int64 micro tokens and as
+object arrays of Python integers in wei (18 decimals), the three forms the
+engines get from FetchData and the balance ledger.
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+#: Token distributions: name -> balances in tokens, given a generator and the number of holders
+DISTRIBUTIONS: Dict[str, Callable[[np.random.Generator, int], np.ndarray]] = {
+    # Power law tail with the 80/20 shape parameter
+    "pareto": lambda rng, n: (rng.pareto(1.16, n) + 1) * 10,
+    "lognormal": lambda rng, n: rng.lognormal(3, 2, n),
+    # Retail holders plus 0.1% whales holding most of the supply, typical of staking pools
+    "whales": lambda rng, n: np.where(rng.random(n) < 0.001, rng.pareto(0.8, n) * 1e5 + 1e5,
+                                      rng.lognormal(2, 1.5, n)),
+}
+
+DTYPES = ("float64", "int64", "object")
+
+# Bytes of memory per holder of the input balances
+_BYTES_PER_HOLDER = {"float64": 8, "int64": 8, "object": 8 + 44}
+
+
+def make_balances(distribution: str, dtype: str, holders: int, seed: int = 0) -> np.ndarray:
+    """Balances of a case, the same for the same seed across dtypes."""
+    tokens = DISTRIBUTIONS[distribution](np.random.default_rng(seed), holders)
+    if dtype == "float64":
+        return tokens
+    micro_tokens = np.maximum(np.round(tokens * 1e6), 1).astype(np.int64)
+    if dtype == "int64":
+        return micro_tokens
+    return np.array([int(amount) * 10 ** 12 for amount in micro_tokens.tolist()], dtype=object)
+
+
+def _lorenz(values):
+    from src.gini_lorenz.lorenz_curve import Lorenz
+
+    lorenz = Lorenz(values)
+    if lorenz.lst.size == 1:
+        return lorenz.gini(lorenz.lst)
+    return lorenz.gini(lorenz.lorenz(plot=False))
+
+
+def _lorenz_curve(values):
+    from src.gini_lorenz.exact_gini import exact_gini
+    from src.gini_lorenz.lorenz_visualization import LorenzCurve
+
+    # What LorenzCurve.plot_lorenz computes, without the figure
+    curve = LorenzCurve(values)
+    if curve.limbs is not None:
+        return exact_gini(curve.limbs)
+    return curve.gini(curve.lst.cumsum() / curve.lst.sum())
+
+
+def _exact_gini(values):
+    from src.gini_lorenz.exact_gini import exact_gini
+
+    return exact_gini(values)
+
+
+def _batch_gini(values):
+    from src.gini_lorenz.batch_gini import batch_gini
+
+    return float(batch_gini(values)[0])
+
+
+def _gini_sketch(values):
+    from src.gini_lorenz.gini_sketch import GiniSketch
+
+    return GiniSketch.from_values(values).gini()[0]
+
+
+def _streaming_gini(values):
+    from src.gini_lorenz.streaming_gini import StreamingGini
+
+    streaming = StreamingGini()
+    for holder, balance in enumerate(values.tolist()):
+        streaming.update(holder, balance)
+    return streaming.gini()
+
+
+class Engine:
+    """A way of computing the Gini coefficient of all balances at once."""
+
+    def __init__(self, function: Callable[[np.ndarray], float], max_holders: Optional[int] = None,
+                 dtypes: Tuple[str, ...] = DTYPES, description: str = ""):
+        """
+        :param function: Gini coefficient of a balance array
+        :param max_holders: Larger cases are skipped, for the engines running at Python speed
+        :param dtypes: Balance dtypes the engine takes
+        """
+        self.function = function
+        self.max_holders = max_holders
+        self.dtypes = dtypes
+        self.description = description
+
+
+#: Engines by name, a faster engine only needs an entry here to be benchmarked against the others
+ENGINES: Dict[str, Engine] = {
+    "Lorenz": Engine(_lorenz, description="lorenz_curve.Lorenz.lorenz + gini"),
+    "LorenzCurve": Engine(_lorenz_curve, description="lorenz_visualization.LorenzCurve, as in plot_lorenz"),
+    "exact_gini": Engine(_exact_gini, dtypes=("int64", "object"), description="exact_gini.exact_gini over 16 bit limbs"),
+    "batch_gini": Engine(_batch_gini, description="batch_gini.batch_gini with a single group"),
+    "GiniSketch": Engine(_gini_sketch, description="gini_sketch.GiniSketch, 1% relative accuracy"),
+    "StreamingGini": Engine(_streaming_gini, max_holders=10 ** 5, description="streaming_gini, one update per holder"),
+}
+
+
+def run_case(engine: str, distribution: str, dtype: str, holders: int, repeat: int, seed: int) -> dict:
+    """Benchmark one case in the current process."""
+    values = make_balances(distribution, dtype, holders, seed)
+    function = ENGINES[engine].function
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Imports and first-call caches out of the timed runs
+    function(values[:2])
+
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        gini = function(values)
+        times.append(time.perf_counter() - started)
+
+    # Memory on a separate run, tracemalloc slows down the allocations
+    gc.collect()
+    collections_before = gc.get_stats()[0]["collections"]
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    result = function(values)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    net_blocks = sys.getallocatedblocks() - blocks_before
+    del result
+
+    return {
+        "gini": float(gini),
+        "best_seconds": min(times),
+        "median_seconds": statistics.median(times),
+        "peak_traced_mb": peak_traced / 2 ** 20,
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "input_rss_mb": rss_before / 1024,
+        "gc_collections": gc.get_stats()[0]["collections"] - collections_before,
+        "net_allocated_blocks": net_blocks,
+    }
+
+
+def _run_case_in_process(queue, *args):
+    try:
+        queue.put(run_case(*args))
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def _skip_reason(engine: str, dtype: str, holders: int, max_object_holders: int, memory_limit_gb: float) -> str:
+    if dtype not in ENGINES[engine].dtypes:
+        return f"{engine} takes no {dtype} balances"
+    max_holders = ENGINES[engine].max_holders
+    if max_holders is not None and holders > max_holders:
+        return f"{engine} runs at Python speed, over {max_holders} holders"
+    if dtype == "object" and holders > max_object_holders:
+        return f"object arrays over {max_object_holders} holders"
+    # The engines hold a few copies of the balances at once
+    if 8 * _BYTES_PER_HOLDER[dtype] * holders > memory_limit_gb * 2 ** 30:
+        return f"needs more than {memory_limit_gb} GB"
+    return ""
+
+
+def _metadata() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": multiprocessing.cpu_count(),
+    }
+
+
+def run_benchmark(engines: List[str], distributions: List[str], dtypes: List[str], holders: List[int],
+                  repeat: int = 3, seed: int = 0, max_object_holders: int = 10 ** 6,
+                  memory_limit_gb: float = 8.0, log: Callable = print) -> List[dict]:
+    """Run every case in a fresh process and collect the results."""
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for n in holders:
+        for distribution in distributions:
+            for dtype in dtypes:
+                for engine in engines:
+                    row = {"engine": engine, "distribution": distribution, "dtype": dtype, "holders": n}
+                    reason = _skip_reason(engine, dtype, n, max_object_holders, memory_limit_gb)
+                    if reason:
+                        row["skipped"] = reason
+                    else:
+                        queue = context.Queue()
+                        process = context.Process(target=_run_case_in_process,
+                                                  args=(queue, engine, distribution, dtype, n, repeat, seed))
+                        process.start()
+                        row.update(queue.get())
+                        process.join()
+                    results.append(row)
+                    log(_format_row(row))
+    return results
+
+
+def _case_key(row: dict) -> tuple:
+    return row["engine"], row["distribution"], row["dtype"], row["holders"]
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float = 1.2,
+            min_seconds: float = 1e-3) -> List[dict]:
+    """Cases slower or larger than the baseline by more than threshold, or with a different Gini coefficient.
+
+    Cases faster than min_seconds in both runs are within the timer noise and not compared by time.
+    """
+    baseline = {_case_key(row): row for row in baseline if "best_seconds" in row}
+    regressions = []
+    for row in results:
+        old = baseline.get(_case_key(row))
+        if old is None or "best_seconds" not in row:
+            continue
+        ratio = row["best_seconds"] / old["best_seconds"] if old["best_seconds"] else 1.0
+        memory_ratio = row["peak_traced_mb"] / old["peak_traced_mb"] if old["peak_traced_mb"] else 1.0
+        gini_changed = not np.isclose(row["gini"], old["gini"], rtol=1e-9, atol=0.0)
+        slower = ratio > threshold and max(row["best_seconds"], old["best_seconds"]) >= min_seconds
+        if slower or memory_ratio > threshold or gini_changed:
+            regressions.append({**dict(zip(("engine", "distribution", "dtype", "holders"), _case_key(row))),
+                                "time_ratio": ratio, "memory_ratio": memory_ratio,
+                                "gini": row["gini"], "baseline_gini": old["gini"]})
+    return regressions
+
+
+def _format_row(row: dict) -> str:
+    case = f"{row['engine']:<14} {row['distribution']:<9} {row['dtype']:<7} {row['holders']:>10}"
+    if "skipped" in row:
+        return f"{case}  skipped: {row['skipped']}"
+    if "error" in row:
+        return f"{case}  failed: {row['error']}"
+    return (f"{case}  {row['best_seconds']:>9.4f} s {row['peak_traced_mb']:>9.1f} MB traced "
+            f"{row['peak_rss_mb']:>8.1f} MB RSS {row['gc_collections']:>7} gc  gini {row['gini']:.6f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument("--distributions", nargs="+", default=list(DISTRIBUTIONS), choices=list(DISTRIBUTIONS))
+    parser.add_argument("--dtypes", nargs="+", default=list(DTYPES), choices=DTYPES)
+    parser.add_argument("--holders", nargs="+", type=float, default=[10 ** k for k in range(3, 9)],
+                        help="Holder counts, e.g. 1e3 1e6")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-object-holders", type=float, default=1e6,
+                        help="Skip object arrays beyond this many holders")
+    parser.add_argument("--memory-limit-gb", type=float, default=8.0,
+                        help="Skip the cases estimated to need more memory")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="Report cases slower or larger than the earlier run by this factor")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.engines, args.distributions, args.dtypes, [int(n) for n in args.holders],
+                            args.repeat, args.seed, int(args.max_object_holders), args.memory_limit_gb)
+    report = {"metadata": _metadata(), "parameters": vars(args), "results": results}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        report["baseline"] = baseline["metadata"]
+        report["regressions"] = compare(results, baseline["results"], args.threshold)
+        for row in report["regressions"]:
+            print(f"Regression: {row}")
+    if args.json:
+        with open(args.json, "wt") as f:
+            json.dump(report, f, indent=2)
+    if args.compare and report["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Throughput benchmark of the scanner modes against the synthetic JSON-RPC node.
+
+Every mode scans the same synthetic chain in its own process, so the peak RSS
+is that of the mode alone, while the node runs on localhost in this process
+and counts the calls. For example::
+
+    python -m benchmarks.scanner_benchmark --blocks 200000 --density 0.05 --latency 0.01 --json results.json
+
+Reports events/s, JSON-RPC calls per 1M blocks, retries (errors the node returned)
+and the peak RSS of every mode.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import time
+from typing import Callable, Dict
+
+from benchmarks.synthetic_node import SyntheticChain, SyntheticNode
+
+#: Pool contracts of the synthetic chain, the same as FetchData.pools
+POOL_ADDRESSES = ["0x25121EDDf746c884ddE4619b573A7B10714E2a36", "0x8B4d8443a0229349A9892D4F7CbE89eF5f843F72"]
+
+
+def _counting_state():
+    from src.contracts.event_scanner_state import EventScannerState
+
+    class CountingState(EventScannerState):
+        """Keeps only the number of events, so we measure the scanner and not the storage."""
+
+        def __init__(self):
+            self.last_scanned_block = 0
+            self.events = 0
+
+        def get_last_scanned_block(self):
+            return self.last_scanned_block
+
+        def delete_data(self, since_block):
+            pass
+
+        def start_chunk(self, block_number, chunk_size):
+            pass
+
+        def end_chunk(self, block_number):
+            self.last_scanned_block = block_number
+
+        def process_event(self, block_when: datetime.datetime, event) -> str:
+            self.events += 1
+            return ""
+
+    return CountingState()
+
+
+def _scanner_kwargs(url: str, mode: str) -> dict:
+    from src.contracts.batch_rpc import BatchRPCTransport
+    from src.contracts.chunk_size_controller import AIMDChunkSizeController
+
+    kwargs = {"combine_event_queries": mode != "sequential"}
+    if mode in ("batch", "parallel", "aimd", "async"):
+        kwargs["batch_transport"] = BatchRPCTransport(url)
+    if mode == "aimd":
+        kwargs["chunk_size_controller"] = AIMDChunkSizeController()
+    if mode == "async":
+        del kwargs["batch_transport"]
+    return kwargs
+
+
+def run_mode(mode: str, url: str, blocks: int) -> dict:
+    """Scan blocks 1..blocks with one scanner mode, in the current process."""
+    from web3 import Web3
+    from web3.providers.rpc import HTTPProvider
+
+    from src.contracts.async_event_scanner import AsyncEventScanner
+    from src.contracts.event_scanner import EventScanner
+    from src.contracts.fetch_data import FetchData
+    from src.utils.project_paths import DOC_PATH
+
+    provider = HTTPProvider(url)
+    provider.middlewares.clear()
+    w3 = Web3(provider)
+    abi = json.load(open(os.path.join(DOC_PATH, "abi.json")))
+    contract = w3.eth.contract(abi=abi)
+    events = [contract.events.Staked, contract.events.Unstaked, contract.events.Transfer]
+    filters = {"address": POOL_ADDRESSES[0]}
+    state = _counting_state()
+
+    def _progress(*args):
+        pass
+
+    started = time.time()
+    chunks = 0
+    if mode == "fetch_data":
+        fetch = FetchData(provider_url=url)
+        fetch.log_cache = None
+        fetch.hard_block_start, fetch.hard_block_end = 1, blocks
+        frames = fetch.make_events_dfs_all_pools(["Staked", "Unstaked"])
+        event_count = sum(len(frame) for frame in frames.values())
+    elif mode == "async":
+        async def _scan():
+            async with AsyncEventScanner(w3, contract, state, events, filters, endpoint_uri=url,
+                                         **_scanner_kwargs(url, mode)) as scanner:
+                return await scanner.scan(1, blocks, progress_callback=_progress)
+        _, chunks = asyncio.run(_scan())
+        event_count = state.events
+    else:
+        scanner = EventScanner(w3, contract, state, events, filters, **_scanner_kwargs(url, mode))
+        if mode == "parallel":
+            _, chunks = scanner.scan_parallel(1, blocks, max_workers=4, progress_callback=_progress)
+        else:
+            _, chunks = scanner.scan(1, blocks, progress_callback=_progress)
+        event_count = state.events
+
+    return {
+        "events": event_count,
+        "seconds": time.time() - started,
+        "chunks": chunks,
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _run_mode_in_process(queue, mode, url, blocks):
+    try:
+        queue.put(run_mode(mode, url, blocks))
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+MODES: Dict[str, str] = {
+    "sequential": "EventScanner.scan, one eth_getLogs per event type",
+    "combined": "EventScanner.scan, one eth_getLogs for all event types",
+    "batch": "combined, block timestamps as JSON-RPC batches",
+    "aimd": "batch, with the AIMD chunk size controller",
+    "parallel": "batch, EventScanner.scan_parallel with 4 workers",
+    "async": "AsyncEventScanner.scan",
+    "fetch_data": "FetchData.make_events_dfs_all_pools",
+}
+
+
+def run_benchmark(modes, blocks: int, density: float, latency: float, max_logs: int, error_rate: float,
+                  reorg_every: int, seed: int, log: Callable = print) -> dict:
+    """Run every mode against a fresh synthetic node and collect the results."""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for mode in modes:
+        chain = SyntheticChain(POOL_ADDRESSES, head=blocks, density=density, seed=seed)
+        node = SyntheticNode(chain, latency=latency, max_logs=max_logs, error_rate=error_rate,
+                             reorg_every=reorg_every, seed=seed)
+        server, url = node.serve()
+        try:
+            queue = context.Queue()
+            process = context.Process(target=_run_mode_in_process, args=(queue, mode, url, blocks))
+            process.start()
+            result = queue.get()
+            process.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        stats = node.stats()
+        rpc_calls = sum(stats["calls"].values())
+        result.update({
+            "rpc_calls": rpc_calls,
+            "rpc_calls_per_1m_blocks": rpc_calls * 1e6 / blocks,
+            "http_requests": stats["http_requests"],
+            "retries": sum(stats["errors"].values()),
+            "reorgs": stats["reorgs"],
+            "calls": stats["calls"],
+        })
+        if "error" not in result:
+            result["events_per_second"] = result["events"] / result["seconds"] if result["seconds"] else 0.0
+        results[mode] = result
+        log(_format_row(mode, result))
+    return results
+
+
+def _format_row(mode: str, result: dict) -> str:
+    if "error" in result:
+        return f"{mode:<12} failed: {result['error']}"
+    return (f"{mode:<12} {result['events']:>9} events {result['events_per_second']:>10.0f} events/s "
+            f"{result['rpc_calls_per_1m_blocks']:>10.0f} calls/1M blocks {result['retries']:>5} retries "
+            f"{result['peak_rss_mb']:>7.1f} MB peak RSS")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--blocks", type=int, default=200000)
+    parser.add_argument("--density", type=float, default=0.02, help="Events per block")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--max-logs", type=int, default=10000, help="eth_getLogs responses above fail as too large")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing transiently")
+    parser.add_argument("--reorg-every", type=int, default=0, help="Reorg the head every this many eth_getLogs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.modes, args.blocks, args.density, args.latency, args.max_logs,
+                            args.error_rate, args.reorg_every, args.seed)
+    if args.json:
+        with open(args.json, "wt") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""A deterministic synthetic chain behind a JSON-RPC interface.
+
+Serves the calls the scanners make (`eth_blockNumber`, `eth_getBlockByNumber`,
+`eth_getLogs`, `eth_chainId`, `net_version`, batches included) from a generated chain
+of Staked/Unstaked/Transfer logs, so scanner performance can be measured
+and regression-tested without a live node. Latency, "response too large" errors,
+transient errors and chain reorganisations can be injected.
+
+Use it in-process through `SyntheticProvider`, or over HTTP on localhost with `serve()`.
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from eth_utils import event_abi_to_log_topic
+from web3.providers.base import JSONBaseProvider
+
+from src.utils.project_paths import DOC_PATH
+
+#: Events we generate, in the order of `event_mix`
+EVENT_NAMES = ("Staked", "Unstaked", "Transfer")
+
+GENESIS_TIMESTAMP = 1623000000
+
+
+class SyntheticChain:
+    """Chain of blocks with pseudo-random pool events, the same for the same seed.
+
+    Blocks are generated up to `capacity`, `head` is the latest mined block.
+    `mine()` moves the head forward and `reorg()` replaces the latest blocks
+    with a different fork, with new hashes and new logs.
+    """
+
+    def __init__(self, addresses: List[str], head: int = 1000000, capacity: Optional[int] = None,
+                 density: float = 0.02, event_mix: Tuple[float, float, float] = (0.5, 0.3, 0.2),
+                 holders: int = 5000, block_time: float = 13.0, seed: int = 0, chain_id: int = 1):
+        """
+        :param addresses: Contract addresses emitting the events
+        :param head: The latest mined block
+        :param capacity: Blocks generated ahead, for mining new blocks later, head by default
+        :param density: Average number of events per block
+        :param event_mix: Shares of Staked, Unstaked and Transfer events
+        :param holders: Number of distinct holder addresses
+        :param block_time: Seconds between blocks
+        """
+        self.addresses = [address.lower() for address in addresses]
+        self.head = head
+        self.capacity = max(capacity or head, head)
+        self.block_time = block_time
+        self.seed = seed
+        self.chain_id = chain_id
+        # Block number -> fork number, for the blocks replaced by reorgs
+        self.forks: Dict[int, int] = {}
+        self.lock = threading.RLock()
+        # Notified when the head moves, for head subscriptions
+        self.head_changed = threading.Condition(self.lock)
+        # Block number -> time.time() when mine() made it, for measuring follow lag
+        self.mined_at: Dict[int, float] = {}
+
+        with open(os.path.join(DOC_PATH, "abi.json")) as f:
+            abi = json.load(f)
+        self.topics = ["0x" + event_abi_to_log_topic(item).hex() for name in EVENT_NAMES
+                       for item in abi if item.get("type") == "event" and item.get("name") == name]
+
+        rng = np.random.default_rng(seed)
+        count = rng.poisson(density * self.capacity)
+        self.blocks = np.sort(rng.integers(1, self.capacity + 1, count))
+        self.events = rng.choice(len(EVENT_NAMES), count, p=event_mix)
+        self.contracts = rng.integers(0, len(self.addresses), count)
+        self.senders = rng.integers(0, holders, count)
+        self.receivers = rng.integers(0, holders, count)
+        # In units of 10 ** 15, the amounts in wei overflow int64
+        self.amounts = rng.integers(1, 10 ** 6, count)
+        # Logs of blocks replaced by reorgs
+        self.fork_logs: Dict[int, List[dict]] = {}
+
+    def block_hash(self, block_number: int) -> str:
+        fork = self.forks.get(block_number, 0)
+        return "0x" + hashlib.sha256(f"{self.seed}-{block_number}-{fork}".encode()).hexdigest()
+
+    def get_block(self, block_number: int) -> Optional[dict]:
+        if block_number < 0 or block_number > self.head:
+            return None
+        return {
+            "number": hex(block_number),
+            "hash": self.block_hash(block_number),
+            "parentHash": self.block_hash(block_number - 1) if block_number else "0x" + "00" * 32,
+            "timestamp": hex(GENESIS_TIMESTAMP + int(block_number * self.block_time)),
+            "transactions": [],
+        }
+
+    def _log(self, i: int, block_number: int, log_index: int) -> dict:
+        address = self.addresses[self.contracts[i]]
+        sender = "0x" + "00" * 12 + hashlib.sha256(f"holder-{self.senders[i]}".encode()).hexdigest()[:40]
+        receiver = "0x" + "00" * 12 + hashlib.sha256(f"holder-{self.receivers[i]}".encode()).hexdigest()[:40]
+        return {
+            "address": address,
+            "topics": [self.topics[self.events[i]], sender, receiver],
+            "data": "0x" + (int(self.amounts[i]) * 10 ** 15).to_bytes(32, "big").hex(),
+            "blockNumber": hex(block_number),
+            "blockHash": self.block_hash(block_number),
+            "transactionHash": "0x" + hashlib.sha256(f"{self.block_hash(block_number)}-{log_index}".encode()).hexdigest(),
+            "transactionIndex": hex(log_index),
+            "logIndex": hex(log_index),
+            "removed": False,
+        }
+
+    def logs_of_range(self, from_block: int, to_block: int) -> List[dict]:
+        """All logs between two blocks, before address and topic filtering."""
+        to_block = min(to_block, self.head)
+        lo = int(np.searchsorted(self.blocks, from_block, side="left"))
+        hi = int(np.searchsorted(self.blocks, to_block, side="right"))
+        logs = []
+        log_index = 0
+        previous_block = None
+        for i in range(lo, hi):
+            block_number = int(self.blocks[i])
+            if block_number in self.fork_logs:
+                continue
+            log_index = log_index + 1 if block_number == previous_block else 0
+            previous_block = block_number
+            logs.append(self._log(i, block_number, log_index))
+        for block_number, fork_logs in self.fork_logs.items():
+            if from_block <= block_number <= to_block:
+                logs.extend(fork_logs)
+        logs.sort(key=lambda log: (int(log["blockNumber"], 16), int(log["logIndex"], 16)))
+        return logs
+
+    def mine(self, blocks: int = 1):
+        with self.lock:
+            now = time.time()
+            for block_number in range(self.head + 1, min(self.capacity, self.head + blocks) + 1):
+                self.mined_at[block_number] = now
+            self.head = min(self.capacity, self.head + blocks)
+            self.head_changed.notify_all()
+
+    def start_mining(self, block_time: float, stop: threading.Event) -> threading.Thread:
+        """Mine a block every block_time seconds in a background thread, until stopped or out of capacity."""
+        def _mine():
+            while not stop.wait(block_time) and self.head < self.capacity:
+                self.mine()
+
+        thread = threading.Thread(target=_mine, daemon=True)
+        thread.start()
+        return thread
+
+    def wait_for_new_head(self, last_head: int, stop: Optional[threading.Event] = None) -> int:
+        """Head subscription: block until the head is past last_head, as `HeadPoller.wait_for_new_head`."""
+        with self.head_changed:
+            while self.head <= last_head and not (stop and stop.is_set()):
+                # Wake up now and then to see the stop event
+                self.head_changed.wait(0.1)
+            return self.head
+
+    def reorg(self, depth: int):
+        """Replace the latest `depth` blocks with another fork."""
+        with self.lock:
+            rng = random.Random(f"{self.seed}-reorg-{self.head}-{len(self.forks)}")
+            for block_number in range(max(1, self.head - depth + 1), self.head + 1):
+                self.forks[block_number] = self.forks.get(block_number, 0) + 1
+                original = self.logs_of_range(block_number, block_number)
+                # The new fork has a different subset of the events, with new hashes
+                kept = [dict(log) for log in original if rng.random() < 0.5]
+                for log_index, log in enumerate(kept):
+                    log.update(blockHash=self.block_hash(block_number), logIndex=hex(log_index),
+                               transactionHash="0x" + hashlib.sha256(
+                                   f"{self.block_hash(block_number)}-{log_index}".encode()).hexdigest())
+                self.fork_logs[block_number] = kept
+
+
+class SyntheticNode:
+    """JSON-RPC front of a `SyntheticChain`, with fault injection and call statistics."""
+
+    def __init__(self, chain: SyntheticChain, latency: float = 0.0, max_logs: Optional[int] = 10000,
+                 max_block_range: Optional[int] = None, error_rate: float = 0.0,
+                 reorg_every: int = 0, reorg_depth: int = 3, seed: int = 0):
+        """
+        :param latency: Seconds added to every request
+        :param max_logs: `eth_getLogs` responses with more logs fail as too large, as Infura does
+        :param max_block_range: `eth_getLogs` over more blocks fail
+        :param error_rate: Share of `eth_getLogs` calls failing with a transient error
+        :param reorg_every: Reorganise the chain head every this many `eth_getLogs` calls, never by default
+        :param reorg_depth: How many blocks a reorg replaces
+        """
+        self.chain = chain
+        self.latency = latency
+        self.max_logs = max_logs
+        self.max_block_range = max_block_range
+        self.error_rate = error_rate
+        self.reorg_every = reorg_every
+        self.reorg_depth = reorg_depth
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.reorgs = 0
+        self.http_requests = 0
+        # All eth_getLogs calls, for the reorg schedule
+        self.get_logs_calls = 0
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = Counter()
+            self.errors = Counter()
+            self.reorgs = 0
+            self.http_requests = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "reorgs": self.reorgs,
+                "http_requests": self.http_requests,
+            }
+
+    def handle(self, payload):
+        """Answer a JSON-RPC request or a batch of them."""
+        with self.lock:
+            self.http_requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(payload, list):
+            return [self._handle_one(item) for item in payload]
+        return self._handle_one(payload)
+
+    def _handle_one(self, request: dict) -> dict:
+        method, params = request.get("method"), request.get("params") or []
+        with self.lock:
+            self.calls[method] += 1
+            # Only eth_getLogs is retried by the scanners
+            transient = method == "eth_getLogs" and self.error_rate and self.rng.random() < self.error_rate
+            if transient:
+                self.errors["transient"] += 1
+        reply = {"jsonrpc": "2.0", "id": request.get("id")}
+        if transient:
+            reply["error"] = {"code": -32603, "message": "internal error, please retry"}
+            return reply
+        handler = getattr(self, "rpc_" + str(method), None)
+        if handler is None:
+            reply["error"] = {"code": -32601, "message": f"the method {method} does not exist"}
+            return reply
+        # Anything else raised by a handler is a bug of the node, and fails loudly
+        try:
+            reply["result"] = handler(*params)
+        except _RPCError as e:
+            with self.lock:
+                self.errors[e.kind] += 1
+            reply["error"] = {"code": e.code, "message": e.message}
+        return reply
+
+    def rpc_eth_chainId(self):
+        return hex(self.chain.chain_id)
+
+    def rpc_net_version(self):
+        return str(self.chain.chain_id)
+
+    def rpc_eth_blockNumber(self):
+        return hex(self.chain.head)
+
+    def rpc_eth_getBlockByNumber(self, block, full_transactions=False):
+        block_number = self.chain.head if block == "latest" else _to_int(block)
+        return self.chain.get_block(block_number)
+
+    def rpc_eth_getLogs(self, params: dict):
+        with self.lock:
+            self.get_logs_calls += 1
+            reorg = self.reorg_every and self.get_logs_calls % self.reorg_every == 0
+            if reorg:
+                self.reorgs += 1
+        if reorg:
+            self.chain.reorg(self.reorg_depth)
+
+        from_block = _to_int(params.get("fromBlock", 0))
+        to_block = _to_int(params.get("toBlock", "latest"), self.chain.head)
+        if self.max_block_range and to_block - from_block + 1 > self.max_block_range:
+            raise _RPCError("range", -32005, f"block range is too large, max {self.max_block_range} blocks")
+
+        address = params.get("address")
+        addresses = None
+        if address:
+            addresses = {a.lower() for a in ([address] if isinstance(address, str) else address)}
+        topics = params.get("topics") or []
+        topic0 = topics[0] if topics else None
+        if isinstance(topic0, str):
+            topic0 = [topic0]
+        topic0 = {t.lower() for t in topic0} if topic0 else None
+
+        with self.chain.lock:
+            logs = [log for log in self.chain.logs_of_range(from_block, to_block)
+                    if (addresses is None or log["address"] in addresses)
+                    and (topic0 is None or log["topics"][0] in topic0)]
+        if self.max_logs is not None and len(logs) > self.max_logs:
+            raise _RPCError("too_large", -32005, f"query returned more than {self.max_logs} results")
+        return logs
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+        """Serve JSON-RPC over HTTP in a background thread.
+
+        :return: tuple(server, endpoint URL), call server.shutdown() to stop
+        """
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are separate writes, Nagle would delay every reply by ~40 ms
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                reply = json.dumps(node.handle(json.loads(body))).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://{host}:{server.server_address[1]}"
+
+
+class SyntheticProvider(JSONBaseProvider):
+    """Web3 provider calling a `SyntheticNode` in-process, without HTTP."""
+
+    def __init__(self, node: SyntheticNode):
+        super().__init__()
+        self.node = node
+        self._ids = 0
+
+    def make_request(self, method, params):
+        self._ids += 1
+        return self.node.handle({"jsonrpc": "2.0", "id": self._ids, "method": method, "params": list(params)})
+
+    def isConnected(self):
+        return True
+
+
+class _RPCError(Exception):
+    def __init__(self, kind: str, code: int, message: str):
+        super().__init__(message)
+        self.kind = kind
+        self.code = code
+        self.message = message
+
+
+def _to_int(value, latest: Optional[int] = None) -> int:
+    if value == "latest":
+        return latest
+    if isinstance(value, str):
+        return int(value, 16)
+    return int(value)
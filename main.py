@@ -7,7 +7,15 @@ import logging
 from web3 import Web3
 
 from src.contracts.event_scanner import EventScanner
+from src.contracts.batch_rpc import BatchRPCTransport
+from src.contracts.block_hash_index import BlockHashIndex
+from src.contracts.block_timestamp_index import BlockTimestampIndex
+from src.contracts.raw_log_cache import RawLogCache
 from src.contracts.json_event_scanner import JSONifiedState
+from src.contracts.balance_ledger import BalanceLedger
+from src.contracts.balance_snapshots import BalanceSnapshotIndex
+from src.contracts.scan_metrics import MeteredHTTPProvider, ScanMetrics, serve_metrics
+from src.contracts.follow import LedgerGini
 
 from src.utils.project_paths import DOC_PATH, DATA_PATH
 
@@ -20,7 +28,6 @@ if __name__ == "__main__":
     # The resulting JSON state file is 2.9 MB.
     import sys
     import json
-    from web3.providers.rpc import HTTPProvider
 
     from tqdm import tqdm
 
@@ -44,7 +51,7 @@ if __name__ == "__main__":
     def run():
 
         if len(sys.argv) < 2:
-            print("Usage: eventscanner.py https://eth-mainnet.alchemyapi.io/v2/uanCKV5LOP7NtaVUos3qtH-R-V1xy-A3")
+            print("Usage: eventscanner.py https://eth-mainnet.alchemyapi.io/v2/uanCKV5LOP7NtaVUos3qtH-R-V1xy-A3 [--follow]")
             sys.exit(1)
 
         api_url = sys.argv[1]
@@ -53,7 +60,16 @@ if __name__ == "__main__":
         # DEBUG is very verbose level
         logging.basicConfig(level=logging.INFO)
 
-        provider = HTTPProvider(api_url)
+        # Counters and timings of the scan, at http://127.0.0.1:9108/metrics while it runs, or a free port if taken
+        metrics = ScanMetrics()
+        try:
+            _, metrics_url = serve_metrics(metrics)
+        except OSError:
+            # The port is taken, e.g. by another scanner
+            _, metrics_url = serve_metrics(metrics, port=0)
+        print(f"Scan metrics at {metrics_url}")
+
+        provider = MeteredHTTPProvider(api_url, metrics=metrics)
 
         # Remove the default JSON-RPC retry middleware
         # as it correctly cannot handle eth_getLogs block range
@@ -67,9 +83,24 @@ if __name__ == "__main__":
         ERC20 = w3.eth.contract(abi=abi)
 
         # Restore/create our persistent state
-        state = JSONifiedState()
+        # Holder balances kept up to date while scanning, for the dashboard
+        ledger = BalanceLedger(
+            fname=os.path.join(DATA_PATH, "ILV-Core balances.json"),
+            pool_labels={RCC_ADDRESS: "ILV Core"},
+            default_pool="ILV Core",
+            # Balance checkpoints for Gini over time
+            snapshots=BalanceSnapshotIndex(os.path.join(DATA_PATH, "ILV-Core balance snapshots")))
+        state = JSONifiedState(journaled=True, ledger=ledger)
         state.restore()
 
+        # Block timestamps we have already asked from the node on the previous runs
+        timestamp_index = BlockTimestampIndex()
+        timestamp_index.restore()
+
+        # Hashes of the scanned blocks, to tell where a chain reorganisation forked off
+        block_hash_index = BlockHashIndex()
+        block_hash_index.restore()
+
         # chain_id: int, w3: Web3, abi: dict, state: EventScannerState, events: List, filters: {}, max_chunk_scan_size: int=10000
         scanner = EventScanner(
             w3=w3,
@@ -79,20 +110,26 @@ if __name__ == "__main__":
             filters={"address": RCC_ADDRESS},
             # How many maximum blocks at the time we request from JSON-RPC
             # and we are unlikely to exceed the response size limit of the JSON-RPC server
-            max_chunk_scan_size=100000
+            max_chunk_scan_size=100000,
+            # Ask for Staked/Unstaked/Transfer in a single eth_getLogs per chunk
+            combine_event_queries=True,
+            # Resolve block timestamps with JSON-RPC batches
+            batch_transport=BatchRPCTransport(api_url, max_batch_size=100, metrics=metrics),
+            timestamp_index=timestamp_index,
+            # Keep the raw eth_getLogs responses, so the history can be decoded again without the node
+            log_cache=RawLogCache(),
+            metrics=metrics,
+            block_hash_index=block_hash_index
         )
 
         # Assume we might have scanned the blocks all the way to the last Ethereum block
         # that mined a few seconds before the previous scan run ended.
         # Because there might have been a minor Etherueum chain reorganisations
-        # since the last scan ended, we need to discard
-        # the last few blocks from the previous scan results.
-        chain_reorg_safety_blocks = 10
-        scanner.delete_potentially_forked_block_data(state.get_last_scanned_block() - chain_reorg_safety_blocks)
-
-        # Scan from [last block scanned] - [latest ethereum block]
-        # Note that our chain reorg safety blocks cannot go negative
-        start_block = max(state.get_last_scanned_block() - chain_reorg_safety_blocks, 0)
+        # since the last scan ended, we compare the stored block hashes with the chain
+        # and discard only the blocks after the fork. Without a reorganisation
+        # this is a single block hash check.
+        # Scan from [first block not on the chain any more] - [latest ethereum block]
+        start_block = scanner.handle_reorg()
         end_block = scanner.get_suggested_scan_end_block()
         blocks_to_scan = end_block - start_block
 
@@ -100,20 +137,47 @@ if __name__ == "__main__":
 
         # Render a progress bar in the console
         start = time.time()
-        with tqdm(total=blocks_to_scan) as progress_bar:
-            def _update_progress(start, end, current, current_block_timestamp, chunk_size, events_count):
-                if current_block_timestamp:
-                    formatted_time = current_block_timestamp.strftime("%d-%m-%Y")
-                else:
-                    formatted_time = "no block time available"
-                progress_bar.set_description(f"Current block: {current} ({formatted_time}), blocks in a scan batch: {chunk_size}, events processed in a batch {events_count}")
-                progress_bar.update(chunk_size)
-
-            # Run the scan
-            result, total_chunks_scanned = scanner.scan(start_block, end_block, progress_callback=_update_progress)
+        if start_block > end_block:
+            # Nothing mined since the last run, or a replay of what is already scanned
+            print("No new blocks to scan")
+            result, total_chunks_scanned = [], 0
+        else:
+            with tqdm(total=blocks_to_scan) as progress_bar:
+                def _update_progress(start, end, current, current_block_timestamp, chunk_size, events_count):
+                    if current_block_timestamp:
+                        formatted_time = current_block_timestamp.strftime("%d-%m-%Y")
+                    else:
+                        formatted_time = "no block time available"
+                    progress_bar.set_description(f"Current block: {current} ({formatted_time}), blocks in a scan batch: {chunk_size}, events processed in a batch {events_count}")
+                    progress_bar.update(chunk_size)
+
+                # Run the scan
+                result, total_chunks_scanned = scanner.scan(start_block, end_block, progress_callback=_update_progress)
 
         state.save()
+        timestamp_index.save()
+        block_hash_index.save()
         duration = time.time() - start
         print(f"Scanned total {len(result)} Transfer events, in {duration} seconds, total {total_chunks_scanned} chunk scans performed")
+        print(f"eth_getLogs latency p50 {metrics.quantile('rpc_request_seconds', 0.5, method='eth_getLogs'):.3f} s, "
+              f"p99 {metrics.quantile('rpc_request_seconds', 0.99, method='eth_getLogs'):.3f} s, "
+              f"{metrics.get('scanner_get_logs_retries_total'):.0f} retries")
+
+        if "--follow" in sys.argv:
+            # Keep the state in memory and scan the new blocks as they are mined,
+            # instead of restarting and reloading the state for every refresh
+            # The new blocks skip the raw log cache, it keeps only the backfill
+            def _print_gini(gini, update):
+                lag = f"{update.lag:.1f} s" if update.lag is not None else "unknown"
+                print(f"Block {update.end_block}: Gini {gini:.4f}, {len(update.events)} new events, lag {lag}")
+
+            print("Following new blocks, CTRL+C to stop")
+            try:
+                scanner.follow(LedgerGini(ledger, on_gini=_print_gini))
+            except KeyboardInterrupt:
+                pass
+            state.save()
+            timestamp_index.save()
+            block_hash_index.save()
 
     run()
\ No newline at end of file
@@ -0,0 +1,355 @@
+"""Asyncio variant of the stateful event scanner.
+
+Talks JSON-RPC over a pooled keep-alive aiohttp session, so the scanner can be
+embedded in an async application and keep many requests in flight to one node
+without blocking the event loop.
+"""
+
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import aiohttp
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.contract import Contract
+from web3.datastructures import AttributeDict
+
+from src.contracts.event_scanner import (EventScanner, _get_abis_by_topic, _construct_multi_event_filter_params,
+                                         _decode_logs, _uncombinable_filters)
+from src.contracts.event_scanner_state import EventScannerState
+from src.contracts.chunk_size_controller import ChunkSizeController, estimate_response_bytes
+from src.contracts.scan_metrics import MetricsSink, NullMetrics, error_kind
+
+
+logger = logging.getLogger(__name__)
+
+
+class JSONRPCError(ValueError):
+    """The node answered a JSON-RPC call with an error, a ValueError as Web3 raises."""
+
+
+#: Failed calls worth retrying: the node, or the way to it, failed
+RETRIABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError, JSONRPCError)
+
+
+class AsyncEventScanner(EventScanner):
+    """Scan blockchain for events using asyncio.
+
+    Same `scan`/`scan_chunk` semantics and the same `EventScannerState` contract as `EventScanner`,
+    but the methods talking to the node are coroutines.
+    The event types of a chunk and the block timestamps are all requested concurrently,
+    limited by `max_concurrent_requests`.
+
+    Use as an async context manager, or call `open()` and `close()`, to manage the HTTP session.
+    Following the head, reorganisation handling and parallel scans are only in `EventScanner`.
+    """
+
+    def __init__(self, w3: Web3, contract: Contract, state: EventScannerState, events: List, filters,
+                 endpoint_uri: str, max_concurrent_requests: int = 8, request_timeout: float = 60.0, **kwargs):
+        """
+        :param w3: Web3 instance used only for the ABI codec
+        :param endpoint_uri: HTTP(S) URL of the JSON-RPC node
+        :param max_concurrent_requests: How many JSON-RPC requests we have in flight at the same time
+        :param request_timeout: HTTP request timeout in seconds
+
+        Other parameters are the same as for `EventScanner`, except `log_cache` and `batch_transport`.
+        Only the address filter is supported in `filters`.
+
+        :raise ValueError: For event argument filters or parameters this scanner does not support
+        """
+        unsupported = [name for name in ("log_cache", "batch_transport") if kwargs.get(name) is not None]
+        if unsupported:
+            raise ValueError(f"AsyncEventScanner does not support {', '.join(unsupported)}")
+        unsupported_filters = _uncombinable_filters(filters)
+        if unsupported_filters:
+            raise ValueError(f"AsyncEventScanner supports only the address filter, got {unsupported_filters}")
+        super().__init__(w3, contract, state, events, filters, **kwargs)
+        self.endpoint_uri = endpoint_uri
+        self.max_concurrent_requests = max_concurrent_requests
+        self.request_timeout = request_timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self._ids = itertools.count(1)
+
+    async def open(self):
+        """Open the keep-alive HTTP session."""
+        connector = aiohttp.TCPConnector(limit=self.max_concurrent_requests, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+        self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def request(self, method: str, params: list):
+        """Do a single JSON-RPC call.
+
+        :raise JSONRPCError: If the node returns a JSON-RPC error, a ValueError as Web3 raises
+        """
+        body = json.dumps({"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params}).encode()
+        self.metrics.inc("rpc_requests_total", method=method)
+        self.metrics.inc("rpc_request_bytes_total", len(body), method=method)
+        async with self.semaphore:
+            try:
+                with self.metrics.timer("rpc_request_seconds", method=method):
+                    async with self.session.post(self.endpoint_uri, data=body,
+                                                 headers={"Content-Type": "application/json"}) as response:
+                        response.raise_for_status()
+                        raw_reply = await response.read()
+            except Exception as e:
+                self.metrics.inc("rpc_errors_total", method=method, kind=error_kind(e))
+                raise
+        self.metrics.inc("rpc_response_bytes_total", len(raw_reply), method=method)
+        reply = json.loads(raw_reply)
+        if "error" in reply:
+            error = JSONRPCError(reply["error"])
+            self.metrics.inc("rpc_errors_total", method=method, kind=error_kind(error))
+            raise error
+        return reply["result"]
+
+    async def get_block_timestamp(self, block_num) -> Optional[datetime.datetime]:
+        """Get Ethereum block timestamp"""
+        block_info = await self.request("eth_getBlockByNumber", [hex(block_num), False])
+        if block_info is None:
+            # Block was not mined yet,
+            # minor chain reorganisation?
+            return None
+        return datetime.datetime.utcfromtimestamp(int(block_info["timestamp"], 16))
+
+    async def get_block_header(self, block_num) -> Optional[Tuple[datetime.datetime, str]]:
+        """Get when a block was mined and its hash, or None if the block is not mined yet."""
+        block_info = await self.request("eth_getBlockByNumber", [hex(block_num), False])
+        if block_info is None:
+            return None
+        return datetime.datetime.utcfromtimestamp(int(block_info["timestamp"], 16)), block_info["hash"]
+
+    async def get_block_timestamps(self, block_nums: Iterable[int]) -> dict:
+        """Get Ethereum block timestamps for many blocks, looking up the timestamp index first."""
+        block_nums = set(block_nums)
+        if self.timestamp_index:
+            result, missing = self.timestamp_index.lookup(block_nums, self.timestamp_max_error)
+            self.metrics.inc("scanner_timestamp_lookups_total", len(block_nums) - len(missing), source="index")
+            self.metrics.inc("scanner_timestamp_lookups_total", len(missing), source="node")
+            fetched = await self._fetch_block_timestamps(missing)
+            self.timestamp_index.record(fetched)
+            result.update(fetched)
+            return result
+        self.metrics.inc("scanner_timestamp_lookups_total", len(block_nums), source="node")
+        return await self._fetch_block_timestamps(block_nums)
+
+    async def _fetch_block_timestamps(self, block_nums: Iterable[int]) -> dict:
+        """Ask block timestamps from the node concurrently."""
+        block_nums = sorted(set(block_nums))
+        timestamps = await asyncio.gather(*[self.get_block_timestamp(block_num) for block_num in block_nums])
+        return dict(zip(block_nums, timestamps))
+
+    async def get_suggested_scan_end_block(self):
+        """Get the last mined block on Ethereum chain we are following."""
+
+        # Do not scan all the way to the final block, as this
+        # block might not be mined yet
+        return await self.get_head_block() - 1
+
+    async def get_head_block(self) -> int:
+        """The number of the latest block the node has."""
+        return int(await self.request("eth_blockNumber", []), 16)
+
+    def handle_reorg(self) -> int:
+        raise NotImplementedError("AsyncEventScanner cannot check the block hashes, use EventScanner.handle_reorg")
+
+    def scan_parallel(self, *args, **kwargs):
+        raise NotImplementedError("AsyncEventScanner keeps requests in flight concurrently in scan already")
+
+    def follow(self, *args, **kwargs):
+        raise NotImplementedError("AsyncEventScanner cannot follow the chain head, use EventScanner.follow")
+
+    async def _fetch_logs(self, events: List, start_block, end_block) -> list:
+        """Get events of the given types using a single eth_getLogs call."""
+        abis_by_topic = _get_abis_by_topic(events)
+        params = _construct_multi_event_filter_params(abis_by_topic, self.filters, hex(start_block), hex(end_block))
+        logger.debug("Querying eth_getLogs with the following parameters: %s", params)
+        logs = await self.request("eth_getLogs", [params])
+        return _decode_logs(self.w3.codec, abis_by_topic, [_format_raw_log(log) for log in logs])
+
+    async def fetch_chunk(self, start_block, end_block) -> Tuple[int, list, dict]:
+        """Read events between two block numbers without touching the state.
+
+        :return: tuple(actual end block number, raw events, map of block number -> when the block was mined)
+        """
+        started = time.perf_counter()
+        if self.combine_event_queries:
+            event_groups = [self.events]
+        else:
+            event_groups = [[event_type] for event_type in self.events]
+
+        def _make_fetch(events):
+            return lambda _start_block, _end_block: self._fetch_logs(events, _start_block, _end_block)
+
+        get_logs_seconds = []
+
+        results = await asyncio.gather(*[
+            _async_retry_web3_call(
+                _make_fetch(events),
+                start_block=start_block,
+                end_block=end_block,
+                retries=self.max_request_retries,
+                controller=self.chunk_size_controller,
+                metrics=self.metrics,
+                durations=get_logs_seconds)
+            for events in event_groups])
+        self.last_get_logs_seconds = max(get_logs_seconds)
+
+        # If any of the event types had to throttle down, we only got all events up to the shortest range
+        end_block = min(actual_end_block for actual_end_block, _ in results)
+        all_events = [evt for _, events in results for evt in events if evt["blockNumber"] <= end_block]
+        all_events.sort(key=lambda evt: (evt["blockNumber"], evt["logIndex"]))
+
+        if self.block_hash_index is not None:
+            # The chunk end is the anchor `handle_reorg` checks first, its header gives the timestamp too
+            end_header, block_timestamps = await asyncio.gather(
+                self.get_block_header(end_block),
+                self.get_block_timestamps([evt["blockNumber"] for evt in all_events if evt["blockNumber"] != end_block]))
+            block_timestamps[end_block] = end_header and end_header[0]
+            hashes = {evt["blockNumber"]: evt["blockHash"] for evt in all_events}
+            if end_header is not None:
+                hashes[end_block] = end_header[1]
+            self._stage_block_hashes(end_block, hashes)
+        else:
+            block_timestamps = await self.get_block_timestamps([evt["blockNumber"] for evt in all_events] + [end_block])
+        self.metrics.observe("scanner_fetch_seconds", time.perf_counter() - started)
+        return end_block, all_events, block_timestamps
+
+    async def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
+        """Read and process events between to block numbers.
+
+        :return: tuple(actual end block number, when this block was mined, processed events)
+        """
+        end_block, events, block_timestamps = await self.fetch_chunk(start_block, end_block)
+        all_processed = self.process_chunk(events, block_timestamps)
+        return end_block, block_timestamps[end_block], all_processed
+
+    async def scan(self, start_block, end_block, start_chunk_size=20,
+                   progress_callback: Optional[Callable] = None) -> Tuple[list, int]:
+        """Perform a token balances scan.
+
+        See `EventScanner.scan`.
+
+        :return: [All processed events, number of chunks used]
+        """
+
+        assert start_block <= end_block
+
+        current_block = start_block
+
+        # Scan in chunks, commit between
+        chunk_size = start_chunk_size
+        last_scan_duration = last_logs_found = 0
+        total_chunks_scanned = 0
+
+        # All processed entries we got on this scan cycle
+        all_processed = []
+
+        while current_block <= end_block:
+
+            self.state.start_chunk(current_block, chunk_size)
+
+            estimated_end_block = min(current_block + chunk_size, end_block)
+            logger.debug(
+                "Scanning token transfers for blocks: %d - %d, chunk size %d, last chunk scan took %f, last logs found %d",
+                current_block, estimated_end_block, chunk_size, last_scan_duration, last_logs_found)
+
+            start = time.time()
+            current_end, events, block_timestamps = await self.fetch_chunk(current_block, estimated_end_block)
+            new_entries = self.process_chunk(events, block_timestamps)
+            end_block_timestamp = block_timestamps[current_end]
+
+            last_scan_duration = time.time() - start
+            last_logs_found = len(new_entries)
+            all_processed += new_entries
+
+            if progress_callback:
+                progress_callback(start_block, end_block, current_block, end_block_timestamp, chunk_size, len(new_entries))
+
+            # Latency of the node only, processing the events is our own time
+            chunk_size = self.estimate_next_chunk_size(current_end - current_block + 1, len(new_entries),
+                                                       self.last_get_logs_seconds, estimate_response_bytes(events))
+
+            total_chunks_scanned += 1
+            self._commit_chunk(current_block, current_end, len(new_entries), start)
+            current_block = current_end + 1
+
+        return all_processed, total_chunks_scanned
+
+
+def _format_raw_log(log: dict) -> AttributeDict:
+    """Convert a raw JSON-RPC log to the same shape Web3 result formatters give us."""
+    return AttributeDict({
+        "address": Web3.toChecksumAddress(log["address"]),
+        "topics": [HexBytes(topic) for topic in log["topics"]],
+        "data": log["data"],
+        "blockNumber": int(log["blockNumber"], 16),
+        "blockHash": HexBytes(log["blockHash"]),
+        "transactionHash": HexBytes(log["transactionHash"]),
+        "transactionIndex": int(log["transactionIndex"], 16),
+        "logIndex": int(log["logIndex"], 16),
+    })
+
+
+async def _async_retry_web3_call(func, start_block, end_block, retries,
+                                 controller: ChunkSizeController,
+                                 metrics: Optional[MetricsSink] = None,
+                                 durations: Optional[List[float]] = None) -> Tuple[int, list]:
+    """A custom retry loop to throttle down block range, without blocking the event loop.
+
+    See `_retry_web3_call`.
+
+    Only node and connection failures are retried, anything else is a bug that retrying does not fix.
+
+    :param func: A coroutine function that triggers Ethereum JSON-RPC, as func(start_block, end_block)
+    """
+    if metrics is None:
+        metrics = NullMetrics()
+
+    for i in range(retries):
+        try:
+            with metrics.timer("scanner_get_logs_seconds"):
+                started = time.perf_counter()
+                events = await func(start_block, end_block)
+            if durations is not None:
+                durations.append(time.perf_counter() - started)
+            return end_block, events
+        except RETRIABLE_ERRORS as e:
+            metrics.inc("scanner_get_logs_errors_total", kind=error_kind(e))
+            if i < retries - 1:
+                metrics.inc("scanner_get_logs_retries_total")
+                chunk_size, delay = controller.on_error(end_block - start_block + 1, e, i)
+                logger.warning(
+                    "Retrying events for block range %d - %d (%d) failed with %s, retrying %d blocks in %s seconds",
+                    start_block,
+                    end_block,
+                    end_block-start_block,
+                    e,
+                    chunk_size,
+                    delay)
+                # Decrease the `eth_getBlocks` range if the controller tells so
+                end_block = start_block + chunk_size - 1
+                # Let the JSON-RPC to recover e.g. from restart
+                await asyncio.sleep(delay)
+                continue
+            else:
+                logger.warning("Out of retries")
+                raise
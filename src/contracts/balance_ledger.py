@@ -0,0 +1,214 @@
+"""Per-address balances kept up to date while scanning.
+
+Instead of replaying the whole event history before every Lorenz/Gini computation,
+the scanner state feeds each event to the ledger, and the dashboard reads
+the current balance vector directly.
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from web3.datastructures import AttributeDict
+
+from src.contracts.balance_snapshots import BalanceSnapshotIndex, balance_vector
+
+
+class BalanceLedger:
+    """Balances by pool and address, with an undo log per block for chain reorganisations.
+
+    Staked adds to the staker's balance, Unstaked subtracts from it
+    and Transfer moves the value from the sender to the receiver.
+    Only the last `undo_depth` blocks can be reverted.
+    """
+
+    def __init__(self, fname: Optional[str] = None, pool_labels: Optional[Dict[str, str]] = None,
+                 default_pool: str = "default", undo_depth: int = 1000,
+                 snapshots: Optional[BalanceSnapshotIndex] = None):
+        """
+        :param fname: JSON file where the ledger is stored
+        :param pool_labels: Pool contract address -> label used as the pool key, the address itself by default
+        :param default_pool: Pool key for events replayed from a state that does not record the contract address
+        :param undo_depth: How many recent blocks we can revert
+        :param snapshots: Balance checkpoints for historical queries, fed with every balance change
+        """
+        self.fname = fname
+        self.pool_labels = pool_labels or {}
+        self.default_pool = default_pool
+        self.undo_depth = undo_depth
+        self.snapshots = snapshots
+        # pool -> address -> balance
+        self.balances: Dict[str, Dict[str, int]] = defaultdict(dict)
+        # block number -> list of (pool, address, delta), blocks in increasing order
+        # whatever order the events are applied in
+        self.undo_log: Dict[int, List[Tuple[str, str, int]]] = {}
+        # Blocks before this have been pruned from the undo log
+        self.undo_from = 0
+        self.last_block = 0
+        # How many second ago we saved the JSON file
+        self.last_save = 0
+
+    def reset(self):
+        self.balances = defaultdict(dict)
+        self.undo_log = {}
+        self.undo_from = 0
+        self.last_block = 0
+        if self.snapshots:
+            self.snapshots.reset()
+
+    def restore(self):
+        """Restore the ledger from a file."""
+        if self.snapshots:
+            self.snapshots.restore()
+        try:
+            data = json.load(open(self.fname, "rt"))
+        except (IOError, TypeError, json.decoder.JSONDecodeError):
+            self.balances = defaultdict(dict)
+            self.undo_log = {}
+            self.undo_from = 0
+            self.last_block = 0
+            return
+        # uint256 amounts are kept as strings, JSON keys are always strings
+        self.balances = defaultdict(dict, {
+            pool: {address: int(balance) for address, balance in balances.items()}
+            for pool, balances in data["balances"].items()})
+        undo_log = {int(block_num): [(pool, address, int(delta)) for pool, address, delta in changes]
+                    for block_num, changes in data["undo_log"].items()}
+        self.undo_log = dict(sorted(undo_log.items()))
+        self.undo_from = data["undo_from"]
+        self.last_block = data["last_block"]
+
+    def save(self):
+        """Save the ledger in a file, atomically."""
+        tmp_fname = self.fname + ".tmp"
+        with open(tmp_fname, "wt") as f:
+            json.dump({
+                "last_block": self.last_block,
+                "undo_from": self.undo_from,
+                "balances": {pool: {address: str(balance) for address, balance in balances.items()}
+                             for pool, balances in self.balances.items()},
+                "undo_log": {block_num: [(pool, address, str(delta)) for pool, address, delta in changes]
+                             for block_num, changes in self.undo_log.items()},
+            }, f)
+        os.replace(tmp_fname, self.fname)
+        if self.snapshots:
+            self.snapshots.save()
+        self.last_save = time.time()
+
+    def change(self, block_number: int, pool: str, address: str, delta: int):
+        """Add delta to a balance and remember how to undo it."""
+        balances = self.balances[pool]
+        balance = balances.get(address, 0) + delta
+        if balance:
+            balances[address] = balance
+        else:
+            # Keep only holders in the balance vector
+            balances.pop(address, None)
+
+        if block_number not in self.undo_log:
+            newest = next(reversed(self.undo_log), None)
+            self.undo_log[block_number] = []
+            if newest is not None and block_number < newest:
+                # An event older than the newest block, e.g. from a per event type query,
+                # keep the undo log in increasing block order for the walks from its ends
+                self.undo_log = dict(sorted(self.undo_log.items()))
+            self.prune(block_number - self.undo_depth)
+        self.undo_log[block_number].append((pool, address, delta))
+        if self.snapshots:
+            self.snapshots.record(block_number, pool, address, delta)
+
+    def apply_record(self, block_number: int, pool: str, record: dict):
+        """Apply an event in the internal format of JSONifiedState."""
+        event_name = record["event"]
+        if event_name == "Staked":
+            self.change(block_number, pool, record["address"], int(record["amount"]))
+        elif event_name == "Unstaked":
+            self.change(block_number, pool, record["address"], -int(record["amount"]))
+        elif event_name == "Transfer":
+            self.change(block_number, pool, record["from"], -int(record["value"]))
+            self.change(block_number, pool, record["to"], int(record["value"]))
+
+    def apply_event(self, event: AttributeDict):
+        """Apply a raw Web3 event."""
+        args = event["args"]
+        event_name = event["event"]
+        if event_name == "Staked":
+            record = {"event": event_name, "address": args["_from"], "amount": args["amount"]}
+        elif event_name == "Unstaked":
+            record = {"event": event_name, "address": args["_to"], "amount": args["amount"]}
+        elif event_name == "Transfer":
+            record = {"event": event_name, "from": args["from"], "to": args["to"], "value": args["value"]}
+        else:
+            return
+        pool = self.pool_labels.get(event["address"], event["address"])
+        self.apply_record(event["blockNumber"], pool, record)
+
+    def end_block(self, block_number: int):
+        """All events up to this block have been applied."""
+        self.last_block = block_number
+        if self.snapshots:
+            self.snapshots.end_block(block_number, self.balances)
+
+    def revert_since(self, since_block: int) -> int:
+        """Undo all changes of the blocks since this block.
+
+        Costs only the number of reverted changes.
+
+        :return: Number of reverted balance changes
+        :raise ValueError: If the blocks are older than our undo log reaches
+        """
+        if since_block < self.undo_from:
+            raise ValueError(f"Cannot revert to block {since_block}, undo log starts at block {self.undo_from}")
+
+        reverted = 0
+        # Blocks are in increasing order in the undo log, walk it from the end
+        while self.undo_log:
+            block_num = next(reversed(self.undo_log))
+            if block_num < since_block:
+                break
+            for pool, address, delta in reversed(self.undo_log.pop(block_num)):
+                balances = self.balances[pool]
+                balance = balances.get(address, 0) - delta
+                if balance:
+                    balances[address] = balance
+                else:
+                    balances.pop(address, None)
+                reverted += 1
+        self.last_block = min(self.last_block, since_block - 1)
+        if self.snapshots:
+            self.snapshots.revert_since(since_block)
+        return reverted
+
+    def prune(self, before_block: int):
+        """Forget undo information of blocks that are final."""
+        if before_block <= self.undo_from:
+            return
+        while self.undo_log:
+            block_num = next(iter(self.undo_log))
+            if block_num >= before_block:
+                break
+            del self.undo_log[block_num]
+        self.undo_from = before_block
+
+    def get_balances(self, pool: Optional[str] = None) -> List[int]:
+        """The balance vector of all holders, for Lorenz/Gini.
+
+        :param pool: Only this pool, all pools summed by address by default
+        """
+        return balance_vector(self.balances, pool)
+
+    def rebuild(self, blocks: dict, pool: Optional[str] = None):
+        """Replay the whole event history stored by JSONifiedState.
+
+        Only needed when the ledger file is missing or out of sync with the state.
+        """
+        self.reset()
+        pool = pool or self.default_pool
+        # JSON keys are always strings
+        for block_num in sorted(blocks, key=int):
+            for txhash, events in blocks[block_num].items():
+                for log_index in sorted(events, key=int):
+                    self.apply_record(int(block_num), pool, events[log_index])
+            self.end_block(int(block_num))
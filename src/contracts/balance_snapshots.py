@@ -0,0 +1,228 @@
+"""Checkpointed balance history for historical Gini/Lorenz queries.
+
+The balance ledger only knows the current balances. To get the balances
+at any past block, we store a full balance checkpoint every N blocks (or K balance changes)
+and the balance changes between the checkpoints. A query loads the nearest checkpoint
+and applies only the changes since.
+"""
+
+import bisect
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.utils.project_paths import DATA_PATH
+
+#: pool -> address -> balance
+Balances = Dict[str, Dict[str, int]]
+
+#: (block number, pool, address, delta)
+Change = Tuple[int, str, str, int]
+
+
+def balance_vector(balances: Balances, pool: Optional[str] = None) -> List[int]:
+    """The balance vector of all holders, for Lorenz/Gini.
+
+    :param pool: Only this pool, all pools summed by address by default
+    """
+    if pool is not None:
+        return [balance for balance in balances.get(pool, {}).values() if balance > 0]
+
+    totals = {}
+    for pool_balances in balances.values():
+        for address, balance in pool_balances.items():
+            totals[address] = totals.get(address, 0) + balance
+    return [balance for balance in totals.values() if balance > 0]
+
+
+def _apply(balances: Balances, pool: str, address: str, delta: int):
+    pool_balances = balances.setdefault(pool, {})
+    balance = pool_balances.get(address, 0) + delta
+    if balance:
+        pool_balances[address] = balance
+    else:
+        pool_balances.pop(address, None)
+
+
+class BalanceSnapshotIndex:
+    """Balance checkpoints plus the balance changes between them, stored in a directory.
+
+    `checkpoint-<block>.json` holds all balances after the block, and
+    `changes-<block>.json` the changes after that checkpoint until the next one.
+    Changes after the newest checkpoint are kept in memory until the next checkpoint
+    or `save()`.
+    """
+
+    def __init__(self, path: Optional[str] = None, every_blocks: int = 50000, every_changes: int = 20000):
+        """
+        :param path: Directory of the checkpoint files
+        :param every_blocks: Take a checkpoint at least every this many blocks
+        :param every_changes: Take a checkpoint at least every this many balance changes
+        """
+        self.path = path or os.path.join(DATA_PATH, "balance snapshots")
+        self.every_blocks = every_blocks
+        self.every_changes = every_changes
+        # Block numbers of the checkpoints, increasing. Block 0 is the empty genesis checkpoint.
+        self.checkpoints: List[int] = [0]
+        # Changes after the newest checkpoint
+        self.changes: List[Change] = []
+
+    def checkpoint_fname(self, block_number: int) -> str:
+        return os.path.join(self.path, f"checkpoint-{block_number}.json")
+
+    def changes_fname(self, block_number: int) -> str:
+        return os.path.join(self.path, f"changes-{block_number}.json")
+
+    @property
+    def manifest_fname(self):
+        return os.path.join(self.path, "manifest.json")
+
+    def reset(self):
+        self.checkpoints = [0]
+        self.changes = []
+
+    def restore(self):
+        """Restore the list of checkpoints and the changes after the newest one."""
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            manifest = json.load(open(self.manifest_fname, "rt"))
+            self.checkpoints = manifest["checkpoints"]
+        except (IOError, json.decoder.JSONDecodeError):
+            self.reset()
+            return
+        self.changes = self.read_changes_file(self.checkpoints[-1])
+
+    def save(self):
+        """Write the changes after the newest checkpoint, and the manifest."""
+        os.makedirs(self.path, exist_ok=True)
+        self.write_json(self.changes_fname(self.checkpoints[-1]), _encode_changes(self.changes))
+        self.write_json(self.manifest_fname, {"checkpoints": self.checkpoints})
+
+    @staticmethod
+    def write_json(fname: str, data):
+        tmp_fname = fname + ".tmp"
+        with open(tmp_fname, "wt") as f:
+            json.dump(data, f)
+        os.replace(tmp_fname, fname)
+
+    def load_checkpoint(self, block_number: int) -> Balances:
+        if block_number == 0:
+            return {}
+        data = json.load(open(self.checkpoint_fname(block_number), "rt"))
+        # uint256 amounts are kept as strings
+        return {pool: {address: int(balance) for address, balance in balances.items()}
+                for pool, balances in data.items()}
+
+    def load_changes(self, block_number: int) -> List[Change]:
+        """Changes after a checkpoint, until the next checkpoint."""
+        if block_number == self.checkpoints[-1]:
+            return self.changes
+        return self.read_changes_file(block_number)
+
+    def read_changes_file(self, block_number: int) -> List[Change]:
+        try:
+            data = json.load(open(self.changes_fname(block_number), "rt"))
+        except IOError:
+            return []
+        return [(block_num, pool, address, int(delta)) for block_num, pool, address, delta in data]
+
+    #
+    # Feeding from the balance ledger
+    #
+
+    def record(self, block_number: int, pool: str, address: str, delta: int):
+        """A balance changed.
+
+        The changes are kept in increasing block order, even if older blocks are recorded after newer ones.
+        """
+        pos = len(self.changes)
+        while pos and self.changes[pos - 1][0] > block_number:
+            pos -= 1
+        self.changes.insert(pos, (block_number, pool, address, delta))
+
+    def end_block(self, block_number: int, balances: Balances):
+        """All changes up to this block have been recorded, take a checkpoint if it is time.
+
+        :param balances: Current balances, copied to the checkpoint
+        """
+        if not self.changes:
+            return
+        if block_number - self.checkpoints[-1] < self.every_blocks and len(self.changes) < self.every_changes:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        self.write_json(self.changes_fname(self.checkpoints[-1]), _encode_changes(self.changes))
+        self.write_json(self.checkpoint_fname(block_number),
+                        {pool: {address: str(balance) for address, balance in pool_balances.items()}
+                         for pool, pool_balances in balances.items()})
+        self.checkpoints.append(block_number)
+        self.changes = []
+        self.write_json(self.manifest_fname, {"checkpoints": self.checkpoints})
+
+    def revert_since(self, since_block: int):
+        """Forget everything since this block, after a chain reorganisation.
+
+        The manifest is written before the dropped checkpoint files are removed,
+        so it never points to a missing checkpoint.
+        """
+        dropped = []
+        while len(self.checkpoints) > 1 and self.checkpoints[-1] >= since_block:
+            dropped.append(self.checkpoints.pop())
+        if dropped:
+            self.changes = self.read_changes_file(self.checkpoints[-1])
+        self.changes = [change for change in self.changes if change[0] < since_block]
+        if dropped:
+            # The reverted changes go from the disk too, the same as `save()`
+            self.save()
+            for block_number in dropped:
+                for fname in (self.checkpoint_fname(block_number), self.changes_fname(block_number)):
+                    if os.path.exists(fname):
+                        os.remove(fname)
+
+    #
+    # Queries
+    #
+
+    def balances_at(self, block_number: int) -> Balances:
+        """All balances after a block."""
+        return next(iter(self.iter_balances_at([block_number])))[1]
+
+    def iter_balances_at(self, block_numbers: Iterable[int]) -> Iterable[Tuple[int, Balances]]:
+        """Balances after many blocks, in increasing block order.
+
+        Only the checkpoint nearest to the first block is loaded, and
+        the rest is reached by applying the changes forward, so the cost is
+        one checkpoint plus the changes between the first and the last block.
+        The same balances dict is updated in place between the yields,
+        copy it if you need to keep it.
+
+        :return: Iterator of (block number, balances)
+        """
+        block_numbers = sorted(block_numbers)
+        if not block_numbers:
+            return
+
+        pos = bisect.bisect_right(self.checkpoints, block_numbers[0]) - 1
+        balances = self.load_checkpoint(self.checkpoints[pos])
+        changes = self.load_changes(self.checkpoints[pos])
+        change_pos = 0
+
+        for block_number in block_numbers:
+            while True:
+                while change_pos < len(changes) and changes[change_pos][0] <= block_number:
+                    _, pool, address, delta = changes[change_pos]
+                    _apply(balances, pool, address, delta)
+                    change_pos += 1
+                if change_pos < len(changes) or pos + 1 >= len(self.checkpoints) \
+                        or self.checkpoints[pos + 1] > block_number:
+                    break
+                # Continue with the changes after the next checkpoint
+                pos += 1
+                changes = self.load_changes(self.checkpoints[pos])
+                change_pos = 0
+            yield block_number, balances
+
+
+def _encode_changes(changes: List[Change]) -> list:
+    # uint256 amounts are kept as strings
+    return [(block_num, pool, address, str(delta)) for block_num, pool, address, delta in changes]
@@ -0,0 +1,149 @@
+"""JSON-RPC batch transport for point lookups.
+
+Web3.py sends one HTTP request per call. For point lookups like
+`eth_getBlockByNumber` over every block that has events in a chunk,
+the round-trip latency dominates, so here we pack many calls
+into a single JSON-RPC batch array.
+"""
+
+import datetime
+import itertools
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+import requests
+from web3 import Web3
+
+from src.contracts.scan_metrics import MetricsSink, NullMetrics, error_kind
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRPCTransport:
+    """Send JSON-RPC calls to a HTTP node, packing point lookups in batch arrays.
+
+    If a batch fails as a whole (e.g. the node does not support batching),
+    or some items in the batch return an error, the failed items are
+    retried one by one with plain JSON-RPC requests.
+    """
+
+    def __init__(self, endpoint_uri: str, max_batch_size: int = 100, timeout: float = 30.0,
+                 session: Optional[requests.Session] = None, metrics: Optional[MetricsSink] = None):
+        """
+        :param endpoint_uri: HTTP(S) URL of the JSON-RPC node
+        :param max_batch_size: Maximum number of calls in a single batch array
+        :param timeout: HTTP request timeout in seconds
+        :param session: Optional requests session, so connections are kept alive between calls
+        :param metrics: Where the latency, the errors and the bytes of every HTTP request are reported
+        """
+        assert max_batch_size >= 1
+        self.endpoint_uri = endpoint_uri
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.metrics = metrics or NullMetrics()
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def from_web3(cls, w3: Web3, **kwargs) -> "BatchRPCTransport":
+        """Create a transport talking to the same node as a Web3 HTTPProvider."""
+        return cls(w3.provider.endpoint_uri, **kwargs)
+
+    def _post(self, payload):
+        if isinstance(payload, list):
+            method = payload[0]["method"]
+            self.metrics.observe("rpc_batch_size", len(payload), method=method)
+        else:
+            method = payload["method"]
+        self.metrics.inc("rpc_requests_total", method=method)
+        started = time.perf_counter()
+        try:
+            response = self.session.post(self.endpoint_uri, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            self.metrics.inc("rpc_errors_total", method=method, kind=error_kind(e))
+            raise
+        finally:
+            self.metrics.observe("rpc_request_seconds", time.perf_counter() - started, method=method)
+        self.metrics.inc("rpc_request_bytes_total", len(response.request.body or b""), method=method)
+        self.metrics.inc("rpc_response_bytes_total", len(response.content), method=method)
+        return response.json()
+
+    def request(self, method: str, params: list):
+        """Do a single JSON-RPC call.
+
+        :raise ValueError: If the node returns a JSON-RPC error, as Web3 does
+        """
+        reply = self._post({"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params})
+        if "error" in reply:
+            self.metrics.inc("rpc_errors_total", method=method, kind=error_kind(ValueError(reply["error"])))
+            raise ValueError(reply["error"])
+        return reply["result"]
+
+    def batch_request(self, method: str, params_list: List[list]) -> list:
+        """Call the same method with many different params.
+
+        :return: Results in the same order as `params_list`
+        """
+        results = []
+        for offset in range(0, len(params_list), self.max_batch_size):
+            results.extend(self._batch_request_slice(method, params_list[offset:offset + self.max_batch_size]))
+        return results
+
+    def _batch_request_slice(self, method: str, params_list: List[list]) -> list:
+        ids = [next(self._ids) for _ in params_list]
+        payload = [{"jsonrpc": "2.0", "id": id_, "method": method, "params": params}
+                   for id_, params in zip(ids, params_list)]
+
+        replies_by_id = {}
+        try:
+            replies = self._post(payload)
+            if isinstance(replies, list):
+                replies_by_id = {reply.get("id"): reply for reply in replies}
+            else:
+                # Some nodes answer a batch with a single error object
+                logger.warning("Batch %s call returned %s, falling back to single requests", method, replies)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("Batch %s call of %d items failed with %s, falling back to single requests",
+                           method, len(params_list), e)
+
+        results = []
+        for id_, params in zip(ids, params_list):
+            reply = replies_by_id.get(id_)
+            if reply is not None and "error" not in reply:
+                results.append(reply.get("result"))
+            else:
+                # Partial failure, redo this item alone
+                results.append(self.request(method, params))
+        return results
+
+    #
+    # Point lookups we need in the scanners
+    #
+
+    def block_number(self) -> int:
+        """The number of the most recent block."""
+        return int(self.request("eth_blockNumber", []), 16)
+
+    def get_blocks(self, block_nums: Iterable[int]) -> Dict[int, Optional[dict]]:
+        """Get block headers without transactions.
+
+        :return: Map of block number -> raw block, or None if the block is not mined yet
+        """
+        block_nums = sorted(set(block_nums))
+        blocks = self.batch_request("eth_getBlockByNumber", [[hex(num), False] for num in block_nums])
+        return dict(zip(block_nums, blocks))
+
+    def get_block_timestamps(self, block_nums: Iterable[int]) -> Dict[int, Optional[datetime.datetime]]:
+        """Get when blocks were mined.
+
+        :return: Map of block number -> UTC time, or None if the block is not mined yet
+        """
+        timestamps = {}
+        for block_num, block in self.get_blocks(block_nums).items():
+            if block is None:
+                timestamps[block_num] = None
+            else:
+                timestamps[block_num] = datetime.datetime.utcfromtimestamp(int(block["timestamp"], 16))
+        return timestamps
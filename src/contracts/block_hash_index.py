@@ -0,0 +1,186 @@
+"""Persistent block number -> block hash index of the scanned blocks.
+
+A block hash commits to the whole chain before the block, so if the hash we stored
+for a block is still the hash the node has, nothing up to that block was reorganised.
+Comparing a few stored hashes with the chain tells exactly where a reorganisation
+forked off, and only the blocks after it have to be rolled back and scanned again.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from hexbytes import HexBytes
+
+from src.utils.project_paths import DATA_PATH
+
+logger = logging.getLogger(__name__)
+
+#: Function that fetches the current hashes of blocks from the chain,
+#: returning None for blocks that do not exist (any more)
+HashFetcher = Callable[[List[int]], Dict[int, Optional[str]]]
+
+
+def normalise_hash(block_hash) -> str:
+    """Lowercase 0x-prefixed hex string of a block hash given as bytes or hex."""
+    return "0x" + bytes(HexBytes(block_hash)).hex()
+
+
+class BlockHashIndex:
+    """Hashes of the scanned blocks with events, plus the last block of every chunk as an anchor.
+
+    The newest stored block still on the chain is found with a galloping search
+    from the newest stored block back, then bisection: one hash check when
+    nothing changed, O(log depth) checks after a reorganisation.
+    Hashes older than `keep_depth` blocks are thinned to one per `anchor_interval` blocks,
+    as such old blocks are final.
+    """
+
+    def __init__(self, fname: Optional[str] = None, keep_depth: int = 1000, anchor_interval: int = 1000):
+        """
+        :param fname: JSON file where the index is stored
+        :param keep_depth: How many of the latest blocks keep all their hashes
+        :param anchor_interval: Spacing of the hashes kept for older blocks
+        """
+        self.fname = fname or os.path.join(DATA_PATH, "block_hashes.json")
+        self.keep_depth = keep_depth
+        self.anchor_interval = anchor_interval
+        # block number -> 0x hex hash
+        self.hashes: Dict[int, str] = {}
+        # Sorted block numbers of self.hashes, for bisecting
+        self.blocks: List[int] = []
+        # How many second ago we saved the JSON file
+        self.last_save = 0
+        self.dirty = False
+        # The index may be shared by parallel scan workers
+        self.lock = threading.RLock()
+
+    def restore(self):
+        """Restore the index from a file."""
+        try:
+            data = json.load(open(self.fname, "rt"))
+            # JSON keys are always strings
+            self.hashes = {int(block_num): block_hash for block_num, block_hash in data["hashes"].items()}
+            logger.info("Restored %d block hashes", len(self.hashes))
+        except (IOError, json.decoder.JSONDecodeError, KeyError):
+            logger.info("Block hash index starting from scratch")
+            self.hashes = {}
+        self.blocks = sorted(self.hashes)
+        self.dirty = False
+
+    def save(self):
+        """Save the index in a file, thinning out the hashes of old blocks first.
+
+        Written to a temporary file first, so a crash cannot leave a half-written index behind.
+        """
+        with self.lock:
+            self.prune()
+            tmp_fname = self.fname + ".tmp"
+            with open(tmp_fname, "wt") as f:
+                json.dump({"hashes": self.hashes}, f)
+            os.replace(tmp_fname, self.fname)
+            self.last_save = time.time()
+            self.dirty = False
+
+    @property
+    def last_block(self) -> int:
+        """The newest block we have a hash of, 0 if none."""
+        return self.blocks[-1] if self.blocks else 0
+
+    def add(self, block_num: int, block_hash):
+        with self.lock:
+            if block_num not in self.hashes:
+                bisect.insort(self.blocks, block_num)
+            self.hashes[block_num] = normalise_hash(block_hash)
+            self.dirty = True
+
+    def record(self, hashes: Dict[int, object]):
+        """Remember the hashes of scanned blocks."""
+        for block_num, block_hash in hashes.items():
+            if block_hash is not None:
+                self.add(block_num, block_hash)
+
+        # Save the index file every minute
+        with self.lock:
+            if self.dirty and time.time() - self.last_save > 60:
+                self.save()
+
+    def delete_since(self, since_block: int) -> int:
+        """Forget the hashes of the blocks since this block.
+
+        :return: Number of hashes deleted
+        """
+        with self.lock:
+            pos = bisect.bisect_left(self.blocks, since_block)
+            for block_num in self.blocks[pos:]:
+                del self.hashes[block_num]
+            deleted = len(self.blocks) - pos
+            del self.blocks[pos:]
+            self.dirty = self.dirty or bool(deleted)
+            return deleted
+
+    def prune(self):
+        """Keep only the newest hash of every `anchor_interval` blocks older than `keep_depth`."""
+        with self.lock:
+            end = bisect.bisect_left(self.blocks, self.last_block - self.keep_depth)
+            kept = []
+            for i, block_num in enumerate(self.blocks[:end]):
+                next_block = self.blocks[i + 1]
+                if next_block // self.anchor_interval != block_num // self.anchor_interval:
+                    kept.append(block_num)
+                else:
+                    del self.hashes[block_num]
+            self.blocks[:end] = kept
+
+    def find_verified_block(self, fetch: HashFetcher, up_to: Optional[int] = None) -> Optional[int]:
+        """The newest stored block whose hash still matches the chain.
+
+        :param fetch: Gets the current hashes of blocks from the node
+        :param up_to: Only consider the blocks up to this one, e.g. the last committed block
+        :return: Block number, or None if no stored hash matches the chain
+        """
+        with self.lock:
+            blocks = self.blocks[:bisect.bisect_right(self.blocks, up_to)] if up_to is not None else list(self.blocks)
+            hashes = {block_num: self.hashes[block_num] for block_num in blocks}
+
+        def _matches(i: int) -> bool:
+            block_num = blocks[i]
+            current = fetch([block_num]).get(block_num)
+            return current is not None and normalise_hash(current) == hashes[block_num]
+
+        if not blocks:
+            return None
+        bad = len(blocks) - 1
+        if _matches(bad):
+            return blocks[bad]
+
+        # Gallop back until a stored hash matches, doubling the step
+        step = 1
+        while True:
+            i = max(bad - step, 0)
+            if _matches(i):
+                good = i
+                break
+            if i == 0:
+                return None
+            bad = i
+            step *= 2
+
+        # The newest match is between good and bad
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            if _matches(middle):
+                good = middle
+            else:
+                bad = middle
+        return blocks[good]
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __iter__(self) -> Iterable[int]:
+        return iter(self.blocks)
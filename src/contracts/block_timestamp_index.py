@@ -0,0 +1,202 @@
+"""Persistent block number -> timestamp index.
+
+Block timestamps never change once a block is final, so there is no reason
+to ask them from the JSON-RPC node more than once. The index keeps the
+timestamps we have seen on the disk, and can estimate the timestamps
+of blocks in between by interpolating between the known anchor blocks.
+"""
+
+import bisect
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.utils.project_paths import DATA_PATH
+
+logger = logging.getLogger(__name__)
+
+#: Function that fetches exact timestamps of blocks from the chain,
+#: returning None for blocks that are not mined yet
+TimestampFetcher = Callable[[List[int]], Dict[int, Optional[datetime.datetime]]]
+
+
+class BlockTimestampIndex:
+    """Block timestamps remembered across runs.
+
+    Exact timestamps we have fetched are stored as anchors.
+    In the estimated mode, a timestamp of a block between two anchors is linearly
+    interpolated without any RPC call. Because block timestamps are strictly increasing,
+    by at least one second per block, we can also tell how far off the estimate can be.
+    """
+
+    def __init__(self, fname: Optional[str] = None, anchor_interval: int = 1000):
+        """
+        :param fname: JSON file where the index is stored
+        :param anchor_interval: Spacing of the sparse anchor blocks added by `add_anchors`
+        """
+        self.fname = fname or os.path.join(DATA_PATH, "block_timestamps.json")
+        self.anchor_interval = anchor_interval
+        # block number -> unix timestamp
+        self.timestamps: Dict[int, int] = {}
+        # Sorted block numbers of self.timestamps, for bisecting
+        self.blocks: List[int] = []
+        # How many second ago we saved the JSON file
+        self.last_save = 0
+        self.dirty = False
+        # The index may be shared by parallel scan workers
+        self.lock = threading.RLock()
+
+    def restore(self):
+        """Restore the index from a file."""
+        try:
+            data = json.load(open(self.fname, "rt"))
+            # JSON keys are always strings
+            self.timestamps = {int(block_num): ts for block_num, ts in data["timestamps"].items()}
+            logger.info("Restored %d block timestamps", len(self.timestamps))
+        except (IOError, json.decoder.JSONDecodeError, KeyError):
+            logger.info("Block timestamp index starting from scratch")
+            self.timestamps = {}
+        self.blocks = sorted(self.timestamps)
+        self.dirty = False
+
+    def save(self):
+        """Save the index in a file.
+
+        Written to a temporary file first, so a crash cannot leave a half-written index behind.
+        """
+        with self.lock:
+            tmp_fname = self.fname + ".tmp"
+            with open(tmp_fname, "wt") as f:
+                json.dump({"timestamps": self.timestamps}, f)
+            os.replace(tmp_fname, self.fname)
+            self.last_save = time.time()
+            self.dirty = False
+
+    def add(self, block_num: int, when: datetime.datetime):
+        """Record an exact timestamp of a block."""
+        ts = int(when.replace(tzinfo=datetime.timezone.utc).timestamp())
+        with self.lock:
+            if block_num not in self.timestamps:
+                bisect.insort(self.blocks, block_num)
+            self.timestamps[block_num] = ts
+            self.dirty = True
+
+    def get_exact(self, block_num: int) -> Optional[datetime.datetime]:
+        """Timestamp of a block if we have it stored, otherwise None."""
+        ts = self.timestamps.get(block_num)
+        if ts is None:
+            return None
+        return datetime.datetime.utcfromtimestamp(ts)
+
+    def estimate(self, block_num: int) -> Tuple[Optional[datetime.datetime], Optional[float]]:
+        """Interpolate the timestamp of a block between the closest anchors.
+
+        :return: tuple(estimated time, maximum error in seconds),
+            or (None, None) if the block is not between two known anchors
+        """
+        ts = self.timestamps.get(block_num)
+        if ts is not None:
+            return datetime.datetime.utcfromtimestamp(ts), 0.0
+
+        pos = bisect.bisect_left(self.blocks, block_num)
+        if pos == 0 or pos == len(self.blocks):
+            # We do not extrapolate, as the block time is not stable over long periods
+            return None, None
+
+        lo_block, hi_block = self.blocks[pos - 1], self.blocks[pos]
+        lo_ts, hi_ts = self.timestamps[lo_block], self.timestamps[hi_block]
+        estimated = lo_ts + (hi_ts - lo_ts) * (block_num - lo_block) / (hi_block - lo_block)
+
+        # Each block is at least one second later than its parent
+        earliest = lo_ts + (block_num - lo_block)
+        latest = hi_ts - (hi_block - block_num)
+        error = max(estimated - earliest, latest - estimated, 0.0)
+        return datetime.datetime.utcfromtimestamp(estimated), error
+
+    def resolve(self, block_nums: Iterable[int], fetch: TimestampFetcher, max_error: Optional[float] = None,
+                errors: Optional[Dict[int, float]] = None) -> Dict[int, Optional[datetime.datetime]]:
+        """Get timestamps of many blocks, fetching from the chain only what we cannot answer locally.
+
+        :param block_nums: Blocks we need the timestamps for
+        :param fetch: Function to get the exact timestamps of blocks missing from the index
+        :param max_error: If given, interpolated timestamps off by at most this many seconds are accepted.
+            By default only exact timestamps are returned.
+        :param errors: If given, filled with block number -> maximum error in seconds of the returned timestamps,
+            0 for exact ones
+        :return: Map of block number -> UTC time, or None if the block is not mined yet
+        """
+        result, missing = self.lookup(block_nums, max_error, errors)
+
+        if missing:
+            fetched = fetch(sorted(missing))
+            self.record(fetched)
+            result.update(fetched)
+            if errors is not None:
+                errors.update({block_num: 0.0 for block_num, when in fetched.items() if when is not None})
+
+        return result
+
+    def lookup(self, block_nums: Iterable[int], max_error: Optional[float] = None,
+               errors: Optional[Dict[int, float]] = None) -> Tuple[Dict[int, datetime.datetime], List[int]]:
+        """Answer what we can from the index alone.
+
+        :param max_error: See `resolve`
+        :param errors: If given, filled with block number -> maximum error in seconds of the returned timestamps
+        :return: tuple(map of block number -> UTC time, block numbers we need to fetch)
+        """
+        result = {}
+        missing = []
+        with self.lock:
+            for block_num in set(block_nums):
+                if max_error is None:
+                    when, error = self.get_exact(block_num), 0.0
+                else:
+                    when, error = self.estimate(block_num)
+                    if when is not None and error > max_error:
+                        when = None
+                if when is None:
+                    missing.append(block_num)
+                else:
+                    result[block_num] = when
+                    if errors is not None:
+                        errors[block_num] = error
+        return result, missing
+
+    def record(self, fetched: Dict[int, Optional[datetime.datetime]]):
+        """Remember exact timestamps fetched from the chain."""
+        for block_num, when in fetched.items():
+            # Do not remember blocks that are not mined yet
+            if when is not None:
+                self.add(block_num, when)
+
+        # Save the index file every minute
+        with self.lock:
+            if self.dirty and time.time() - self.last_save > 60:
+                self.save()
+
+    def delete_since(self, since_block: int) -> int:
+        """Forget the timestamps of the blocks since this block, after a chain reorganisation.
+
+        :return: Number of timestamps deleted
+        """
+        with self.lock:
+            pos = bisect.bisect_left(self.blocks, since_block)
+            for block_num in self.blocks[pos:]:
+                del self.timestamps[block_num]
+            deleted = len(self.blocks) - pos
+            del self.blocks[pos:]
+            self.dirty = self.dirty or bool(deleted)
+            return deleted
+
+    def add_anchors(self, start_block: int, end_block: int, fetch: TimestampFetcher):
+        """Make sure there is an anchor every `anchor_interval` blocks in the range.
+
+        After this, estimates for any block in the range are available without RPC calls.
+        """
+        first = start_block - start_block % self.anchor_interval
+        wanted = list(range(first, end_block + self.anchor_interval, self.anchor_interval))
+        self.resolve(wanted, fetch)
@@ -0,0 +1,200 @@
+"""Controllers deciding how many blocks we ask in one `eth_getLogs` call.
+
+The scanner reports how each chunk went, and a controller picks the next chunk size
+and how a failed request is retried.
+"""
+
+import random
+import threading
+from abc import ABC, abstractmethod
+from typing import Iterable, Tuple
+
+
+# Error messages JSON-RPC servers give when the `eth_getLogs` response would be too large.
+# Go Ethereum does not tell, it just fails with a timeout ("context was cancelled" on the server side),
+# so we treat timeouts as too large responses as well.
+RESPONSE_TOO_LARGE_MARKERS = (
+    "query returned more than",  # Infura
+    "response size exceeded",  # Alchemy
+    "log response size",
+    "block range",
+    "range is too large",
+    "range too large",
+    "timed out",
+    "timeout",
+    "context was cancelled",
+    "context canceled",
+)
+
+
+# JSON of a log without its topics and data: address, hashes, numbers and the keys
+LOG_JSON_OVERHEAD = 340
+
+# A 32 byte topic or ABI word as a quoted 0x hex string with its separator
+WORD_JSON_BYTES = 69
+
+
+def estimate_response_bytes(logs: Iterable) -> int:
+    """Size of the `eth_getLogs` JSON response the logs came in.
+
+    Raw logs are measured from their data and topics. Decoded events are counted
+    as one word per argument, exact for the static argument types of our events.
+    """
+    total = 0
+    for log in logs:
+        if "args" in log:
+            total += LOG_JSON_OVERHEAD + WORD_JSON_BYTES * (1 + len(log["args"]))
+        else:
+            data = log.get("data") or b""
+            data_bytes = (len(data) - 2) // 2 if isinstance(data, str) else len(data)
+            total += LOG_JSON_OVERHEAD + WORD_JSON_BYTES * len(log.get("topics") or []) + 2 * data_bytes
+    return total
+
+
+def is_response_too_large(error: Exception) -> bool:
+    """Tell if a failed `eth_getLogs` asked too much, as opposed to a transient error.
+
+    Too large responses must be retried with a smaller block range,
+    transient errors (connection resets, rate limits, node restarts) with the same one.
+    """
+    message = str(error).lower()
+    return any(marker in message for marker in RESPONSE_TOO_LARGE_MARKERS)
+
+
+class ChunkSizeController(ABC):
+    """Decides the block range of the next `eth_getLogs` call."""
+
+    def __init__(self, min_chunk_size: int, max_chunk_size: int):
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+
+    def clamp(self, chunk_size: float) -> int:
+        return int(min(self.max_chunk_size, max(self.min_chunk_size, chunk_size)))
+
+    @abstractmethod
+    def next_chunk_size(self, chunk_size: int, event_count: int, duration: float, response_bytes: int = 0) -> int:
+        """Pick the next chunk size after a successful chunk.
+
+        Controllers may be shared by the worker threads of a parallel scan.
+
+        :param chunk_size: How many blocks the last chunk had
+        :param event_count: How many events the last chunk had
+        :param duration: How many seconds the slowest `eth_getLogs` response of the last chunk took
+        :param response_bytes: How large the `eth_getLogs` responses of the last chunk were,
+            see `estimate_response_bytes`. 0 if not known.
+        """
+
+    @abstractmethod
+    def on_error(self, chunk_size: int, error: Exception, attempt: int) -> Tuple[int, float]:
+        """Decide how to retry a failed request.
+
+        :param chunk_size: How many blocks the failed request had
+        :param error: What went wrong
+        :param attempt: How many times we have retried already, starting from 0
+        :return: tuple(chunk size for the retry, seconds to sleep before it)
+        """
+
+
+class DoublingChunkSizeController(ChunkSizeController):
+    """The original heuristics of the scanner.
+
+    Exponentially increase the chunk size while we do not see events,
+    and fall back to the minimum chunk size as soon as we see any.
+    On any error, halve the block range and sleep a fixed time.
+    """
+
+    def __init__(self, min_chunk_size: int = 2000, max_chunk_size: int = 10000,
+                 chunk_size_increase: float = 2.0, retry_delay: float = 3.0):
+        super().__init__(min_chunk_size, max_chunk_size)
+        self.chunk_size_increase = chunk_size_increase
+        self.retry_delay = retry_delay
+
+    def next_chunk_size(self, chunk_size, event_count, duration, response_bytes=0):
+        if event_count > 0:
+            # When we encounter first events, reset the chunk size window
+            chunk_size = self.min_chunk_size
+        else:
+            chunk_size *= self.chunk_size_increase
+        return self.clamp(chunk_size)
+
+    def on_error(self, chunk_size, error, attempt):
+        # Do not clamp here, we need to be able to go below the minimum chunk size
+        # if the JSON-RPC server cannot serve it
+        return max(1, chunk_size // 2), self.retry_delay
+
+
+class AIMDChunkSizeController(ChunkSizeController):
+    """Additive increase, multiplicative decrease around a target load per response.
+
+    The load of a chunk is how it compares to our budgets: the number of events
+    per response, the response size and the response latency. Over the budget, the chunk size is cut
+    proportionally. Under it, the chunk size grows exponentially until the first
+    overload (slow start, as in TCP congestion control) and additively after that.
+    A chunk well under the budget raises the slow start threshold again,
+    so sparse block ranges after dense ones are crossed quickly.
+
+    Responses that were too large are retried at once with a cut block range,
+    transient errors are retried with the same block range after an exponential backoff with jitter.
+    """
+
+    def __init__(self, min_chunk_size: int = 10, max_chunk_size: int = 10000,
+                 target_events: int = 2000, latency_budget: float = 5.0, target_bytes: int = 8 * 1024 * 1024,
+                 additive_increase: int = 100, decrease_factor: float = 0.5, slow_start_factor: float = 2.0,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0, jitter: float = 0.5):
+        """
+        :param target_events: How many events we want per `eth_getLogs` response
+        :param latency_budget: How many seconds we want a chunk to take
+        :param target_bytes: How large we want the `eth_getLogs` responses of a chunk to be,
+            well under the response size limits of the node providers
+        :param additive_increase: How many blocks we add per chunk after the slow start
+        :param decrease_factor: The largest cut we do to the chunk size at once
+        :param slow_start_factor: How fast the chunk size grows in the slow start
+        :param backoff_base: Delay before the first retry of a transient error
+        :param backoff_max: Maximum delay between retries
+        :param jitter: Fraction of the backoff delay randomised, so parallel workers do not retry in lockstep
+        """
+        super().__init__(min_chunk_size, max_chunk_size)
+        self.target_events = target_events
+        self.latency_budget = latency_budget
+        self.target_bytes = target_bytes
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.slow_start_factor = slow_start_factor
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        # Below this chunk size we grow exponentially
+        self.slow_start_threshold = max_chunk_size
+        # The parallel scan workers report to the same controller
+        self.lock = threading.Lock()
+
+    def next_chunk_size(self, chunk_size, event_count, duration, response_bytes=0):
+        load = max(event_count / self.target_events, response_bytes / self.target_bytes,
+                   duration / self.latency_budget)
+
+        with self.lock:
+            if load > 1:
+                # Cut proportionally to the overload, but at most by decrease_factor
+                chunk_size = chunk_size * max(self.decrease_factor, 1 / load)
+                self.slow_start_threshold = self.clamp(chunk_size)
+            else:
+                if load < 0.25:
+                    self.slow_start_threshold = max(self.slow_start_threshold,
+                                                    self.clamp(chunk_size * self.slow_start_factor))
+                if chunk_size < self.slow_start_threshold:
+                    chunk_size = min(chunk_size * self.slow_start_factor, self.slow_start_threshold)
+                else:
+                    chunk_size += self.additive_increase
+
+        return self.clamp(chunk_size)
+
+    def on_error(self, chunk_size, error, attempt):
+        if is_response_too_large(error):
+            chunk_size = max(1, int(chunk_size * self.decrease_factor))
+            with self.lock:
+                self.slow_start_threshold = self.clamp(chunk_size)
+            return chunk_size, 0.0
+
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay *= random.uniform(1 - self.jitter, 1)
+        return chunk_size, delay
@@ -0,0 +1,332 @@
+"""Columnar event store partitioned by block range.
+
+Every partition covers a fixed range of blocks and keeps each column in its own
+.npy file, so readers can memory-map only the partitions and columns they need
+instead of parsing the whole JSON state.
+"""
+
+import datetime
+import json
+import os
+import shutil
+import time
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from src.contracts.event_scanner_state import EventScannerState
+
+from web3.datastructures import AttributeDict
+
+from src.utils.project_paths import DATA_PATH
+
+
+EVENT_CODES = {"Staked": 0, "Unstaked": 1, "Transfer": 2}
+
+#: Column name -> numpy dtype
+COLUMNS = {
+    "block": np.int64,
+    "log_index": np.int32,
+    # Raw bytes, "S32" would strip the trailing zero bytes of a hash
+    "tx_hash": "V32",
+    "event": np.uint8,
+    # Staked: the staker, Unstaked: the unstaker, Transfer: the receiver
+    "address_id": np.int32,
+    # Transfer: the sender, -1 for other events
+    "from_id": np.int32,
+    # uint256 split in four little-endian 64 bit limbs, shape (n, 4)
+    "amount": np.uint64,
+    # Unix time of the block
+    "timestamp": np.int64,
+}
+
+AMOUNT_LIMBS = 4
+LIMB_MASK = (1 << 64) - 1
+
+
+def _empty_columns(columns: Iterable[str]) -> Dict[str, np.ndarray]:
+    return {name: np.empty((0, AMOUNT_LIMBS) if name == "amount" else (0,), dtype=COLUMNS[name]) for name in columns}
+
+
+def split_amount(amount: int) -> List[int]:
+    """Split an uint256 to 64 bit limbs, least significant first."""
+    return [(amount >> (64 * i)) & LIMB_MASK for i in range(AMOUNT_LIMBS)]
+
+
+def amounts_to_int(limbs: np.ndarray) -> List[int]:
+    """Exact Python integers from an amount column."""
+    return [sum(int(limb) << (64 * i) for i, limb in enumerate(row)) for row in limbs]
+
+
+def amounts_to_float(limbs: np.ndarray) -> np.ndarray:
+    """Approximate float64 amounts from an amount column, vectorised."""
+    scale = np.array([2.0 ** (64 * i) for i in range(AMOUNT_LIMBS)])
+    return limbs.astype(np.float64) @ scale
+
+
+class ColumnarState(EventScannerState):
+    """Store all events in typed column files partitioned by block range.
+
+    Rows of the newest, still open partition are kept in memory and the partition files
+    are rewritten when the partition closes or every minute, so a save costs at most
+    one partition. `last_scanned_block` in the manifest only covers data on the disk.
+    """
+
+    def __init__(self, path: Optional[str] = None, partition_size: int = 100000):
+        """
+        :param path: Directory of the store
+        :param partition_size: How many blocks one partition covers
+        """
+        self.path = path or os.path.join(DATA_PATH, "ILV-Core (with_transfer) columns")
+        self.partition_size = partition_size
+        # Partition start block -> number of rows on the disk
+        self.partitions: Dict[int, int] = {}
+        self.addresses: List[str] = []
+        self.address_ids: Dict[str, int] = {}
+        self.last_scanned_block = 0
+        # Partition start block -> column name -> list of values not yet on the disk
+        self.open_rows: Dict[int, Dict[str, list]] = {}
+        # How many second ago we saved the files
+        self.last_save = 0
+
+    @property
+    def manifest_fname(self):
+        return os.path.join(self.path, "manifest.json")
+
+    @property
+    def addresses_fname(self):
+        return os.path.join(self.path, "addresses.txt")
+
+    def partition_path(self, partition_start: int) -> str:
+        return os.path.join(self.path, f"part-{partition_start:012d}")
+
+    def restore(self):
+        """Restore the manifest and the address dictionary."""
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            manifest = json.load(open(self.manifest_fname, "rt"))
+            # JSON keys are always strings
+            self.partitions = {int(start): rows for start, rows in manifest["partitions"].items()}
+            self.last_scanned_block = manifest["last_scanned_block"]
+            self.partition_size = manifest["partition_size"]
+            address_count = manifest["address_count"]
+            print(f"Restored the state, previously {self.last_scanned_block} blocks have been scanned")
+        except (IOError, json.decoder.JSONDecodeError):
+            print("State starting from scratch")
+            self.partitions = {}
+            self.last_scanned_block = 0
+            address_count = 0
+
+        for partition_start in self.partitions:
+            path = self.partition_path(partition_start)
+            if not os.path.exists(path) and os.path.exists(path + ".old"):
+                # Crashed while swapping in a rewritten partition
+                os.replace(path + ".old", path)
+
+        try:
+            # Addresses appended after the last manifest was written are not referred to by any row
+            self.addresses = open(self.addresses_fname, "rt").read().split()[:address_count]
+        except IOError:
+            self.addresses = []
+        self.address_ids = {address: i for i, address in enumerate(self.addresses)}
+        self.open_rows = {}
+
+    def save(self):
+        """Write the partitions that have rows in memory, then the manifest."""
+        for partition_start, rows in self.open_rows.items():
+            if rows["block"]:
+                self.write_partition(partition_start, rows)
+        self.open_rows = {start: rows for start, rows in self.open_rows.items()
+                          if start + self.partition_size > self.last_scanned_block}
+
+        with open(self.addresses_fname, "wt") as f:
+            f.write("\n".join(self.addresses))
+
+        tmp_fname = self.manifest_fname + ".tmp"
+        with open(tmp_fname, "wt") as f:
+            json.dump({
+                "last_scanned_block": self.last_scanned_block,
+                "partition_size": self.partition_size,
+                "partitions": self.partitions,
+                "address_count": len(self.addresses),
+            }, f)
+        os.replace(tmp_fname, self.manifest_fname)
+        self.last_save = time.time()
+
+    def write_partition(self, partition_start: int, rows: Dict[str, list]):
+        """Rewrite all column files of one partition, from the disk and memory rows together."""
+        columns = self.read_partition(partition_start, COLUMNS.keys(), mmap=False)
+        for name, dtype in COLUMNS.items():
+            new_values = np.array(rows[name], dtype=dtype)
+            if name == "amount":
+                new_values = new_values.reshape(-1, AMOUNT_LIMBS)
+            # Partitions written before tx_hash was "V32" are converted on the way
+            columns[name] = np.concatenate([columns[name].astype(dtype, copy=False), new_values])
+
+        path = self.partition_path(partition_start)
+        tmp_path = path + ".tmp"
+        old_path = path + ".old"
+        # Leftovers of a write that crashed
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+        # Swap the directories. If we crash in between, restore() puts the old partition back
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+        self.partitions[partition_start] = len(columns["block"])
+        for values in rows.values():
+            values.clear()
+
+    def read_partition(self, partition_start: int, columns: Iterable[str], mmap: bool = True) -> Dict[str, np.ndarray]:
+        """Load columns of one partition, memory-mapped by default."""
+        rows = self.partitions.get(partition_start, 0)
+        if not rows:
+            return _empty_columns(columns)
+        result = {}
+        for name in columns:
+            values = np.load(os.path.join(self.partition_path(partition_start), f"{name}.npy"),
+                             mmap_mode="r" if mmap else None)
+            # Rows past the manifest are from a save that did not finish
+            result[name] = values[:rows]
+        return result
+
+    def read(self, columns: Iterable[str], start_block: int = 0, end_block: Optional[int] = None,
+             event: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """Read columns of the events between two blocks, touching only the partitions in the range.
+
+        For example all Staked amounts up to a block::
+
+            state.read(["address_id", "amount"], end_block=block, event="Staked")
+
+        :param columns: Column names to read
+        :param start_block: The first block included
+        :param end_block: The last block included, everything on the disk by default
+        :param event: Only rows of this event type
+        :return: Column name -> values
+        """
+        columns = list(columns)
+        needed = set(columns) | {"block"} | ({"event"} if event else set())
+        parts = []
+        for partition_start in sorted(self.partitions):
+            partition_end = partition_start + self.partition_size - 1
+            if partition_end < start_block or (end_block is not None and partition_start > end_block):
+                continue
+            part = self.read_partition(partition_start, needed)
+            mask = part["block"] >= start_block
+            if end_block is not None:
+                mask &= part["block"] <= end_block
+            if event:
+                mask &= part["event"] == EVENT_CODES[event]
+            parts.append({name: part[name][mask] for name in columns})
+
+        if not parts:
+            return _empty_columns(columns)
+        return {name: np.concatenate([part[name] for part in parts]) for name in columns}
+
+    def get_address_id(self, address: str) -> int:
+        address_id = self.address_ids.get(address)
+        if address_id is None:
+            address_id = len(self.addresses)
+            self.addresses.append(address)
+            self.address_ids[address] = address_id
+        return address_id
+
+    #
+    # EventScannerState methods implemented below
+    #
+
+    def get_last_scanned_block(self):
+        """The number of the last block we have stored."""
+        return self.last_scanned_block
+
+    def delete_data(self, since_block):
+        """Remove potentially reorganised blocks from the scan data."""
+        deleted = 0
+        for rows in self.open_rows.values():
+            keep = [i for i, block_num in enumerate(rows["block"]) if block_num < since_block]
+            deleted += len(rows["block"]) - len(keep)
+            for name, values in rows.items():
+                if name == "amount":
+                    values[:] = [values[i * AMOUNT_LIMBS + limb] for i in keep for limb in range(AMOUNT_LIMBS)]
+                else:
+                    values[:] = [values[i] for i in keep]
+
+        emptied = []
+        for partition_start in sorted(self.partitions):
+            if partition_start + self.partition_size <= since_block:
+                continue
+            part = self.read_partition(partition_start, COLUMNS.keys(), mmap=False)
+            keep = part["block"] < since_block
+            deleted += int((~keep).sum())
+            # Rewritten from the kept rows only
+            del self.partitions[partition_start]
+            if keep.any():
+                rows = {name: values[keep].ravel().tolist() for name, values in part.items()}
+                self.write_partition(partition_start, rows)
+            else:
+                emptied.append(partition_start)
+
+        # Do not leave the manifest pointing to partitions that are gone,
+        # nor resuming past the deleted blocks after a crash before the rescan
+        self.last_scanned_block = min(self.last_scanned_block, since_block - 1)
+        self.save()
+        for partition_start in emptied:
+            if partition_start in self.partitions:
+                # Rows of the partition still in memory were written again by the save
+                continue
+            shutil.rmtree(self.partition_path(partition_start), ignore_errors=True)
+        return deleted
+
+    def start_chunk(self, block_number, chunk_size):
+        pass
+
+    def end_chunk(self, block_number):
+        """Write partitions that are complete, and everything every minute."""
+        self.last_scanned_block = block_number
+
+        closed = any(start + self.partition_size <= block_number and rows["block"]
+                     for start, rows in self.open_rows.items())
+        if closed or time.time() - self.last_save > 60:
+            self.save()
+
+    def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
+        """Record an event as a row of the partition of its block."""
+        log_index = event.logIndex
+        txhash = event.transactionHash.hex()
+        block_number = event.blockNumber
+
+        args = event["args"]
+        event_name = event['event']
+
+        from_id = -1
+        if event_name == "Staked":
+            address = args["_from"]
+            amount = args["amount"]
+        elif event_name == "Unstaked":
+            address = args["_to"]
+            amount = args["amount"]
+        elif event_name == "Transfer":
+            address = args["to"]
+            from_id = self.get_address_id(args["from"])
+            amount = args["value"]
+
+        partition_start = block_number - block_number % self.partition_size
+        if partition_start not in self.open_rows:
+            self.open_rows[partition_start] = {name: [] for name in COLUMNS}
+        rows = self.open_rows[partition_start]
+        rows["block"].append(block_number)
+        rows["log_index"].append(log_index)
+        rows["tx_hash"].append(bytes(event.transactionHash))
+        rows["event"].append(EVENT_CODES[event_name])
+        rows["address_id"].append(self.get_address_id(address))
+        rows["from_id"].append(from_id)
+        rows["amount"].extend(split_amount(amount))
+        rows["timestamp"].append(int(block_when.replace(tzinfo=datetime.timezone.utc).timestamp()))
+
+        # Return a pointer that allows us to look up this event later if needed
+        return f"{block_number}-{txhash}-{log_index}"
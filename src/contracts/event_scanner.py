@@ -5,14 +5,18 @@ where events are added wherever the scanner left off.
 """
 
 import datetime
+import threading
 import time
 import logging
-from typing import Tuple, Optional, Callable, List, Iterable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, Callable, List, Iterable, Union
 
 from web3 import Web3
 from web3.contract import Contract
 from web3.exceptions import BlockNotFound
 from eth_abi.codec import ABICodec
+from eth_utils import event_abi_to_log_topic, encode_hex
 
 # Currently this method is not exposed over official web3 API,
 # but we need it to construct eth_getLogs parameters
@@ -20,6 +24,14 @@ from web3._utils.filters import construct_event_filter_params
 from web3._utils.events import get_event_data
 
 from src.contracts.event_scanner_state import EventScannerState
+from src.contracts.batch_rpc import BatchRPCTransport
+from src.contracts.block_hash_index import BlockHashIndex
+from src.contracts.block_timestamp_index import BlockTimestampIndex
+from src.contracts.chunk_size_controller import (ChunkSizeController, DoublingChunkSizeController,
+                                                 estimate_response_bytes)
+from src.contracts.raw_log_cache import RawLogCache
+from src.contracts.scan_metrics import MetricsSink, NullMetrics, error_kind
+from src.contracts.follow import FollowUpdate, HeadPoller, push_update
 
 
 logger = logging.getLogger(__name__)
@@ -28,7 +40,8 @@ logger = logging.getLogger(__name__)
 class EventScanner:
     """Scan blockchain for events and try not to abuse JSON-RPC API too much.
 
-    Can be used for real-time scans, as it detects minor chain reorganisation and rescans.
+    Can be used for real-time scans, as it detects chain reorganisations and rescans.
+    With a block hash index, only the blocks after the fork are rolled back.
     Unlike the easy web3.contract.Contract, this scanner can scan events from multiple contracts at once.
     For example, you can get all transfers from all tokens in the same scan.
 
@@ -36,8 +49,16 @@ class EventScanner:
     because it cannot correctly throttle and decrease the `eth_getLogs` block number range.
     """
 
+    #: Blocks rescanned on start when we have no block hashes to tell where a reorganisation forked
+    NUM_BLOCKS_RESCAN_FOR_FORKS = 10
+
     def __init__(self, w3: Web3, contract: Contract, state: EventScannerState, events: List, filters,
-                 max_chunk_scan_size: int = 10000, max_request_retries: int = 30, request_retry_seconds: float = 3.0):
+                 max_chunk_scan_size: int = 10000, max_request_retries: int = 30, request_retry_seconds: float = 3.0,
+                 combine_event_queries: bool = False, batch_transport: Optional[BatchRPCTransport] = None,
+                 timestamp_index: Optional[BlockTimestampIndex] = None, timestamp_max_error: Optional[float] = None,
+                 chunk_size_controller: Optional[ChunkSizeController] = None,
+                 log_cache: Optional[RawLogCache] = None, metrics: Optional[MetricsSink] = None,
+                 block_hash_index: Optional[BlockHashIndex] = None):
         """
         :param contract: Contract
         :param events: List of web3 Event we scan
@@ -45,6 +66,22 @@ class EventScanner:
         :param max_chunk_scan_size: JSON-RPC API limit in the number of blocks we query. (Recommendation: 10,000 for mainnet, 500,000 for testnets)
         :param max_request_retries: How many times we try to reattempt a failed JSON-RPC call
         :param request_retry_seconds: Delay between failed requests to let JSON-RPC server to recover
+        :param combine_event_queries: Fetch all event types with a single `eth_getLogs` per chunk,
+            using a topic0 OR-list, instead of one call per event type.
+            Only the address filter can be combined, with event argument filters we query per event type.
+        :param batch_transport: If given, block timestamps and other point lookups are sent as JSON-RPC batches
+        :param timestamp_index: Persistent block timestamp index consulted before asking timestamps from the node
+        :param timestamp_max_error: Accept interpolated timestamps from the index off by at most this many seconds.
+            The default None means only exact timestamps are used.
+        :param chunk_size_controller: Picks the block range of each `eth_getLogs` call and how failed calls are retried.
+            Defaults to `DoublingChunkSizeController`, the original heuristics.
+        :param log_cache: Raw `eth_getLogs` responses are read from and stored to this cache.
+            In its offline mode the scan is replayed from the cache without any node calls,
+            with block timestamps from the timestamp index.
+        :param metrics: Where the scan reports its counters and timings, e.g. `ScanMetrics`.
+            Nothing is recorded by default.
+        :param block_hash_index: Hashes of the scanned blocks are recorded here, so `handle_reorg`
+            can tell where a chain reorganisation forked off
         """
 
         self.logger = logger
@@ -53,6 +90,26 @@ class EventScanner:
         self.state = state
         self.events = events
         self.filters = filters
+        unsupported_filters = _uncombinable_filters(filters)
+        if combine_event_queries and unsupported_filters:
+            logger.warning("Event argument filters %s cannot be combined, querying each event type separately",
+                           unsupported_filters)
+            combine_event_queries = False
+        self.combine_event_queries = combine_event_queries
+        self.batch_transport = batch_transport
+        self.timestamp_index = timestamp_index
+        self.timestamp_max_error = timestamp_max_error
+        self.log_cache = log_cache
+        # Set while following the head, when fetched logs skip the log cache
+        self.bypass_log_cache = False
+        self.metrics = metrics or NullMetrics()
+        self.block_hash_index = block_hash_index
+        # Seconds the slowest `eth_getLogs` response of the last fetched chunk took,
+        # the latency the chunk size controller aims at
+        self.last_get_logs_seconds = 0.0
+        # Chunk end block -> block hashes of a fetched chunk, recorded when the chunk is committed
+        self.pending_block_hashes = {}
+        self.pending_block_hashes_lock = threading.Lock()
 
         # Our JSON-RPC throttling parameters
         self.min_scan_chunk_size = 2000  # 12 s/block = 120 seconds period
@@ -67,6 +124,12 @@ class EventScanner:
         # Factor how was we increase chunk size if no results found
         self.chunk_size_increase = 2.0
 
+        self.chunk_size_controller = chunk_size_controller or DoublingChunkSizeController(
+            min_chunk_size=self.min_scan_chunk_size,
+            max_chunk_size=self.max_scan_chunk_size,
+            chunk_size_increase=self.chunk_size_increase,
+            retry_delay=self.request_retry_seconds)
+
     @property
     def address(self):
         return self.token_address
@@ -82,6 +145,124 @@ class EventScanner:
         last_time = block_info["timestamp"]
         return datetime.datetime.utcfromtimestamp(last_time)
 
+    def get_block_timestamps(self, block_nums: Iterable[int], optional: Iterable[int] = ()) -> dict:
+        """Get Ethereum block timestamps for many blocks.
+
+        Timestamps are looked up from the persistent timestamp index first, if we have one.
+        The rest are asked from the node, as a single JSON-RPC batch if we have a batch transport.
+
+        :param optional: Blocks that may be left None when replaying from the log cache, e.g. a chunk end
+        :return: Map of block number -> UTC time, or None if the block is not mined yet
+        """
+        block_nums = set(block_nums)
+        if self.offline:
+            self.metrics.inc("scanner_timestamp_lookups_total", len(block_nums), source="replay")
+            return self._replay_block_timestamps(block_nums, optional)
+        if self.timestamp_index:
+            fetched = []
+
+            def _fetch(missing):
+                fetched.extend(missing)
+                return self._fetch_block_timestamps(missing)
+
+            result = self.timestamp_index.resolve(block_nums, _fetch, self.timestamp_max_error)
+            self.metrics.inc("scanner_timestamp_lookups_total", len(block_nums) - len(fetched), source="index")
+            self.metrics.inc("scanner_timestamp_lookups_total", len(fetched), source="node")
+            return result
+        self.metrics.inc("scanner_timestamp_lookups_total", len(block_nums), source="node")
+        return self._fetch_block_timestamps(block_nums)
+
+    @property
+    def offline(self) -> bool:
+        return bool(self.log_cache and self.log_cache.offline)
+
+    @property
+    def fetch_log_cache(self) -> Optional[RawLogCache]:
+        """The log cache the `eth_getLogs` calls go through, if any."""
+        return None if self.bypass_log_cache else self.log_cache
+
+    def _replay_block_timestamps(self, block_nums: Iterable[int], optional: Iterable[int] = ()) -> dict:
+        """Block timestamps without the node: exact when the index has them, interpolated otherwise.
+
+        Blocks with events have exact timestamps in the index if it was used when the logs were cached.
+        Estimates are not recorded in the index.
+
+        :param optional: Blocks left None if the index cannot place them
+        :raise LookupError: If the index cannot place other blocks between two known blocks
+        """
+        if self.timestamp_index is None:
+            raise LookupError("Replaying from the log cache needs a block timestamp index")
+        result, missing = self.timestamp_index.lookup(block_nums, max_error=float("inf"))
+        unknown = sorted(set(missing) - set(optional))
+        if unknown:
+            raise LookupError(f"Blocks {unknown[:10]} are not in the block timestamp index, "
+                              f"cannot replay them from the log cache")
+        result.update({block_num: None for block_num in missing})
+        return result
+
+    def _fetch_block_timestamps(self, block_nums: Iterable[int]) -> dict:
+        """Ask block timestamps from the node."""
+        if self.batch_transport:
+            return self.batch_transport.get_block_timestamps(block_nums)
+        return {block_num: self.get_block_timestamp(block_num) for block_num in set(block_nums)}
+
+    def get_block_headers(self, block_nums: Iterable[int]) -> dict:
+        """Get the timestamps and the hashes of blocks from the node, as a single batch if we can.
+
+        :return: Map of block number -> tuple(UTC time, block hash), or None if the block is not mined yet
+        """
+        headers = {}
+        if self.batch_transport:
+            for block_num, block in self.batch_transport.get_blocks(block_nums).items():
+                if block is not None:
+                    block = datetime.datetime.utcfromtimestamp(int(block["timestamp"], 16)), block["hash"]
+                headers[block_num] = block
+            return headers
+        for block_num in set(block_nums):
+            try:
+                block = self.w3.eth.getBlock(block_num)
+            except BlockNotFound:
+                headers[block_num] = None
+                continue
+            headers[block_num] = datetime.datetime.utcfromtimestamp(block["timestamp"]), block["hash"]
+        return headers
+
+    def get_block_hashes(self, block_nums: Iterable[int]) -> dict:
+        """Get the current hashes of blocks from the node.
+
+        :return: Map of block number -> block hash, or None if the block is not mined (any more)
+        """
+        return {block_num: header and header[1] for block_num, header in self.get_block_headers(block_nums).items()}
+
+    def _stage_block_hashes(self, end_block: int, hashes: dict):
+        """Keep the block hashes of a fetched chunk until the chunk is committed.
+
+        Recording them earlier could make `handle_reorg` trust blocks the state does not have.
+        """
+        with self.pending_block_hashes_lock:
+            self.pending_block_hashes[end_block] = hashes
+
+    def _commit_chunk(self, start_block: int, end_block: int, event_count: int, started: float):
+        """Let the state persist a finished chunk, record its block hashes, and report the chunk.
+
+        :param started: `time.time()` when the chunk was started
+        """
+        with self.metrics.timer("scanner_commit_seconds"):
+            self.state.end_chunk(end_block)
+        if self.block_hash_index is not None:
+            with self.pending_block_hashes_lock:
+                hashes = self.pending_block_hashes.pop(end_block, {})
+                # Leftovers of failed attempts at earlier chunks
+                for stale_end in [block_num for block_num in self.pending_block_hashes if block_num <= end_block]:
+                    del self.pending_block_hashes[stale_end]
+            self.block_hash_index.record(hashes)
+        self.metrics.inc("scanner_chunks_total")
+        self.metrics.inc("scanner_blocks_total", end_block - start_block + 1)
+        self.metrics.inc("scanner_events_total", event_count)
+        self.metrics.set("scanner_last_block", end_block)
+        self.metrics.observe("scanner_chunk_blocks", end_block - start_block + 1)
+        self.metrics.observe("scanner_chunk_seconds", time.time() - started)
+
     def get_suggested_scan_start_block(self):
         """Get where we should start to scan for new token events.
 
@@ -89,7 +270,7 @@ class EventScanner:
         Otherwise, start from the last end block minus ten blocks.
         We rescan the last ten scanned blocks in the case there were forks to avoid
         misaccounting due to minor single block works (happens once in a hour in Ethereum).
-        These heurestics could be made more robust, but this is for the sake of simple reference implementation.
+        With a block hash index, `handle_reorg` tells exactly where to start instead.
         """
 
         end_block = self.get_last_scanned_block()
@@ -100,46 +281,126 @@ class EventScanner:
     def get_suggested_scan_end_block(self):
         """Get the last mined block on Ethereum chain we are following."""
 
+        if self.offline:
+            # Replay everything we have cached for all our queries
+            return min(self.log_cache.last_block_of(params) for params in self._log_queries())
+
         # Do not scan all the way to the final block, as this
         # block might not be mined yet
-        return self.w3.eth.blockNumber - 1
+        return self.get_head_block() - 1
+
+    def get_head_block(self) -> int:
+        """The number of the latest block the node has."""
+        if self.batch_transport:
+            return self.batch_transport.block_number()
+        return self.w3.eth.blockNumber
 
     def get_last_scanned_block(self) -> int:
         return self.state.get_last_scanned_block()
 
     def delete_potentially_forked_block_data(self, after_block: int):
-        """Purge old data in the case of blockchain reorganisation."""
-        self.state.delete_data(after_block)
+        """Purge old data in the case of blockchain reorganisation.
 
-    def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
-        """Read and process events between to block numbers.
+        Everything we keep about the blocks since `after_block` goes: the events in the state,
+        the block hashes, the block timestamps and the cached raw logs.
+        """
+        self.state.delete_data(after_block)
+        if self.block_hash_index is not None:
+            self.block_hash_index.delete_since(after_block)
+        if self.timestamp_index is not None:
+            self.timestamp_index.delete_since(after_block)
+        if self.log_cache is not None and not self.offline:
+            self.log_cache.delete_since(after_block)
+
+    def handle_reorg(self) -> int:
+        """Find where the scanned data left the chain, and roll back only the blocks after that.
+
+        The stored block hashes are compared with the chain, newest first. Without a
+        reorganisation this is a single hash check of the last scanned chunk end.
+        Without a block hash index, the last `NUM_BLOCKS_RESCAN_FOR_FORKS` blocks are rolled back.
+
+        :return: The first block to scan
+        :raise ValueError: If no stored block hash is on the chain any more, the reorganisation
+            is deeper than the index and the state has to be scanned again from scratch
+        """
+        last_scanned_block = self.get_last_scanned_block()
+        if not last_scanned_block or self.offline:
+            return last_scanned_block + 1
+
+        if self.block_hash_index is None or not self.block_hash_index.blocks:
+            logger.info("No block hashes to verify the scanned blocks against, rescanning the last %d blocks",
+                        self.NUM_BLOCKS_RESCAN_FOR_FORKS)
+            since_block = max(1, last_scanned_block - self.NUM_BLOCKS_RESCAN_FOR_FORKS)
+        else:
+            # Hashes of chunks committed after the state was last saved
+            self.block_hash_index.delete_since(last_scanned_block + 1)
+            verified_block = self.block_hash_index.find_verified_block(self.get_block_hashes, last_scanned_block)
+            if verified_block is None:
+                raise ValueError(f"None of the {len(self.block_hash_index)} stored block hashes is on the chain, "
+                                 f"the reorganisation is deeper than the block hash index")
+            since_block = verified_block + 1
+            if since_block <= last_scanned_block:
+                logger.warning("Chain reorganisation after block %d, rolling back %d blocks",
+                               verified_block, last_scanned_block - verified_block)
+                self.metrics.inc("scanner_reorgs_total")
+                self.metrics.observe("scanner_reorg_blocks", last_scanned_block - verified_block)
+
+        if since_block <= last_scanned_block:
+            self.delete_potentially_forked_block_data(since_block)
+        return since_block
+
+    def _make_event_fetch(self, event_type) -> Callable:
+        """Callable that takes care of the underlying web3 call for a single event type."""
+        def _fetch_events(_start_block, _end_block):
+            return _fetch_events_for_all_contracts(self.w3,
+                                                   event_type,
+                                                   self.filters,
+                                                   from_block=_start_block,
+                                                   to_block=_end_block,
+                                                   log_cache=self.fetch_log_cache)
+        return _fetch_events
+
+    def _make_combined_fetch(self) -> Callable:
+        """Callable that fetches all our event types with one web3 call."""
+        def _fetch_events(_start_block, _end_block):
+            return _fetch_events_for_all_event_types(self.w3,
+                                                     self.events,
+                                                     self.filters,
+                                                     from_block=_start_block,
+                                                     to_block=_end_block,
+                                                     log_cache=self.fetch_log_cache)
+        return _fetch_events
+
+    def _log_queries(self) -> List[dict]:
+        """The `eth_getLogs` parameters of our queries, the block range aside."""
+        if self.combine_event_queries:
+            return [_construct_multi_event_filter_params(_get_abis_by_topic(self.events), self.filters, None, None)]
+        return [construct_event_filter_params(event._get_event_abi(), self.w3.codec,
+                                              address=self.filters.get("address"),
+                                              argument_filters=self.filters)[1]
+                for event in self.events]
+
+    def fetch_chunk(self, start_block, end_block) -> Tuple[int, list, dict]:
+        """Read events between two block numbers without touching the state.
 
         Dynamically decrease the size of the chunk if the case JSON-RPC server pukes out.
 
-        :return: tuple(actual end block number, when this block was mined, processed events)
+        :return: tuple(actual end block number, events sorted by (blockNumber, logIndex),
+            map of block number -> when the block was mined)
         """
 
-        block_timestamps = {}
-        get_block_timestamp = self.get_block_timestamp
-
-        # Cache block timestamps to reduce some RPC overhead
-        # Real solution might include smarter models around block
-        def get_block_when(block_num):
-            if block_num not in block_timestamps:
-                block_timestamps[block_num] = get_block_timestamp(block_num)
-            return block_timestamps[block_num]
+        all_events = []
+        get_logs_seconds = []
+        started = time.perf_counter()
 
-        all_processed = []
-
-        for event_type in self.events:
+        if self.combine_event_queries:
+            # One `eth_getLogs` round-trip for all event types
+            fetches = [self._make_combined_fetch()]
+        else:
+            # One `eth_getLogs` round-trip per event type
+            fetches = [self._make_event_fetch(event_type) for event_type in self.events]
 
-            # Callable that takes care of the underlying web3 call
-            def _fetch_events(_start_block, _end_block):
-                return _fetch_events_for_all_contracts(self.w3,
-                                                       event_type,
-                                                       self.filters,
-                                                       from_block=_start_block,
-                                                       to_block=_end_block)
+        for _fetch_events in fetches:
 
             # Do `n` retries on `eth_getLogs`,
             # throttle down block range if needed
@@ -148,29 +409,95 @@ class EventScanner:
                 start_block=start_block,
                 end_block=end_block,
                 retries=self.max_request_retries,
-                delay=self.request_retry_seconds)
+                controller=self.chunk_size_controller,
+                metrics=self.metrics,
+                durations=get_logs_seconds)
+            all_events += events
+        self.last_get_logs_seconds = max(get_logs_seconds)
+
+        # If a later event type had to throttle down the block range,
+        # the rest of the range is scanned again in the next chunk
+        all_events = [evt for evt in all_events if evt["blockNumber"] <= end_block]
+        # Per event type queries return the events type by type,
+        # the state must see them in chain order as with a combined query
+        all_events.sort(key=lambda evt: (evt["blockNumber"], evt["logIndex"]))
+
+        # Resolve the timestamps of all blocks with events in one go,
+        # as a single JSON-RPC batch if we have a batch transport
+        block_nums = [evt["blockNumber"] for evt in all_events] + [end_block]
+        if self.block_hash_index is not None and not self.offline:
+            # The chunk end is the anchor `handle_reorg` checks first,
+            # its header gives the timestamp too
+            end_header = self.get_block_headers([end_block])[end_block]
+            block_timestamps = self.get_block_timestamps([block_num for block_num in block_nums
+                                                          if block_num != end_block])
+            block_timestamps[end_block] = end_header and end_header[0]
+            hashes = {evt["blockNumber"]: evt["blockHash"] for evt in all_events}
+            if end_header is not None:
+                hashes[end_block] = end_header[1]
+                if self.timestamp_index is not None:
+                    self.timestamp_index.record({end_block: end_header[0]})
+            self._stage_block_hashes(end_block, hashes)
+        else:
+            # Progress only, a replay can do without the timestamp of the chunk end
+            block_timestamps = self.get_block_timestamps(block_nums, optional=[end_block])
+        self.metrics.observe("scanner_fetch_seconds", time.perf_counter() - started)
+        return end_block, all_events, block_timestamps
 
-            for evt in events:
-                idx = evt["logIndex"]  # Integer of the log index position in the block, null when its pending
+    def process_chunk(self, events: list, block_timestamps: dict) -> list:
+        """Feed fetched events to the state.
 
-                # We cannot avoid minor chain reorganisations, but
-                # at least we must avoid blocks that are not mined yet
-                assert idx is not None, "Somehow tried to scan a pending block"
+        :return: Processed events
+        """
+        all_processed = []
+        started = time.perf_counter()
+        for evt in events:
+            idx = evt["logIndex"]  # Integer of the log index position in the block, null when its pending
+
+            # We cannot avoid minor chain reorganisations, but
+            # at least we must avoid blocks that are not mined yet
+            assert idx is not None, "Somehow tried to scan a pending block"
+
+            block_number = evt["blockNumber"]
 
-                block_number = evt["blockNumber"]
+            # Get UTC time when this event happened (block mined timestamp)
+            # from our in-memory cache
+            block_when = block_timestamps[block_number]
+
+            logger.debug("Processing event %s, block:%d", evt["event"], evt["blockNumber"])
+            processed = self.state.process_event(block_when, evt)
+            all_processed.append(processed)
+        self.metrics.observe("scanner_process_seconds", time.perf_counter() - started)
+        return all_processed
+
+    def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
+        """Read and process events between to block numbers.
 
-                # Get UTC time when this event happened (block mined timestamp)
-                # from our in-memory cache
-                block_when = get_block_when(block_number)
+        Dynamically decrease the size of the chunk if the case JSON-RPC server pukes out.
 
-                logger.debug("Processing event %s, block:%d count:%d", evt["event"], evt["blockNumber"])
-                processed = self.state.process_event(block_when, evt)
-                all_processed.append(processed)
+        :return: tuple(actual end block number, when this block was mined, processed events)
+        """
+        end_block, events, block_timestamps = self.fetch_chunk(start_block, end_block)
+        all_processed = self.process_chunk(events, block_timestamps)
+        return end_block, block_timestamps[end_block], all_processed
 
-        end_block_timestamp = get_block_when(end_block)
-        return end_block, end_block_timestamp, all_processed
+    def _fetch_range(self, start_block, end_block) -> List[Tuple[float, int, list, dict]]:
+        """Fetch a whole block range, in several chunks if the JSON-RPC server throttles us down.
 
-    def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int):
+        :return: List of (`time.time()` when the chunk fetch started, *fetch_chunk() result)
+            covering the range without gaps
+        """
+        chunks = []
+        current_block = start_block
+        while current_block <= end_block:
+            started = time.time()
+            chunk = self.fetch_chunk(current_block, end_block)
+            chunks.append((started,) + chunk)
+            current_block = chunk[0] + 1
+        return chunks
+
+    def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int, duration: float = 0.0,
+                                 response_bytes: int = 0):
         """Try to figure out optimal chunk size
 
         Our scanner might need to scan the whole blockchain for all events
@@ -184,20 +511,14 @@ class EventScanner:
         Currently Ethereum JSON-API does not have an API to tell when a first event occurred in a blockchain
         and our heuristics try to accelerate block fetching (chunk size) until we see the first event.
 
-        These heurestics exponentially increase the scan chunk size depending on if we are seeing events or not.
+        The default heuristics exponentially increase the scan chunk size depending on if we are seeing events or not.
         When any transfers are encountered, we are back to scanning only a few blocks at a time.
         It does not make sense to do a full chain scan starting from block 1, doing one JSON-RPC call per 20 blocks.
-        """
-
-        if event_found_count > 0:
-            # When we encounter first events, reset the chunk size window
-            current_chuck_size = self.min_scan_chunk_size
-        else:
-            current_chuck_size *= self.chunk_size_increase
 
-        current_chuck_size = max(self.min_scan_chunk_size, current_chuck_size)
-        current_chuck_size = min(self.max_scan_chunk_size, current_chuck_size)
-        return int(current_chuck_size)
+        The actual decision is made by our chunk size controller.
+        """
+        return self.chunk_size_controller.next_chunk_size(current_chuck_size, event_found_count, duration,
+                                                          response_bytes)
 
     def scan(self, start_block, end_block, start_chunk_size=20, progress_callback=Optional[Callable]) -> Tuple[
         list, int]:
@@ -233,36 +554,198 @@ class EventScanner:
             self.state.start_chunk(current_block, chunk_size)
 
             # Print some diagnostics to logs to try to fiddle with real world JSON-RPC API performance
-            estimated_end_block = current_block + chunk_size
+            # Never past end_block, it may be the head
+            estimated_end_block = min(current_block + chunk_size, end_block)
             logger.debug(
                 "Scanning token transfers for blocks: %d - %d, chunk size %d, last chunk scan took %f, last logs found %d",
                 current_block, estimated_end_block, chunk_size, last_scan_duration, last_logs_found)
 
             start = time.time()
-            actual_end_block, end_block_timestamp, new_entries = self.scan_chunk(current_block, estimated_end_block)
+            actual_end_block, events, block_timestamps = self.fetch_chunk(current_block, estimated_end_block)
+            new_entries = self.process_chunk(events, block_timestamps)
+            end_block_timestamp = block_timestamps[actual_end_block]
 
             # Where does our current chunk scan ends - are we out of chain yet?
             current_end = actual_end_block
 
             last_scan_duration = time.time() - start
+            last_logs_found = len(new_entries)
             all_processed += new_entries
 
             # Print progress bar
             if progress_callback:
                 progress_callback(start_block, end_block, current_block, end_block_timestamp, chunk_size, len(new_entries))
 
-            # Try to guess how many blocks to fetch over `eth_getLogs` API next time
-            chunk_size = self.estimate_next_chunk_size(chunk_size, len(new_entries))
+            # Try to guess how many blocks to fetch over `eth_getLogs` API next time,
+            # based on how many blocks we actually got in this chunk
+            # Latency of the node only, processing the events is our own time
+            chunk_size = self.estimate_next_chunk_size(current_end - current_block + 1, len(new_entries),
+                                                       self.last_get_logs_seconds, estimate_response_bytes(events))
+
+            total_chunks_scanned += 1
+            self._commit_chunk(current_block, current_end, len(new_entries), start)
 
             # Set where the next chunk starts
             current_block = current_end + 1
-            total_chunks_scanned += 1
-            self.state.end_chunk(current_end)
 
         return all_processed, total_chunks_scanned
 
 
-def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int, list]:
+    def scan_parallel(self, start_block, end_block, chunk_size=None, max_workers=4,
+                      progress_callback: Optional[Callable] = None) -> Tuple[list, int]:
+        """Perform a scan with several block ranges fetched at the same time.
+
+        The block range is split to sub-ranges of `chunk_size` blocks that are fetched
+        by a bounded pool of worker threads. The results are still handed to the state
+        strictly in the block order, one sub-range at a time, so `last_scanned_block`
+        never moves past a sub-range that has not been fetched yet.
+        If any sub-range fails, everything before it stays committed and the rest is discarded.
+
+        :param start_block: The first block included in the scan
+
+        :param end_block: The last block included in the scan
+
+        :param chunk_size: How many blocks each worker fetches at a time, defaults to `max_chunk_scan_size`
+
+        :param max_workers: How many JSON-RPC requests we have in flight at the same time
+
+        :param progress_callback: If this is an UI application, update the progress of the scan
+
+        :return: [All processed events, number of chunks used]
+        """
+
+        assert start_block <= end_block
+
+        chunk_size = chunk_size or self.max_scan_chunk_size
+        ranges = deque((first, min(first + chunk_size - 1, end_block))
+                       for first in range(start_block, end_block + 1, chunk_size))
+
+        total_chunks_scanned = 0
+        all_processed = []
+
+        # Do not fetch too far ahead of the ordered commit,
+        # so memory stays bounded if an early sub-range is slow
+        max_pending = max_workers * 2
+        pending = deque()
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            while ranges or pending:
+                while ranges and len(pending) < max_pending:
+                    range_start, range_end = ranges.popleft()
+                    pending.append((range_start, executor.submit(self._fetch_range, range_start, range_end)))
+
+                # Commit in block order
+                range_start, future = pending.popleft()
+                for started, chunk_end, events, block_timestamps in future.result():
+                    self.state.start_chunk(range_start, chunk_end - range_start + 1)
+                    new_entries = self.process_chunk(events, block_timestamps)
+                    all_processed += new_entries
+                    total_chunks_scanned += 1
+                    self._commit_chunk(range_start, chunk_end, len(new_entries), started)
+
+                    if progress_callback:
+                        progress_callback(start_block, end_block, range_start, block_timestamps[chunk_end],
+                                          chunk_end - range_start + 1, len(new_entries))
+                    range_start = chunk_end + 1
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return all_processed, total_chunks_scanned
+
+    def follow(self, on_update: Union[Callable[[FollowUpdate], None], List[Callable], None] = None,
+               start_block: Optional[int] = None, confirmations: int = 1, head_source=None,
+               stop: Optional[threading.Event] = None, max_updates: Optional[int] = None) -> int:
+        """Keep scanning new blocks as they are mined, until stopped.
+
+        The state stays in memory between the updates, only the new blocks are scanned,
+        in a single `eth_getLogs` range unless the node throttles us down.
+        After each batch of new blocks is committed to the state, a `FollowUpdate`
+        is pushed to the consumers, e.g. `LedgerGini` for a live Gini coefficient.
+        A failed scan is logged and resumed from the last committed block on the next head.
+        The new blocks are not stored in the raw log cache.
+        With a block hash index, every update first checks for a chain reorganisation
+        and rescans the blocks after the fork.
+
+        :param on_update: Consumer, or list of consumers, called with every `FollowUpdate`
+
+        :param start_block: The first block to scan, by default the one after the last scanned block
+
+        :param confirmations: How many blocks we stay behind the head, 1 as in `get_suggested_scan_end_block`
+
+        :param head_source: Tells when there is a new head, with `wait_for_new_head(last_head, stop) -> head`.
+            By default `HeadPoller`, polling the head at adaptive intervals.
+
+        :param stop: Set this event, e.g. from another thread, to stop following
+
+        :param max_updates: Stop after this many updates
+
+        :return: Number of updates pushed
+        """
+        if self.offline:
+            raise ValueError("Cannot follow the chain head when replaying from the log cache")
+
+        if on_update is None:
+            consumers = []
+        elif callable(on_update):
+            consumers = [on_update]
+        else:
+            consumers = list(on_update)
+        head_source = head_source or HeadPoller(self.get_head_block, metrics=self.metrics)
+        stop = stop or threading.Event()
+
+        current_block = start_block or self.get_last_scanned_block() + 1
+        # Each update would be a tiny segment file of blocks that may still reorganise,
+        # the raw log cache is for the backfill
+        self.bypass_log_cache = True
+        try:
+            head = 0
+            updates = 0
+            while not stop.is_set() and (max_updates is None or updates < max_updates):
+                head = head_source.wait_for_new_head(head, stop)
+                self.metrics.set("scanner_head_block", head)
+                end_block = head - confirmations
+                if stop.is_set() or end_block < current_block:
+                    continue
+
+                reverted_since = None
+                end_times = {}
+
+                def _progress(start, end, current, block_when, chunk_size, events_count):
+                    end_times["last"] = block_when
+
+                try:
+                    if self.block_hash_index is not None:
+                        # One hash check, unless the chain reorganised under us
+                        since_block = self.handle_reorg()
+                        if since_block < current_block:
+                            reverted_since = current_block = since_block
+                    # The first chunk covers all new blocks
+                    processed, _ = self.scan(current_block, end_block, start_chunk_size=end_block - current_block,
+                                             progress_callback=_progress)
+                except Exception as e:
+                    logger.warning("Following blocks %d - %d failed with %s, resuming on the next head",
+                                   current_block, end_block, e)
+                    current_block = self.get_last_scanned_block() + 1
+                    continue
+
+                update = FollowUpdate(current_block, end_block, head, processed, end_times.get("last"),
+                                      reverted_since=reverted_since)
+                if update.lag is not None:
+                    self.metrics.observe("scanner_follow_lag_seconds", update.lag)
+                push_update(consumers, update)
+                updates += 1
+                current_block = end_block + 1
+        finally:
+            self.bypass_log_cache = False
+
+        return updates
+
+
+def _retry_web3_call(func, start_block, end_block, retries, delay=3.0,
+                     controller: Optional[ChunkSizeController] = None,
+                     metrics: Optional[MetricsSink] = None,
+                     durations: Optional[List[float]] = None) -> Tuple[int, list]:
     """A custom retry loop to throttle down block range.
 
     If our JSON-RPC server cannot serve all incoming `eth_getLogs` in a single request,
@@ -275,26 +758,48 @@ def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int,
     :param start_block: The initial start block of the block range
     :param end_block: The initial start block of the block range
     :param retries: How many times we retry
-    :param delay: Time to sleep between retries
+    :param delay: Time to sleep between retries, if no controller is given
+    :param controller: Decides the block range and the delay of each retry.
+        By default the block range is halved on every retry.
+    :param metrics: Where the attempts, their timings and errors are reported
+    :param durations: Seconds the successful call took are appended here
+    :return: tuple(the end block we actually got the events for, events)
     """
+    if controller is None:
+        controller = DoublingChunkSizeController(retry_delay=delay)
+    if metrics is None:
+        metrics = NullMetrics()
+
     for i in range(retries):
         try:
-            return end_block, func(start_block, end_block)
+            with metrics.timer("scanner_get_logs_seconds"):
+                started = time.perf_counter()
+                events = func(start_block, end_block)
+            if durations is not None:
+                durations.append(time.perf_counter() - started)
+            return end_block, events
+        except LookupError:
+            # Replaying from the log cache and the range is not there, retrying does not help
+            raise
         except Exception as e:
             # Assume this is HTTPConnectionPool(host='localhost', port=8545): Read timed out. (read timeout=10)
             # from Go Ethereum. This translates to the error "context was cancelled" on the server side:
             # https://github.com/ethereum/go-ethereum/issues/20426
+            metrics.inc("scanner_get_logs_errors_total", kind=error_kind(e))
             if i < retries - 1:
+                metrics.inc("scanner_get_logs_retries_total")
+                chunk_size, delay = controller.on_error(end_block - start_block + 1, e, i)
                 # Give some more verbose info than the default middleware
                 logger.warning(
-                    "Retrying events for block range %d - %d (%d) failed with %s, retrying in %s seconds",
+                    "Retrying events for block range %d - %d (%d) failed with %s, retrying %d blocks in %s seconds",
                     start_block,
                     end_block,
                     end_block-start_block,
                     e,
+                    chunk_size,
                     delay)
-                # Decrease the `eth_getBlocks` range
-                end_block = start_block + ((end_block - start_block) // 2)
+                # Decrease the `eth_getBlocks` range if the controller tells so
+                end_block = start_block + chunk_size - 1
                 # Let the JSON-RPC to recover e.g. from restart
                 time.sleep(delay)
                 continue
@@ -308,13 +813,16 @@ def _fetch_events_for_all_contracts(
         event,
         argument_filters: dict,
         from_block: int,
-        to_block: int) -> Iterable:
+        to_block: int,
+        log_cache: Optional[RawLogCache] = None) -> Iterable:
     """Get events using eth_getLogs API.
 
     This method is detached from any contract instance.
 
     This is a stateless method, as opposed to createFilter.
     It can be safely called against nodes which do not provide `eth_newFilter` API, like Infura.
+
+    :param log_cache: Answer from this raw log cache when it covers the block range, and store the responses in it
     """
 
     if from_block is None:
@@ -350,7 +858,7 @@ def _fetch_events_for_all_contracts(
 
     # Call JSON-RPC API on your Ethereum node.
     # get_logs() returns raw AttributedDict entries
-    logs = w3.eth.get_logs(event_filter_params)
+    logs = _get_logs(w3, event_filter_params, log_cache)
 
     # Convert raw binary data to Python proxy objects as described by ABI
     all_events = []
@@ -365,3 +873,90 @@ def _fetch_events_for_all_contracts(
     return all_events
 
 
+def _fetch_events_for_all_event_types(
+        w3,
+        events: List,
+        argument_filters: dict,
+        from_block: int,
+        to_block: int,
+        log_cache: Optional[RawLogCache] = None) -> list:
+    """Get events of several types using a single eth_getLogs call.
+
+    The topic0 of the filter is an OR-list of the event signature hashes,
+    and each returned log is decoded with the ABI matching its own topic0.
+
+    :param log_cache: See `_fetch_events_for_all_contracts`
+    :return: Decoded events sorted by (blockNumber, logIndex)
+    """
+
+    if from_block is None:
+        raise TypeError("Missing mandatory keyword argument to getLogs: fromBlock")
+
+    abis_by_topic = _get_abis_by_topic(events)
+    event_filter_params = _construct_multi_event_filter_params(abis_by_topic, argument_filters, from_block, to_block)
+
+    logger.debug("Querying eth_getLogs with the following parameters: %s", event_filter_params)
+
+    logs = _get_logs(w3, event_filter_params, log_cache)
+    return _decode_logs(w3.codec, abis_by_topic, logs)
+
+
+def _get_logs(w3, event_filter_params: dict, log_cache: Optional[RawLogCache] = None) -> list:
+    """Raw logs from the cache if we have one, from the node otherwise."""
+    if log_cache is None:
+        return w3.eth.get_logs(event_filter_params)
+    return log_cache.get_logs(event_filter_params, w3.eth.get_logs)
+
+
+def _get_abis_by_topic(events: List) -> dict:
+    """Map event signature hash -> raw ABI of the event."""
+    abis_by_topic = {}
+    for event in events:
+        abi = event._get_event_abi()
+        abis_by_topic[encode_hex(event_abi_to_log_topic(abi))] = abi
+    return abis_by_topic
+
+
+def _uncombinable_filters(argument_filters: dict) -> List[str]:
+    """Names of the filters a combined query of several event types cannot apply."""
+    return sorted(name for name, value in (argument_filters or {}).items() if name != "address" and value is not None)
+
+
+def _construct_multi_event_filter_params(abis_by_topic: dict, argument_filters: dict, from_block, to_block) -> dict:
+    """eth_getLogs parameters matching any of our event signatures.
+
+    Only the address filter is supported, as the event arguments differ between the event types.
+
+    :raise ValueError: If there are other filters, rather than silently ignoring them
+    """
+    unsupported_filters = _uncombinable_filters(argument_filters)
+    if unsupported_filters:
+        raise ValueError(f"Event argument filters {unsupported_filters} cannot be used in a combined query")
+    event_filter_params = {
+        "fromBlock": from_block,
+        "toBlock": to_block,
+        "topics": [list(abis_by_topic.keys())],
+    }
+    address = argument_filters.get("address")
+    if address:
+        event_filter_params["address"] = address
+    return event_filter_params
+
+
+def _decode_logs(codec: ABICodec, abis_by_topic: dict, logs: Iterable) -> list:
+    """Decode raw logs with the ABI matching their topic0.
+
+    :return: Decoded events sorted by (blockNumber, logIndex)
+    """
+    all_events = []
+    for log in logs:
+        topic = log["topics"][0]
+        topic = topic if isinstance(topic, str) else encode_hex(topic)
+        abi = abis_by_topic.get(topic.lower())
+        if abi is None:
+            # Anonymous or unrelated log sneaked in, nothing we can decode
+            continue
+        all_events.append(get_event_data(codec, abi, log))
+
+    all_events.sort(key=lambda evt: (evt["blockNumber"], evt["logIndex"]))
+    return all_events
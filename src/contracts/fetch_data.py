@@ -1,23 +1,74 @@
 
 
+from concurrent.futures import ThreadPoolExecutor
 from itertools import count
 import os
 import json    
+import datetime
+import time
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+from eth_utils import event_abi_to_log_topic, to_checksum_address
+from hexbytes import HexBytes
 from web3 import Web3
 
 from src.utils.project_paths import DOC_PATH
+from src.contracts.block_timestamp_index import BlockTimestampIndex
+from src.contracts.chunk_size_controller import AIMDChunkSizeController, estimate_response_bytes
+from src.contracts.event_scanner import _retry_web3_call
+from src.contracts.rate_limiter import RateLimiter
+from src.contracts.raw_log_cache import RawLogCache
+from src.gini_lorenz.gini_sketch import GiniSketch
+
+# Columns of the events with a fixed log layout, decoded straight from the raw logs:
+# (column, source, position) where source is "topic" (an indexed address), "uint" or "bool"
+# (a data word), "block", "txhash" or "pool"
+LOG_LAYOUTS = {
+    "Staked": [("address", "topic", 2), ("blockNumber", "block", None), ("amount", "uint", 0),
+               ("Pool", "pool", None)],
+    "Unstaked": [("address", "topic", 2), ("blockNumber", "block", None), ("amount", "uint", 0),
+                 ("Pool", "pool", None)],
+    "YieldClaimed": [("blockNumber", "block", None), ("address", "topic", 2), ("sILV", "bool", 0),
+                     ("amount", "uint", 1), ("txhash", "txhash", None), ("Pool", "pool", None)],
+    "Transfer": [("to", "topic", 2), ("blockNumber", "block", None), ("txhash", "txhash", None),
+                 ("Pool", "pool", None)],
+}
+
+
+@lru_cache(maxsize=None)
+def _checksum_address(raw: bytes) -> str:
+    # Holders come back again and again, hash each address once
+    return to_checksum_address(raw)
+
+
+def _words(chunks, n):
+    """Stack equally long byte strings in a (n, words, 32) uint8 array."""
+    return np.frombuffer(b"".join(chunks), dtype=np.uint8).reshape(n, -1, 32)
+
 
 class FetchData:
 
-    def __init__(self) -> None:
+    def __init__(self, provider_url=None) -> None:
         with open(os.path.join(DOC_PATH, 'abi.json'), 'r') as f:
             self.abi = json.load(f)    
         self.hard_block_start = 12736883
         self.hard_block_end = 14307725
         self.block_window_size = 2000
-        provider_url = "https://eth-mainnet.alchemyapi.io/v2/uanCKV5LOP7NtaVUos3qtH-R-V1xy-A3"
+        # Concurrent eth_getLogs requests, all threads together stay under the request rate
+        self.max_workers = 4
+        self.rate_limiter = RateLimiter(rate=20, burst=4)
+        self.max_retries = 10
+        # Ask all pools in one eth_getLogs per window, instead of one query per pool and event
+        self.combine_pools = True
+        # Raw eth_getLogs responses kept on the disk, so the history can be decoded again without the node
+        self.log_cache = RawLogCache()
+        # Any JSON-RPC node, e.g. the synthetic node of the benchmarks
+        provider_url = provider_url or "https://eth-mainnet.alchemyapi.io/v2/uanCKV5LOP7NtaVUos3qtH-R-V1xy-A3"
         self.w3 = Web3(Web3.HTTPProvider(provider_url))
+        # Shared with the EventScanner, so blocks seen by either are never asked twice
+        self.timestamp_index = BlockTimestampIndex()
+        self.timestamp_index.restore()
         self.pools = {
         "ILV Core": "0x25121EDDf746c884ddE4619b573A7B10714E2a36",
         "ILV-ETH LP": "0x8B4d8443a0229349A9892D4F7CbE89eF5f843F72",
@@ -28,11 +79,126 @@ class FetchData:
     }
     
     def get_relevant_event_logs(self):
-        self.stake_events = self.make_events_df_all_pools(event_name="Staked")
-        self.unstake_events = self.make_events_df_all_pools(event_name="Unstaked")
+        events = self.make_events_dfs_all_pools(["Staked", "Unstaked"])
+        self.stake_events = events["Staked"]
+        self.unstake_events = events["Unstaked"]
         # self.yield_claim_events = self.make_events_df_all_pools(event_name="YieldClaimed")
 
+    def pool_sketches(self, relative_accuracy=0.01):
+        """Approximate balance distribution of every pool, from the stake and unstake events.
+
+        Merge them with GiniSketch.merged for a combined-pool Gini/Lorenz preview.
+
+        Args:
+            relative_accuracy (float, optional): Relative width of the sketch buckets. Defaults to 0.01.
+
+        Returns:
+            dict: Pool label -> GiniSketch of the staked balances.
+        """
+        staked = self.stake_events.groupby(["Pool", "address"])["amount"].sum()
+        unstaked = self.unstake_events.groupby(["Pool", "address"])["amount"].sum()
+        balances = staked.sub(unstaked, fill_value=0)
+        return {pool: GiniSketch.from_values(balances.loc[pool].values, relative_accuracy)
+                for pool in balances.index.get_level_values("Pool").unique()}
+
+    def make_events_dfs_all_pools(self, event_names):
+        """Fixed layout events of all pools, fetched concurrently with stateless eth_getLogs.
+
+        With combine_pools, every eth_getLogs asks all pools and events of a block window,
+        and the block range is split between the workers, so adding pools adds no requests.
+        Otherwise every (pool, event) pair is a task with its own window size.
+        The windows of every task adapt to the event density it sees.
+
+        Args:
+            event_names (list): Events of LOG_LAYOUTS.
+
+        Returns:
+            dict: Event name -> dataframe of the events of all pools, as make_events_df_all_pools.
+        """
+        topics = {self.event_topic(event_name): event_name for event_name in event_names}
+        labels = {address.lower(): label for label, address in self.pools.items()}
+        if self.combine_pools:
+            addresses = list(self.pools.values())
+            bounds = np.linspace(self.hard_block_start, self.hard_block_end + 1, self.max_workers + 1).astype(int)
+            tasks = [(addresses, list(topics), int(bounds[i]), int(bounds[i + 1]) - 1)
+                     for i in range(self.max_workers) if bounds[i] < bounds[i + 1]]
+        else:
+            tasks = [([address], [topic], self.hard_block_start, self.hard_block_end)
+                     for address in self.pools.values() for topic in topics]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda task: self.get_logs_range(*task), tasks))
+
+        # Split the logs by pool and event, tasks and their logs are in block order
+        grouped = {}
+        for logs in results:
+            for log in logs:
+                key = (labels[log["address"].lower()], topics[HexBytes(log["topics"][0]).hex()])
+                grouped.setdefault(key, []).append(log)
+
+        frames = {}
+        for event_name in event_names:
+            batches = [self.decode_logs_to_columns(label, grouped[(label, event_name)], event_name)
+                       for label in self.pools if (label, event_name) in grouped]
+            if batches:
+                frames[event_name] = pd.DataFrame({column: np.concatenate([columns[column] for columns in batches])
+                                                   for column in batches[0]})
+            else:
+                frames[event_name] = pd.DataFrame(columns=[column for column, _, _ in LOG_LAYOUTS[event_name]])
+        return frames
+
+    def get_logs_range(self, addresses, topics, start, end):
+        """All logs of a block range, in windows that adapt to the event density.
+
+        Args:
+            addresses (list): Contract addresses.
+            topics (list): Event topics, any of them matches.
+            start (int): First block.
+            end (int): Last block.
+
+        Returns:
+            list: Raw logs in block order.
+        """
+        controller = AIMDChunkSizeController(max_chunk_size=100000)
+        logs = []
+        window_end = min(end, start + self.block_window_size - 1)
+        while start <= end:
+            started = time.time()
+            window_end, batch = _retry_web3_call(
+                lambda from_block, to_block: self.get_logs_window(addresses, topics, from_block, to_block),
+                start, window_end, retries=self.max_retries, controller=controller)
+            logs.extend(batch)
+            start, window_end = self.get_new_block_window(len(batch), start, window_end,
+                                                          controller=controller, duration=time.time() - started,
+                                                          response_bytes=estimate_response_bytes(batch))
+            window_end = min(end, window_end)
+        return logs
+
+    def get_logs_window(self, addresses, topics, block_start, block_end):
+        """One eth_getLogs under the shared request rate, or none if the raw log cache has the block range."""
+        params = {
+            "address": addresses if len(addresses) > 1 else addresses[0],
+            "topics": [topics],
+            "fromBlock": block_start,
+            "toBlock": block_end,
+        }
+        if self.log_cache is not None:
+            return self.log_cache.get_logs(params, self._get_logs)
+        return self._get_logs(params)
+
+    def _get_logs(self, params):
+        self.rate_limiter.acquire()
+        return self.w3.eth.getLogs(params)
+
+    def event_topic(self, event_name, abi=None):
+        if abi is None:
+            abi = self.abi
+        event_abi = next(item for item in abi if item.get("type") == "event" and item.get("name") == event_name)
+        return HexBytes(event_abi_to_log_topic(event_abi)).hex()
+
     def make_events_df_all_pools(self, event_name):
+        if event_name in LOG_LAYOUTS:
+            return self.make_events_dfs_all_pools([event_name])[event_name]
         dfs = []
         for pool_name, pool_address in self.pools.items():
             pool_dfs = self.make_events_df_per_pool(pool_address, pool_name, event_name)
@@ -43,25 +209,45 @@ class FetchData:
         if abi is None:
             abi = self.abi
         contract = self.w3.eth.contract(address=pool_address, abi=abi)
+        # Fixed layout events are decoded from the raw logs, in columns
+        columnar = event_name in LOG_LAYOUTS
         start = self.hard_block_start
         end = self.hard_block_start + self.block_window_size
         dfs = []
+        batches = []
         for batch in count():
-            data = self.get_events_data(contract, event_name, block_start=start, block_end=end)
+            if columnar:
+                data = self.get_raw_logs(pool_address, event_name, block_start=start, block_end=end, abi=abi)
+            else:
+                data = self.get_events_data(contract, event_name, block_start=start, block_end=end)
             print("Batch nr: {}, elements: {}".format(batch, len(data)))
             start, end = self.get_new_block_window(len(data), start, end)
             print("START: {}, END: {}".format(start, end))
-            df = self.parse_event_batch_to_df(pool_label, data, event_name)
-            print("LENGTH DF: {}".format(len(df)))
-            if df.empty:
-                pass
+            if columnar:
+                if data:
+                    batches.append(self.decode_logs_to_columns(pool_label, data, event_name))
             else:
-                dfs.append(df)
+                df = self.parse_event_batch_to_df(pool_label, data, event_name)
+                print("LENGTH DF: {}".format(len(df)))
+                if df.empty:
+                    pass
+                else:
+                    dfs.append(df)
             if start > self.hard_block_end:
                 break
+        if batches:
+            # One frame per pool instead of one per batch
+            dfs.append(pd.DataFrame({column: np.concatenate([columns[column] for columns in batches])
+                                     for column in batches[0]}))
         return dfs
 
     def get_events_data(self, contract, event_name, block_start, block_end):
+        if self.log_cache is not None:
+            # Stateless eth_getLogs through the raw log cache, decoded by the contract ABI
+            event = contract.events[event_name]()
+            logs = self.get_logs_window([contract.address], [self.event_topic(event_name, contract.abi)],
+                                        block_start, block_end)
+            return [event.processLog(log) for log in logs]
         staked_filter = contract.events[event_name].createFilter(fromBlock=block_start, toBlock=block_end)
         try:
             data = staked_filter.get_all_entries()
@@ -76,6 +262,52 @@ class FetchData:
             raise
         return data
 
+    def get_raw_logs(self, pool_address, event_name, block_start, block_end, abi=None):
+        """Undecoded logs of one event of one contract, with a plain eth_getLogs."""
+        return self.get_logs_window([pool_address], [self.event_topic(event_name, abi)], block_start, block_end)
+
+    def decode_logs_to_columns(self, pool_label, logs, event_name):
+        """Decode raw logs of a fixed layout event (see LOG_LAYOUTS) into typed columns.
+
+        Addresses are read from the indexed topics and amounts from the data words
+        of all logs at once, without the generic ABI decoder.
+
+        Args:
+            pool_label (str): Value of the Pool column.
+            logs (list): Raw logs as returned by eth_getLogs.
+            event_name (str): Staked, Unstaked, YieldClaimed or Transfer.
+
+        Returns:
+            dict: Column name -> np.ndarray, the columns of parse_event_batch_to_df.
+        """
+        n = len(logs)
+        topics = _words((bytes(topic) for log in logs for topic in log["topics"]), n)
+        words = None
+        columns = {}
+        for column, source, position in LOG_LAYOUTS[event_name]:
+            if source == "topic":
+                # The address is in the last 20 bytes of the topic
+                raw = np.ascontiguousarray(topics[:, position, 12:]).tobytes()
+                values = np.empty(n, dtype=object)
+                values[:] = [_checksum_address(raw[i * 20:(i + 1) * 20]) for i in range(n)]
+            elif source in ("uint", "bool"):
+                if words is None:
+                    words = _words((bytes(HexBytes(log["data"])) for log in logs), n)
+                if source == "bool":
+                    values = words[:, position, 31] != 0
+                else:
+                    # uint256 as Python integers, from four big-endian 64 bit limbs
+                    limbs = np.ascontiguousarray(words[:, position]).view(">u8").astype(object)
+                    values = (limbs[:, 0] << 192) | (limbs[:, 1] << 128) | (limbs[:, 2] << 64) | limbs[:, 3]
+            elif source == "block":
+                values = np.fromiter((log["blockNumber"] for log in logs), dtype=np.int64, count=n)
+            elif source == "txhash":
+                values = np.array([HexBytes(log["transactionHash"]).hex() for log in logs], dtype=object)
+            else:
+                values = np.full(n, pool_label, dtype=object)
+            columns[column] = values
+        return columns
+
     def parse_event_batch_to_df(self, pool_label, data, event_name):
         parsed = {}
         for i in range(len(data)):
@@ -120,12 +352,41 @@ class FetchData:
         return df
 
 
-    def get_new_block_window(self, n_elements, start, end):
+    def get_new_block_window(self, n_elements, start, end, controller=None, duration=0.0, response_bytes=0):
         window_size = end - start
-        # if n_elements > 5000:
-        #     window_size /= 2
-        # elif n_elements < 50:   
-        #     window_size *= 2
+        if controller is not None:
+            # Larger windows where events are sparse, smaller where they are dense or slow
+            window_size = controller.next_chunk_size(end - start + 1, n_elements, duration, response_bytes)
         start = end + 1
         end = start + window_size - 1
-        return int(start), int(end)
\ No newline at end of file
+        return int(start), int(end)
+
+    def get_block_timestamps(self, block_nums):
+        """Ask block timestamps from the node, one block at a time."""
+        return {block_num: datetime.datetime.utcfromtimestamp(self.w3.eth.getBlock(block_num)["timestamp"])
+                for block_num in block_nums}
+
+    def add_timestamps(self, df, max_error=None):
+        """Add a timestamp column to an events dataframe.
+
+        Args:
+            df (pd.DataFrame): Events with a blockNumber column.
+            max_error (float, optional): Accept timestamps interpolated from the index that are off
+                by at most this many seconds, e.g. 43200 for day-level resolution. Defaults to exact timestamps.
+
+        Returns:
+            pd.DataFrame: The same dataframe with the timestamp column, and with max_error
+                a timestamp_error column of how many seconds each timestamp may be off.
+        """
+        if max_error is not None:
+            # Make sure every block of the dataframe falls between two anchors
+            self.timestamp_index.add_anchors(int(df["blockNumber"].min()), int(df["blockNumber"].max()),
+                                             self.get_block_timestamps)
+        errors = {}
+        timestamps = self.timestamp_index.resolve(df["blockNumber"].unique().tolist(),
+                                                  self.get_block_timestamps, max_error, errors)
+        df["timestamp"] = df["blockNumber"].map(timestamps)
+        if max_error is not None:
+            df["timestamp_error"] = df["blockNumber"].map(errors)
+        self.timestamp_index.save()
+        return df
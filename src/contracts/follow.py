@@ -0,0 +1,202 @@
+"""Follow the chain head: scan new blocks as soon as they are mined.
+
+`EventScanner.follow` keeps the state in memory and, for every new head,
+scans only the blocks we have not seen yet and pushes a `FollowUpdate`
+to its consumers. A head source tells when there is a new head:
+`HeadPoller` polls `eth_blockNumber` at intervals adapted to the block time,
+and anything with the same `wait_for_new_head` method, like a head subscription,
+can be used instead.
+"""
+
+import datetime
+import logging
+import threading
+import time
+from typing import Callable, List, Optional, Set
+
+from src.contracts.balance_ledger import BalanceLedger
+from src.contracts.scan_metrics import MetricsSink, NullMetrics
+from src.gini_lorenz.streaming_gini import StreamingGini
+
+logger = logging.getLogger(__name__)
+
+
+class HeadPoller:
+    """Wait for new blocks by polling the head, as often as needed and not more.
+
+    The block time is estimated from the heads we see. After a new block we sleep
+    until the next one is due, then poll every `min_interval` seconds,
+    backing off towards `max_interval` while the block is late.
+    """
+
+    def __init__(self, get_head: Callable[[], int], block_time: float = 13.0, min_interval: float = 0.5,
+                 max_interval: float = 15.0, backoff: float = 1.5, smoothing: float = 0.2,
+                 metrics: Optional[MetricsSink] = None):
+        """
+        :param get_head: Number of the latest block, e.g. `lambda: w3.eth.blockNumber`
+        :param block_time: Initial guess of the seconds between blocks
+        :param min_interval: Shortest time between polls
+        :param max_interval: Longest time between polls
+        :param backoff: Factor the interval grows by for every poll that finds no new block
+        :param smoothing: Weight of the latest observation in the block time estimate
+        """
+        self.get_head = get_head
+        self.block_time = block_time
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.metrics = metrics or NullMetrics()
+        self.last_head = None
+        # time.monotonic() when we saw the last head
+        self.last_head_time = None
+        # Polls since the next block was due
+        self.late_polls = 0
+
+    def on_head(self, head: int, now: float):
+        """A poll found a new head."""
+        if self.last_head is not None and self.last_head_time is not None and head > self.last_head:
+            observed = (now - self.last_head_time) / (head - self.last_head)
+            self.block_time += self.smoothing * (observed - self.block_time)
+        self.last_head = head
+        self.last_head_time = now
+        self.late_polls = 0
+
+    def next_interval(self, now: float) -> float:
+        """Seconds to wait before the next poll."""
+        if self.last_head_time is not None:
+            due = self.last_head_time + self.block_time
+            if now + self.min_interval < due:
+                # Sleep until the next block is due
+                return min(due - now, self.max_interval)
+        interval = min(self.max_interval, self.min_interval * self.backoff ** self.late_polls)
+        self.late_polls += 1
+        return interval
+
+    def wait_for_new_head(self, last_head: int, stop: Optional[threading.Event] = None) -> int:
+        """Block until the head is past `last_head`.
+
+        A failing poll is logged and retried, so a node restart does not end a follow.
+
+        :return: The new head, or `last_head` if stopped
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                head = self.get_head()
+            except Exception as e:
+                logger.warning("Polling the head failed with %s", e)
+                head = None
+            self.metrics.inc("scanner_head_polls_total")
+            now = time.monotonic()
+            if head is not None and head > last_head:
+                self.on_head(head, now)
+                return head
+            stop.wait(self.next_interval(now))
+        return last_head
+
+
+class FollowUpdate:
+    """New blocks scanned by `EventScanner.follow`."""
+
+    def __init__(self, start_block: int, end_block: int, head: int, events: list,
+                 block_when: Optional[datetime.datetime], reverted_since: Optional[int] = None):
+        """
+        :param start_block: The first block scanned in this update
+        :param end_block: The last block scanned in this update, now committed to the state
+        :param head: The head we scanned up to, minus the confirmations
+        :param events: What the state returned for each processed event
+        :param block_when: When the end block was mined
+        :param reverted_since: If a chain reorganisation was rolled back before this update,
+            the first reverted block. The update then rescans from it.
+        """
+        self.start_block = start_block
+        self.end_block = end_block
+        self.head = head
+        self.events = events
+        self.block_when = block_when
+        self.reverted_since = reverted_since
+        self.pushed_at = datetime.datetime.utcnow()
+
+    @property
+    def lag(self) -> Optional[float]:
+        """Seconds from mining the end block to pushing this update."""
+        if self.block_when is None:
+            return None
+        return (self.pushed_at - self.block_when).total_seconds()
+
+    def __repr__(self):
+        return (f"FollowUpdate(blocks {self.start_block} - {self.end_block}, head {self.head}, "
+                f"{len(self.events)} events, lag {self.lag}"
+                + (f", reverted since {self.reverted_since})" if self.reverted_since is not None else ")"))
+
+
+class LedgerGini:
+    """Follow consumer keeping the Gini coefficient of a `BalanceLedger` up to date.
+
+    Only the holders whose balances changed in the blocks of an update are read
+    again from the ledger, found from its undo log, and moved in a `StreamingGini`,
+    so an update costs O(changes * log holders) instead of a sort of all holders.
+    """
+
+    def __init__(self, ledger: BalanceLedger, pool: Optional[str] = None, norm: bool = False,
+                 on_gini: Optional[Callable[[float, FollowUpdate], None]] = None):
+        """
+        :param ledger: The ledger fed by the scanner state
+        :param pool: Only this pool, all pools summed by address by default
+        :param norm: Normalize by n / (n - 1)
+        :param on_gini: Called with the new Gini coefficient after every update
+        """
+        self.ledger = ledger
+        self.pool = pool
+        self.norm = norm
+        self.on_gini = on_gini
+        self.gini: Optional[float] = None
+        self.resync()
+
+    def _balance(self, address: str) -> int:
+        if self.pool is not None:
+            return self.ledger.balances.get(self.pool, {}).get(address, 0)
+        return sum(balances.get(address, 0) for balances in self.ledger.balances.values())
+
+    def resync(self):
+        """Read all balances again."""
+        self.streaming = StreamingGini()
+        pools = [self.pool] if self.pool is not None else list(self.ledger.balances)
+        for address in {address for pool in pools for address in self.ledger.balances.get(pool, {})}:
+            self.streaming.update(address, max(self._balance(address), 0))
+        self._update_gini()
+
+    def _touched(self, start_block: int) -> Set[str]:
+        touched = set()
+        # Blocks are in increasing order in the undo log, walk it from the end
+        for block_num in reversed(self.ledger.undo_log):
+            if block_num < start_block:
+                break
+            touched.update(address for pool, address, _ in self.ledger.undo_log[block_num]
+                           if self.pool is None or pool == self.pool)
+        return touched
+
+    def _update_gini(self):
+        self.gini = self.streaming.gini(self.norm) if len(self.streaming) else None
+
+    def __call__(self, update: FollowUpdate):
+        if update.reverted_since is not None or update.start_block < self.ledger.undo_from:
+            # Reverted balances are not in the undo log any more,
+            # nor are changes older than it
+            self.resync()
+        else:
+            for address in self._touched(update.start_block):
+                self.streaming.update(address, max(self._balance(address), 0))
+            self._update_gini()
+        if self.on_gini and self.gini is not None:
+            self.on_gini(self.gini, update)
+
+
+def push_update(consumers: List[Callable[[FollowUpdate], None]], update: FollowUpdate):
+    """Hand an update to every consumer. A failing consumer does not stop the others or the follow."""
+    for consumer in consumers:
+        try:
+            consumer(update)
+        except Exception:
+            logger.exception("Follow consumer %s failed on %s", consumer, update)
@@ -1,24 +1,52 @@
+import bisect
 import datetime
 import json
 import os
 import time
+from typing import Optional
 from src.contracts.event_scanner_state import EventScannerState
+from src.contracts.balance_ledger import BalanceLedger
 
 from web3.datastructures import AttributeDict
 
 from src.utils.project_paths import DATA_PATH
 
 
+def _int_keys(blocks: dict) -> dict:
+    """Block numbers and log indexes back to integers, JSON keys are always strings."""
+    return {int(block_num): {txhash: {int(log_index): el for log_index, el in events.items()}
+                             for txhash, events in txs.items()}
+            for block_num, txs in blocks.items()}
+
+
 class JSONifiedState(EventScannerState):
         """Store the state of scanned blocks and all events.
 
         All state is an in-memory dict.
         Simple load/store massive JSON on start up.
+
+        In the journaled mode, the JSON file is a compacted base snapshot and
+        every chunk only appends the blocks it added to a journal file next to it.
+        When the journal grows past a threshold, it is compacted to a new snapshot.
         """
 
-        def __init__(self):
+        def __init__(self, journaled: bool = False, compact_threshold: int = 64 * 1024 * 1024,
+                     ledger: Optional[BalanceLedger] = None):
+            """
+            :param journaled: Append the changes of each chunk to a journal instead of rewriting the whole file
+            :param compact_threshold: Journal size in bytes after which we write a new base snapshot
+            :param ledger: Holder balances updated with every event, saved together with the state
+            """
             self.state = None
             self.fname = os.path.join(DATA_PATH, "ILV-Core (with_transfer).json")
+            self.journal_fname = self.fname + ".journal"
+            self.journaled = journaled
+            self.compact_threshold = compact_threshold
+            self.ledger = ledger
+            # Blocks touched since the last journal append
+            self.dirty_blocks = set()
+            # Sorted block numbers of the state, so deleting the last blocks does not walk them all
+            self.block_numbers = []
             # How many second ago we saved the JSON file
             self.last_save = 0
 
@@ -28,22 +56,81 @@ class JSONifiedState(EventScannerState):
                 "last_scanned_block": 0,
                 "blocks": {},
             }
+            self.block_numbers = []
 
         def restore(self):
             """Restore the last scan state from a file."""
             try:
                 self.state = json.load(open(self.fname, "rt"))
-                print(f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
+                self.state["blocks"] = _int_keys(self.state["blocks"])
+                self.block_numbers = sorted(self.state["blocks"])
             except (IOError, json.decoder.JSONDecodeError):
                 print("State starting from scratch")
                 self.reset()
+            if self.journaled:
+                self.replay_journal()
+            if self.ledger:
+                self.ledger.restore()
+                if self.ledger.last_block != self.state["last_scanned_block"]:
+                    # Ledger file missing or saved at a different point than the state
+                    self.ledger.rebuild(self.state["blocks"])
+                    self.ledger.end_block(self.state["last_scanned_block"])
+            print(f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
 
         def save(self):
-            """Save everything we have scanned so far in a file."""
-            with open(self.fname, "wt") as f:
+            """Save everything we have scanned so far in a file.
+
+            Written to a temporary file first and renamed over the old one,
+            so a crash cannot leave a half-written state behind.
+            """
+            tmp_fname = self.fname + ".tmp"
+            with open(tmp_fname, "wt") as f:
                 json.dump(self.state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_fname, self.fname)
+            if self.ledger:
+                self.ledger.save()
+            if self.journaled:
+                # Everything in the journal is now in the snapshot
+                open(self.journal_fname, "wt").close()
+                self.dirty_blocks = set()
             self.last_save = time.time()
 
+        def append_journal(self, entry: dict):
+            """Append one change record to the journal."""
+            with open(self.journal_fname, "at") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+        def replay_journal(self):
+            """Apply the changes recorded after the base snapshot was written.
+
+            Replaying is idempotent, so a crash between writing a new snapshot
+            and truncating the journal is harmless.
+            """
+            try:
+                lines = open(self.journal_fname, "rt").readlines()
+            except IOError:
+                return
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # A crash in the middle of an append, this chunk was never completed
+                    break
+                if "delete_since" in entry:
+                    self.delete_blocks(entry["delete_since"])
+                    if "last_scanned_block" in entry:
+                        self.state["last_scanned_block"] = entry["last_scanned_block"]
+                else:
+                    for block_num, txs in _int_keys(entry["blocks"]).items():
+                        if block_num not in self.state["blocks"]:
+                            bisect.insort(self.block_numbers, block_num)
+                        self.state["blocks"][block_num] = txs
+                    self.state["last_scanned_block"] = entry["last_scanned_block"]
+
         #
         # EventScannerState methods implemented below
         #
@@ -53,10 +140,29 @@ class JSONifiedState(EventScannerState):
             return self.state["last_scanned_block"]
 
         def delete_data(self, since_block):
-            """Remove potentially reorganised blocks from the scan data."""
-            for block_num in range(since_block, self.get_last_scanned_block()):
-                if block_num in self.state["blocks"]:
-                    del self.state["blocks"][block_num]
+            """Remove potentially reorganised blocks from the scan data.
+
+            The deleted blocks no longer count as scanned, so a crash before they are scanned
+            again cannot skip them on the next start. Journaled, a truncation record is appended,
+            otherwise the state file is written by the next `end_chunk`.
+            """
+            self.delete_blocks(since_block)
+            self.state["last_scanned_block"] = min(self.state["last_scanned_block"], since_block - 1)
+            if self.ledger:
+                self.ledger.revert_since(since_block)
+            if self.journaled:
+                self.append_journal({"delete_since": since_block,
+                                     "last_scanned_block": self.state["last_scanned_block"]})
+            else:
+                # The block hashes of the rescanned blocks are recorded after the chunk ends,
+                # the file must not have the deleted blocks by then
+                self.last_save = 0
+
+        def delete_blocks(self, since_block):
+            pos = bisect.bisect_left(self.block_numbers, since_block)
+            for block_num in self.block_numbers[pos:]:
+                del self.state["blocks"][block_num]
+            del self.block_numbers[pos:]
 
         def start_chunk(self, block_number, chunk_size):
             pass
@@ -65,6 +171,20 @@ class JSONifiedState(EventScannerState):
             """Save at the end of each block, so we can resume in the case of a crash or CTRL+C"""
             # Next time the scanner is started we will resume from this block
             self.state["last_scanned_block"] = block_number
+            if self.ledger:
+                self.ledger.end_block(block_number)
+
+            if self.journaled:
+                # Only the blocks of this chunk are written
+                self.append_journal({
+                    "last_scanned_block": block_number,
+                    "blocks": {block_num: self.state["blocks"][block_num] for block_num in self.dirty_blocks
+                               if block_num in self.state["blocks"]},
+                })
+                self.dirty_blocks = set()
+                if os.path.getsize(self.journal_fname) > self.compact_threshold:
+                    self.save()
+                return
 
             # Save the database file for every minute
             if time.time() - self.last_save > 60:
@@ -115,6 +235,7 @@ class JSONifiedState(EventScannerState):
             # Create empty dict as the block that contains all transactions by txhash
             if block_number not in self.state["blocks"]:
                 self.state["blocks"][block_number] = {}
+                bisect.insort(self.block_numbers, block_number)
 
             block = self.state["blocks"][block_number]
             if txhash not in block:
@@ -125,6 +246,9 @@ class JSONifiedState(EventScannerState):
 
             # Record ERC-20 Staked in our database
             self.state["blocks"][block_number][txhash][log_index] = el
+            self.dirty_blocks.add(block_number)
+            if self.ledger:
+                self.ledger.apply_event(event)
 
             # Return a pointer that allows us to look up this event later if needed
             return f"{block_number}-{txhash}-{log_index}"
\ No newline at end of file
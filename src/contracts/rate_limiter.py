@@ -0,0 +1,31 @@
+"""Request rate limit shared by threads talking to the same JSON-RPC node."""
+
+import threading
+import time
+
+
+class RateLimiter:
+    """Space requests evenly so that all threads together stay under a rate.
+
+    Up to `burst` requests can go out at once after an idle period.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate: Requests per second
+        :param burst: How many requests may go out back to back
+        """
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        # When the next request may go out
+        self.next_time = 0.0
+
+    def acquire(self):
+        """Wait until we may send the next request."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_time, now - (self.burst - 1) / self.rate)
+            self.next_time = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,226 @@
+"""Local cache of raw `eth_getLogs` responses.
+
+Raw logs never change once their blocks are final, so after a change in event parsing
+or in the state schema the history can be decoded again from the disk instead of
+asking the node for it again. Every distinct query (chain, addresses, topics)
+is a stream, stored in a directory named after the hash of the query.
+Each response is a gzip compressed segment file named after its block range.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from src.utils.project_paths import DATA_PATH
+
+logger = logging.getLogger(__name__)
+
+#: Log fields holding binary data, stored as hex strings
+HEX_FIELDS = ("blockHash", "transactionHash")
+
+
+def _block_number(value) -> int:
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+def _normalise_topic(topic):
+    if topic is None:
+        return None
+    if isinstance(topic, (list, tuple)):
+        return sorted(_normalise_topic(item) for item in topic)
+    return HexBytes(topic).hex().lower()
+
+
+def stream_key(chain_id: int, params: dict) -> str:
+    """Hash of everything in eth_getLogs parameters but the block range."""
+    address = params.get("address") or []
+    if isinstance(address, str):
+        address = [address]
+    query = [chain_id, sorted(a.lower() for a in address), [_normalise_topic(t) for t in params.get("topics", [])]]
+    return hashlib.sha256(json.dumps(query).encode()).hexdigest()[:32]
+
+
+def _encode_log(log) -> dict:
+    encoded = {}
+    for key, value in log.items():
+        if key == "topics":
+            value = [HexBytes(topic).hex() for topic in value]
+        elif isinstance(value, bytes):
+            value = HexBytes(value).hex()
+        encoded[key] = value
+    return encoded
+
+
+def _decode_log(log: dict) -> AttributeDict:
+    log["topics"] = [HexBytes(topic) for topic in log["topics"]]
+    for key in HEX_FIELDS:
+        if log.get(key) is not None:
+            log[key] = HexBytes(log[key])
+    return AttributeDict(log)
+
+
+class RawLogCache:
+    """Raw logs by query and block range, compressed on the disk.
+
+    A query is answered from the cache when the segments of its stream cover
+    the whole block range, even if the range was fetched as different chunks.
+    In the offline mode nothing is asked from the node and a range that is not
+    in the cache raises `LookupError`.
+    """
+
+    def __init__(self, path: Optional[str] = None, chain_id: int = 1, offline: bool = False):
+        """
+        :param path: Directory of the cache
+        :param chain_id: Chain the logs are from, part of the cache key
+        :param offline: Only replay from the cache, never call the node
+        """
+        self.path = path or os.path.join(DATA_PATH, "log cache")
+        self.chain_id = chain_id
+        self.offline = offline
+        # Stream key -> sorted (start block, end block) of its segments
+        self.segments: Dict[str, List[Tuple[int, int]]] = {}
+        # The cache may be shared by parallel scan workers
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def stream_path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def segment_fname(self, key: str, start_block: int, end_block: int) -> str:
+        return os.path.join(self.stream_path(key), f"{start_block:012d}-{end_block:012d}.json.gz")
+
+    def _stream_segments(self, key: str) -> List[Tuple[int, int]]:
+        with self.lock:
+            if key not in self.segments:
+                segments = []
+                if os.path.isdir(self.stream_path(key)):
+                    for fname in os.listdir(self.stream_path(key)):
+                        if fname.endswith(".json.gz"):
+                            start, end = fname[:-len(".json.gz")].split("-")
+                            segments.append((int(start), int(end)))
+                self.segments[key] = sorted(segments)
+            return self.segments[key]
+
+    @property
+    def last_block(self) -> int:
+        """The last block of any cached segment, where an offline replay can scan to."""
+        if os.path.isdir(self.path):
+            for key in os.listdir(self.path):
+                self._stream_segments(key)
+        return max((segments[-1][1] for segments in self.segments.values() if segments), default=0)
+
+    def last_block_of(self, params: dict) -> int:
+        """The last cached block of the stream of a query, 0 if nothing is cached."""
+        segments = self._stream_segments(stream_key(self.chain_id, params))
+        return segments[-1][1] if segments else 0
+
+    def get(self, params: dict) -> Optional[list]:
+        """Logs of a query from the cache.
+
+        :return: Logs in block order, or None if the block range is not fully cached
+        """
+        key = stream_key(self.chain_id, params)
+        start_block, end_block = _block_number(params["fromBlock"]), _block_number(params["toBlock"])
+
+        # Find segments covering the range without gaps
+        needed = start_block
+        covering = []
+        for segment_start, segment_end in self._stream_segments(key):
+            if segment_end < needed:
+                continue
+            if segment_start > needed:
+                break
+            covering.append((segment_start, segment_end))
+            needed = segment_end + 1
+            if needed > end_block:
+                break
+        if needed <= end_block:
+            return None
+
+        logs = []
+        seen = set()
+        for segment_start, segment_end in covering:
+            for log in _read_segment(self.segment_fname(key, segment_start, segment_end)):
+                # Segments of different chunkings may overlap
+                position = (log["blockNumber"], log["logIndex"])
+                if start_block <= log["blockNumber"] <= end_block and position not in seen:
+                    seen.add(position)
+                    logs.append(_decode_log(dict(log)))
+        return logs
+
+    def put(self, params: dict, logs: list):
+        """Store the response of a query."""
+        key = stream_key(self.chain_id, params)
+        start_block, end_block = _block_number(params["fromBlock"]), _block_number(params["toBlock"])
+        fname = self.segment_fname(key, start_block, end_block)
+        with self.lock:
+            os.makedirs(self.stream_path(key), exist_ok=True)
+            tmp_fname = fname + ".tmp"
+            with gzip.open(tmp_fname, "wt") as f:
+                json.dump([_encode_log(log) for log in logs], f)
+            os.replace(tmp_fname, fname)
+            _read_segment.cache_clear()
+            segments = self._stream_segments(key)
+            if (start_block, end_block) not in segments:
+                segments.append((start_block, end_block))
+                segments.sort()
+
+    def delete_since(self, since_block: int) -> int:
+        """Drop the segments of all streams that reach this block, after a chain reorganisation.
+
+        Earlier blocks of a dropped segment are fetched again when needed.
+
+        :return: Number of segments deleted
+        """
+        deleted = 0
+        with self.lock:
+            if os.path.isdir(self.path):
+                for key in os.listdir(self.path):
+                    self._stream_segments(key)
+            for key, segments in self.segments.items():
+                kept = []
+                for segment_start, segment_end in segments:
+                    if segment_end >= since_block:
+                        os.remove(self.segment_fname(key, segment_start, segment_end))
+                        deleted += 1
+                    else:
+                        kept.append((segment_start, segment_end))
+                segments[:] = kept
+            if deleted:
+                _read_segment.cache_clear()
+        return deleted
+
+    def get_logs(self, params: dict, fetch: Callable[[dict], list]) -> list:
+        """Logs of a query, from the cache or from the node.
+
+        :param params: eth_getLogs parameters
+        :param fetch: Calls eth_getLogs, e.g. `w3.eth.get_logs`
+        :raise LookupError: In the offline mode, if the block range is not cached
+        """
+        logs = self.get(params)
+        if logs is not None:
+            self.hits += 1
+            return logs
+        if self.offline:
+            raise LookupError(f"Blocks {params['fromBlock']} - {params['toBlock']} are not in the log cache")
+        self.misses += 1
+        logger.debug("Blocks %s - %s not in the log cache", params["fromBlock"], params["toBlock"])
+        logs = fetch(params)
+        self.put(params, logs)
+        return logs
+
+
+@lru_cache(maxsize=16)
+def _read_segment(fname: str) -> Tuple[dict, ...]:
+    # Replays read the same segment for several chunks, keep the last ones decompressed
+    with gzip.open(fname, "rt") as f:
+        return tuple(json.load(f))
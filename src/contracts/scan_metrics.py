@@ -0,0 +1,293 @@
+"""Counters and histograms of where a scan spends its time.
+
+The scanners, the retry loop and the JSON-RPC transports report to a `MetricsSink`.
+The default sink drops everything. `ScanMetrics` keeps the metrics in memory
+and renders them in the Prometheus text exposition format, which `serve_metrics`
+serves over HTTP for a Prometheus server or a plain `curl`.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Sequence, Tuple
+
+from web3.providers.rpc import HTTPProvider
+from web3._utils.request import make_post_request
+
+from src.contracts.chunk_size_controller import is_response_too_large
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a cached local lookup to a struggling `eth_getLogs`
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Blocks or events per chunk, items per batch
+SIZE_BUCKETS = (1, 10, 100, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 1000000)
+
+#: Metrics the scanners report: name -> (type, help, histogram buckets)
+METRICS: Dict[str, Tuple[str, str, Optional[Sequence[float]]]] = {
+    "scanner_chunks_total": ("counter", "Chunks scanned and committed", None),
+    "scanner_blocks_total": ("counter", "Blocks scanned", None),
+    "scanner_events_total": ("counter", "Events processed", None),
+    "scanner_last_block": ("gauge", "The last block committed to the state", None),
+    "scanner_chunk_seconds": ("histogram", "Wall time of a chunk, from the first request to the commit",
+                              LATENCY_BUCKETS),
+    "scanner_chunk_blocks": ("histogram", "Blocks per chunk", SIZE_BUCKETS),
+    "scanner_fetch_seconds": ("histogram", "Time to fetch the events and block timestamps of a chunk",
+                              LATENCY_BUCKETS),
+    "scanner_process_seconds": ("histogram", "Time of EventScannerState.process_event over a chunk",
+                                LATENCY_BUCKETS),
+    "scanner_commit_seconds": ("histogram", "Time of EventScannerState.end_chunk", LATENCY_BUCKETS),
+    "scanner_get_logs_seconds": ("histogram", "Time of an eth_getLogs attempt, decoding included",
+                                 LATENCY_BUCKETS),
+    "scanner_get_logs_errors_total": ("counter", "Failed eth_getLogs attempts by kind (too_large, transient)", None),
+    "scanner_get_logs_retries_total": ("counter", "eth_getLogs attempts retried", None),
+    "scanner_timestamp_lookups_total": ("counter", "Block timestamps by where they came from (index, node, replay)",
+                                        None),
+    "scanner_head_block": ("gauge", "The latest head seen while following the chain", None),
+    "scanner_head_polls_total": ("counter", "Head polls while following the chain", None),
+    "scanner_follow_lag_seconds": ("histogram", "Seconds from mining a block to pushing it to the follow consumers",
+                                   LATENCY_BUCKETS),
+    "scanner_reorgs_total": ("counter", "Chain reorganisations found by comparing block hashes", None),
+    "scanner_reorg_blocks": ("histogram", "Scanned blocks rolled back per chain reorganisation", SIZE_BUCKETS),
+    "rpc_requests_total": ("counter", "JSON-RPC HTTP requests", None),
+    "rpc_request_seconds": ("histogram", "JSON-RPC HTTP request latency", LATENCY_BUCKETS),
+    "rpc_errors_total": ("counter", "JSON-RPC requests failing or returning an error", None),
+    "rpc_request_bytes_total": ("counter", "Bytes sent in JSON-RPC requests", None),
+    "rpc_response_bytes_total": ("counter", "Bytes received in JSON-RPC responses", None),
+    "rpc_batch_size": ("histogram", "Calls per JSON-RPC batch", SIZE_BUCKETS),
+}
+
+
+class MetricsSink(ABC):
+    """Receives the metrics of a scan.
+
+    Metrics are named as in `METRICS`, and labels are given as keyword arguments.
+    Implementations must be thread safe, as parallel scans report from worker threads.
+    """
+
+    @abstractmethod
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Add to a counter."""
+
+    @abstractmethod
+    def observe(self, name: str, value: float, **labels):
+        """Add an observation to a histogram."""
+
+    @abstractmethod
+    def set(self, name: str, value: float, **labels):
+        """Set a gauge."""
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the wall time of a block of code in a histogram, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+
+class NullMetrics(MetricsSink):
+    """Drops all metrics, the default when nobody is looking."""
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        pass
+
+    def observe(self, name: str, value: float, **labels):
+        pass
+
+    def set(self, name: str, value: float, **labels):
+        pass
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by linear interpolation inside its bucket, as Prometheus does."""
+        if not self.count:
+            return float("nan")
+        rank = q * self.count
+        lower = 0.0
+        previous = 0
+        for upper, cumulative in zip(self.buckets, self.cumulative_counts()):
+            if cumulative >= rank:
+                in_bucket = cumulative - previous
+                return lower + (upper - lower) * (rank - previous) / in_bucket if in_bucket else upper
+            lower, previous = upper, cumulative
+        # Beyond the last bucket, the best we can tell is the last bound
+        return self.buckets[-1]
+
+
+class ScanMetrics(MetricsSink):
+    """Keeps the metrics in memory and renders them in the Prometheus text format.
+
+    Metrics not in `METRICS` are accepted too, histograms of them use the latency buckets.
+    """
+
+    def __init__(self, namespace: str = "", metrics: Optional[Dict] = None):
+        """
+        :param namespace: Prefix of all metric names, e.g. "ilv"
+        :param metrics: Metric definitions, `METRICS` by default
+        """
+        self.namespace = namespace
+        self.metrics = metrics or METRICS
+        self.lock = threading.Lock()
+        # name -> label tuple -> value or _Histogram
+        self.values: Dict[str, Dict[tuple, object]] = {}
+
+    def _series(self, name: str) -> Dict[tuple, object]:
+        return self.values.setdefault(name, {})
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._series(name)
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._series(name)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self.metrics.get(name, (None, None, None))[2] or LATENCY_BUCKETS)
+            histogram.observe(value)
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self._series(name)[tuple(sorted(labels.items()))] = value
+
+    def get(self, name: str, **labels) -> float:
+        """Value of a counter or a gauge, or the number of observations of a histogram."""
+        with self.lock:
+            value = self.values.get(name, {}).get(tuple(sorted(labels.items())), 0)
+            return value.count if isinstance(value, _Histogram) else value
+
+    def quantile(self, name: str, q: float, **labels) -> float:
+        """Estimated quantile of a histogram, e.g. the 99th percentile RPC latency with q=0.99."""
+        with self.lock:
+            histogram = self.values.get(name, {}).get(tuple(sorted(labels.items())))
+            return histogram.quantile(q) if histogram else float("nan")
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format, version 0.0.4."""
+        lines = []
+        with self.lock:
+            for name in sorted(self.values):
+                kind, help_text, _ = self.metrics.get(name, (None, None, None))
+                series = self.values[name]
+                if kind is None:
+                    kind = "histogram" if any(isinstance(v, _Histogram) for v in series.values()) else "untyped"
+                full_name = f"{self.namespace}_{name}" if self.namespace else name
+                if help_text:
+                    lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                for labels, value in sorted(series.items()):
+                    if isinstance(value, _Histogram):
+                        for bound, cumulative in zip(value.buckets, value.cumulative_counts()):
+                            lines.append(f"{full_name}_bucket{_format_labels(labels, le=_format_value(bound))} {cumulative}")
+                        lines.append(f"{full_name}_bucket{_format_labels(labels, le='+Inf')} {value.count}")
+                        lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                        lines.append(f"{full_name}_count{_format_labels(labels)} {value.count}")
+                    else:
+                        lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def _format_labels(labels: tuple, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in items)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+
+def serve_metrics(metrics: ScanMetrics, host: str = "127.0.0.1", port: int = 9108) -> Tuple[ThreadingHTTPServer, str]:
+    """Serve the metrics at /metrics over HTTP in a background thread.
+
+    :param port: 0 picks a free port
+    :return: tuple(server, URL of the metrics), call server.shutdown() to stop
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://{host}:{server.server_address[1]}/metrics"
+    logger.info("Serving scan metrics at %s", url)
+    return server, url
+
+
+def error_kind(error: Exception) -> str:
+    """Label of a failed request: too_large if a smaller block range may help, transient otherwise."""
+    return "too_large" if is_response_too_large(error) else "transient"
+
+
+class MeteredHTTPProvider(HTTPProvider):
+    """Web3 HTTP provider reporting the latency, the errors and the bytes of every JSON-RPC call."""
+
+    def __init__(self, endpoint_uri=None, request_kwargs=None, session=None, metrics: Optional[MetricsSink] = None):
+        super().__init__(endpoint_uri, request_kwargs, session)
+        self.metrics = metrics or NullMetrics()
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        self.metrics.inc("rpc_requests_total", method=method)
+        self.metrics.inc("rpc_request_bytes_total", len(request_data), method=method)
+        try:
+            with self.metrics.timer("rpc_request_seconds", method=method):
+                raw_response = make_post_request(self.endpoint_uri, request_data, **self.get_request_kwargs())
+        except Exception as e:
+            self.metrics.inc("rpc_errors_total", method=method, kind=error_kind(e))
+            raise
+        self.metrics.inc("rpc_response_bytes_total", len(raw_response), method=method)
+        response = self.decode_rpc_response(raw_response)
+        if "error" in response:
+            self.metrics.inc("rpc_errors_total", method=method, kind=error_kind(ValueError(response["error"])))
+        return response
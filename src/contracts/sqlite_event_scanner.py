@@ -0,0 +1,150 @@
+import datetime
+import os
+import sqlite3
+from typing import List, Optional, Tuple
+
+from src.contracts.event_scanner_state import EventScannerState
+
+from web3.datastructures import AttributeDict
+
+from src.utils.project_paths import DATA_PATH
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scan_state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+-- The primary key doubles as our block number index
+CREATE TABLE IF NOT EXISTS events (
+    block_number INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    txhash TEXT NOT NULL,
+    event TEXT NOT NULL,
+    address TEXT,
+    from_address TEXT,
+    to_address TEXT,
+    -- uint256 does not fit SQLite integers, keep the exact decimal
+    amount TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (block_number, log_index)
+);
+
+CREATE INDEX IF NOT EXISTS idx_events_address ON events (address);
+CREATE INDEX IF NOT EXISTS idx_events_to_address ON events (to_address);
+"""
+
+
+class SQLiteState(EventScannerState):
+    """Store the state of scanned blocks and all events in a SQLite database.
+
+    Events of a chunk are buffered and written with one executemany
+    in a single transaction when the chunk ends, so memory use stays flat
+    and the cost of a checkpoint does not grow with the history.
+    """
+
+    def __init__(self, fname: Optional[str] = None):
+        self.fname = fname or os.path.join(DATA_PATH, "ILV-Core (with_transfer).sqlite")
+        self.conn: Optional[sqlite3.Connection] = None
+        # Rows of the chunk we are currently scanning
+        self.pending: List[Tuple] = []
+
+    def restore(self):
+        """Open the database, creating the tables if needed."""
+        # We manage the transactions ourselves
+        self.conn = sqlite3.connect(self.fname, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL is still safe against application crashes
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        print(f"Restored the state, previously {self.get_last_scanned_block()} blocks have been scanned")
+
+    def reset(self):
+        """Create initial state of nothing scanned."""
+        with self.conn:
+            self.conn.execute("DELETE FROM events")
+            self.conn.execute("DELETE FROM scan_state")
+
+    def save(self):
+        """Everything is committed at the end of each chunk, just checkpoint the WAL."""
+        self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+    #
+    # EventScannerState methods implemented below
+    #
+
+    def get_last_scanned_block(self):
+        """The number of the last block we have stored."""
+        row = self.conn.execute("SELECT value FROM scan_state WHERE key = 'last_scanned_block'").fetchone()
+        return row[0] if row else 0
+
+    def delete_data(self, since_block):
+        """Remove potentially reorganised blocks from the scan data.
+
+        The last scanned block goes back before them in the same transaction,
+        so a crash before the rescan does not resume past the deleted blocks.
+        """
+        if self.conn.in_transaction:
+            # A chunk failed half way, nothing of it was committed
+            self.conn.execute("ROLLBACK")
+        self.conn.execute("BEGIN")
+        cursor = self.conn.execute("DELETE FROM events WHERE block_number >= ?", (since_block,))
+        self.conn.execute(
+            "UPDATE scan_state SET value = MIN(value, ?) WHERE key = 'last_scanned_block'",
+            (since_block - 1,))
+        self.conn.execute("COMMIT")
+        return cursor.rowcount
+
+    def start_chunk(self, block_number, chunk_size):
+        """Open the transaction of the chunk."""
+        if self.conn.in_transaction:
+            # The previous chunk failed half way, nothing of it was committed
+            self.conn.execute("ROLLBACK")
+        self.pending = []
+        self.conn.execute("BEGIN")
+
+    def end_chunk(self, block_number):
+        """Commit the events of the chunk, so we can resume in the case of a crash or CTRL+C"""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO events "
+            "(block_number, log_index, txhash, event, address, from_address, to_address, amount, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            self.pending)
+        # Next time the scanner is started we will resume from this block
+        self.conn.execute(
+            "INSERT OR REPLACE INTO scan_state (key, value) VALUES ('last_scanned_block', ?)",
+            (block_number,))
+        self.conn.execute("COMMIT")
+        self.pending = []
+
+    def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
+        """Record a ERC-20 staked in our database."""
+        log_index = event.logIndex  # Log index within the block
+        txhash = event.transactionHash.hex()  # Transaction hash
+        block_number = event.blockNumber
+
+        args = event["args"]
+        event_name = event['event']
+
+        address = from_address = to_address = None
+        if event_name == "Staked":
+            address = args["_from"]
+            amount = args["amount"]
+        elif event_name == "Unstaked":
+            address = args["_to"]
+            amount = args["amount"]
+        elif event_name == "Transfer":
+            from_address = args["from"]
+            to_address = args["to"]
+            amount = args["value"]
+
+        self.pending.append((block_number, log_index, txhash, event_name, address, from_address, to_address,
+                             str(amount), block_when.isoformat()))
+
+        # Return a pointer that allows us to look up this event later if needed
+        return f"{block_number}-{txhash}-{log_index}"
@@ -0,0 +1,96 @@
+"""
+Gini coefficients of many distributions at once, in a single NumPy pass.
+
+Building a LorenzCurve per pool and per point in time re-sorts and re-normalises
+every distribution in a Python loop. Here all distributions are concatenated
+and handled with one segmented sort and segmented sums.
+"""
+
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+
+def _ragged_from_padded(values: np.ndarray, lengths: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Flatten a 2-D padded array to values and group offsets.
+
+    Without lengths, NaN marks the padding.
+    """
+    if lengths is None:
+        mask = ~np.isnan(values)
+    else:
+        mask = np.arange(values.shape[1])[None, :] < np.asarray(lengths)[:, None]
+    offsets = np.concatenate([[0], np.cumsum(mask.sum(axis=1))])
+    return values[mask], offsets
+
+
+def batch_gini(values: Union[np.ndarray, list], offsets: Optional[Union[np.ndarray, list]] = None,
+               lengths: Optional[Union[np.ndarray, list]] = None, norm: bool = False,
+               return_lorenz: bool = False):
+    """Gini coefficient of every group of values.
+
+    Args:
+        values (array): Either all groups concatenated (1-D, with offsets),
+            or a 2-D array with one group per row, padded with NaN or cut by lengths.
+        offsets (array, optional): Start of each group in the 1-D values, plus the total length at the end.
+        lengths (array, optional): Number of values in each row of the 2-D values.
+        norm (bool, optional): Normalize by n / (n - 1), as LorenzCurve.gini does. Defaults to False.
+        return_lorenz (bool, optional): Also return the Lorenz curve ordinates of every group. Defaults to False.
+
+    Returns:
+        np.ndarray: Gini coefficient per group, NaN for empty groups and 1.0 for single values
+            as in LorenzCurve.gini. With return_lorenz, also the tuple (ordinates, offsets) where
+            ordinates[offsets[g]:offsets[g + 1]] is the Lorenz curve of group g without the (0, 0) point.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 2:
+        values, offsets = _ragged_from_padded(values, lengths)
+    elif offsets is None:
+        offsets = [0, values.size]
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    sizes = np.diff(offsets)
+    n_groups = sizes.size
+    group_ids = np.repeat(np.arange(n_groups), sizes)
+
+    # Segmented sort: by group first, by value within the group
+    order = np.lexsort((values, group_ids))
+    ordered = values[order]
+
+    # 1-based rank of each value within its group
+    ranks = np.arange(1, values.size + 1) - np.repeat(offsets[:-1], sizes)
+
+    non_empty = sizes > 0
+    starts = offsets[:-1][non_empty]
+    totals = np.zeros(n_groups)
+    totals[non_empty] = np.add.reduceat(ordered, starts)
+
+    # sum of the Lorenz ordinates = sum_j x_j (n - rank_j + 1) / S
+    weighted = np.zeros(n_groups)
+    weighted[non_empty] = np.add.reduceat(ordered * (np.repeat(sizes, sizes) - ranks + 1), starts)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lorenz_sums = weighted / totals
+        gini = (sizes + 1 - 2 * lorenz_sums) / sizes
+        if norm:
+            gini = sizes / (sizes - 1) * gini
+    gini[sizes == 1] = 0.5*2
+    gini[~non_empty] = np.nan
+
+    if not return_lorenz:
+        return gini
+
+    # Segmented cumulative sum: the running sum restarts at every group.
+    # Normalise first, so the running sum stays in the order of the number of groups
+    # and subtracting the group start does not lose the precision of small groups.
+    group_totals = np.repeat(totals, sizes)
+    zero_total = group_totals == 0
+    shares = ordered / np.where(zero_total, 1, group_totals)
+    running = np.cumsum(shares)
+    starts_running = np.zeros(n_groups)
+    before = offsets[:-1] > 0
+    starts_running[before] = running[offsets[:-1][before] - 1]
+    ordinates = running - np.repeat(starts_running, sizes)
+    # A group of zeros has no Lorenz curve
+    ordinates[zero_total] = np.nan
+    return gini, (ordinates, offsets)
@@ -0,0 +1,177 @@
+"""
+Approximate Gini coefficient and Lorenz curve from a mergeable sketch.
+
+A sketch keeps the count and the sum of the values in logarithmic buckets,
+so its size only depends on the spread of the values and the accuracy, not on
+the number of holders. Sketches of pools or block ranges merge by adding their
+buckets, which gives the sketch of the combined values without the raw balances.
+"""
+
+import math
+from typing import Iterable, Tuple, Union
+
+import numpy as np
+
+
+class GiniSketch:
+    """Logarithmic bucket sketch of positive values, with exact counts and sums per bucket.
+
+    Bucket k holds the values in (gamma**(k - 1), gamma**k] with gamma = 1 + relative_accuracy.
+    The cumulative counts and sums are exact at the bucket boundaries, and inside
+    a bucket the values differ by at most the relative accuracy. That bounds
+    the error of the Gini coefficient and of the Lorenz curve, and the bound of
+    every answer is returned with it.
+
+    Merging is the union of the values: a holder present in two merged pools
+    counts as two holders.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        """
+        Args:
+            relative_accuracy (float, optional): Relative width of the buckets. Defaults to 0.01.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = 1 + relative_accuracy
+        self.log_gamma = math.log(self.gamma)
+        # Bucket indexes in increasing order, and the count and the sum of the values of each bucket
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.sums = np.empty(0, dtype=np.float64)
+
+    @classmethod
+    def from_values(cls, values: Iterable, relative_accuracy: float = 0.01) -> "GiniSketch":
+        sketch = cls(relative_accuracy)
+        sketch.add(values)
+        return sketch
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    @property
+    def total(self) -> float:
+        return float(self.sums.sum())
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _combine(self, keys: np.ndarray, counts: np.ndarray, sums: np.ndarray):
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts]),
+                                  minlength=len(keys)).astype(np.int64)
+        self.sums = np.bincount(inverse, weights=np.concatenate([self.sums, sums]), minlength=len(keys))
+        self.keys = keys
+
+    def add(self, values: Iterable):
+        """Add values, zeros and negative values are ignored.
+
+        Token amounts beyond int64 can be given as Python integers, they are bucketed as floats.
+        """
+        values = np.asarray(values)
+        if values.dtype == object:
+            values = values.astype(np.float64)
+        values = values[values > 0].astype(np.float64)
+        if not values.size:
+            return
+        keys = np.ceil(np.log(values) / self.log_gamma).astype(np.int64)
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        self._combine(unique_keys, np.bincount(inverse), np.bincount(inverse, weights=values))
+
+    def merge(self, other: "GiniSketch") -> "GiniSketch":
+        """Add the values of another sketch of the same accuracy to this one."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches of the same accuracy can be merged")
+        self._combine(other.keys, other.counts, other.sums)
+        return self
+
+    @classmethod
+    def merged(cls, sketches: Iterable["GiniSketch"]) -> "GiniSketch":
+        """A new sketch of the values of all the sketches together."""
+        sketches = list(sketches)
+        result = cls(sketches[0].relative_accuracy)
+        for sketch in sketches:
+            result.merge(sketch)
+        return result
+
+    def _bucket_widths(self) -> np.ndarray:
+        """Upper minus lower bound of the values of every bucket, 0 for buckets of one value."""
+        upper = self.gamma ** self.keys.astype(np.float64)
+        widths = upper - upper / self.gamma
+        # Nothing is uncertain in a bucket of one value
+        widths[self.counts == 1] = 0.0
+        return widths
+
+    def gini(self, norm: bool = False) -> Tuple[float, float]:
+        """Approximate Gini coefficient.
+
+        Inside a bucket of c values, the rank-weighted sum sum(i * x_i) is at least
+        what it would be with c equal values, and exceeds that by at most
+        width * floor(c**2 / 4) / 2. The middle of that range is used.
+
+        Args:
+            norm (bool, optional): Normalize by n / (n - 1), as LorenzCurve.gini does. Defaults to False.
+
+        Returns:
+            Tuple[float, float]: The Gini coefficient and the maximal absolute error.
+        """
+        n = self.count
+        if n == 0:
+            raise ValueError("Empty sketch")
+        if n == 1:
+            return 0.5*2, 0.0
+        total = self.total
+        counts = self.counts.astype(np.float64)
+        ranks_before = np.cumsum(counts) - counts
+        spread = self._bucket_widths() * np.floor(counts ** 2 / 4) / 2
+
+        weighted = (ranks_before * self.sums + self.sums * (counts + 1) / 2 + spread / 2).sum()
+        gini = 2 * weighted / (n * total) - (n + 1) / n
+        error = spread.sum() / (n * total)
+        if norm:
+            return (n/(n-1))*gini, (n/(n-1))*error
+        else:
+            return gini, error
+
+    def lorenz(self, p: Union[float, np.ndarray]) -> Tuple[Union[float, np.ndarray], float]:
+        """Approximate Lorenz curve ordinates: the share of the total held by the poorest fractions p.
+
+        Exact at the bucket boundaries and interpolated linearly inside the buckets.
+        Inside a bucket of c values the slope of the curve changes by at most
+        width * n / total, so the chord is at most width * c / (4 * total) away.
+
+        Returns:
+            The ordinates and the maximal absolute error over the whole curve.
+        """
+        if not self.count:
+            raise ValueError("Empty sketch")
+        total = self.total
+        x = np.concatenate([[0.0], np.cumsum(self.counts) / self.count])
+        y = np.concatenate([[0.0], np.cumsum(self.sums) / total])
+        error = float((self._bucket_widths() * self.counts / (4 * total)).max())
+        return np.interp(p, x, y), error
+
+    def quantile(self, q: float) -> float:
+        """Approximate value at the quantile q, within the relative accuracy."""
+        rank = q * (self.count - 1)
+        pos = int(np.searchsorted(np.cumsum(self.counts), rank, side="right"))
+        pos = min(pos, len(self.keys) - 1)
+        # Middle of the bucket, relative to its bounds
+        return float(self.gamma ** self.keys[pos] * (1 + 1 / self.gamma) / 2)
+
+    def to_dict(self) -> dict:
+        """JSON serialisable form, for storing a sketch per pool or per block partition."""
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "keys": self.keys.tolist(),
+            "counts": self.counts.tolist(),
+            "sums": self.sums.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GiniSketch":
+        sketch = cls(data["relative_accuracy"])
+        sketch.keys = np.array(data["keys"], dtype=np.int64)
+        sketch.counts = np.array(data["counts"], dtype=np.int64)
+        sketch.sums = np.array(data["sums"], dtype=np.float64)
+        return sketch
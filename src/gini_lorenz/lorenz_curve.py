@@ -1,6 +1,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+from src.gini_lorenz.lorenz_downsampling import downsample_lorenz
+
 
 class Lorenz:
     """class for creating a lorenz curve"""
@@ -10,8 +12,12 @@ class Lorenz:
         self.lst = np.sort(np.array(lst))
 
         
-    def lorenz(self, plot=True, verbose=False):
-        """calculate the lorenz curbve values with option to plot the curve"""
+    def lorenz(self, plot=True, verbose=False, max_points=2000):
+        """calculate the lorenz curbve values with option to plot the curve
+
+        The plotted curve is reduced to about max_points points (None plots every point),
+        see downsample_lorenz.
+        """
         
         # check size of input list
         if(self.lst.size == 1):
@@ -25,13 +31,16 @@ class Lorenz:
             print(vals)
 
         if plot == True:
-            # plot lorenz curve
-            plt.plot(np.linspace(0.0, 1.0, plt_vals.size), plt_vals, "-bo")
+            if max_points is None:
+                x, y = np.linspace(0.0, 1.0, plt_vals.size), plt_vals
+            else:
+                x, y, _ = downsample_lorenz(plt_vals, max_points)
+            # plot lorenz curve, markers only while they can be told apart
+            plt.plot(x, y, "-bo" if x.size <= 100 else "-b")
             # plot equality curve
             plt.plot([0,1], [0,1], "-go")
             if verbose:
-                plt.fill_between(np.linspace(0.0, 1.0, plt_vals.size),np.linspace(0.0, 1.0, plt_vals.size),
-                                 plt_vals, color="lightsteelblue")
+                plt.fill_between(x, x, y, color="lightsteelblue")
                 txt = str(np.round(self.gini(plt_vals),2))
                 plt.text(0.48, 0.4, f"Gini = {txt}", size="large")
                 plt.show()
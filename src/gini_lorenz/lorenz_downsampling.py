@@ -0,0 +1,47 @@
+"""
+Reduce a Lorenz curve to a bounded number of points for plotting.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+
+def downsample_lorenz(y: np.ndarray, max_points: int = 2000, tail_points: int = 100) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Pick at most about max_points points of a Lorenz curve, within a known error.
+
+    The unit square is cut in a grid of cells of side eps. We keep every point that
+    enters a new cell in x or in y, and the point just before it, so between two kept
+    points the curve either stays in one cell or makes a single exact step.
+    The straight line between the kept points is therefore never more than eps away
+    from the full curve, horizontally or vertically. The first and last points and
+    the tail_points largest holders are always kept exactly.
+
+    Args:
+        y (np.ndarray): Lorenz curve ordinates starting with the (0, 0) point,
+            at the evenly spaced fractions of holders.
+        max_points (int, optional): Point budget. Defaults to 2000.
+        tail_points (int, optional): Number of top holders kept exactly. Defaults to 100.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, float]: x and y of the kept points,
+            and the error bound eps (0.0 when nothing was dropped).
+    """
+    x = np.linspace(0.0, 1.0, y.size)
+    if y.size <= max_points:
+        return x, y, 0.0
+
+    tail_points = min(tail_points, max_points // 2)
+    # At most 1 / eps new cells along each axis, two points kept for each
+    eps = 4 / max(max_points - tail_points - 2, 4)
+
+    cell_x = np.floor(x / eps)
+    cell_y = np.floor(y / eps)
+    enters = np.zeros(y.size, dtype=bool)
+    enters[1:] = (cell_x[1:] != cell_x[:-1]) | (cell_y[1:] != cell_y[:-1])
+
+    keep = enters.copy()
+    keep[:-1] |= enters[1:]
+    keep[0] = True
+    keep[-tail_points - 1:] = True
+    return x[keep], y[keep], eps
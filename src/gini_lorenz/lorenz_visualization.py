@@ -5,9 +5,15 @@ Name: Felipe Lana Machado
 Date: 02/03/2022
 """
 
+from typing import Optional
+
 import numpy as np
 import plotly.express as px
-from plotly.graph_objs import Data, Figure
+from plotly.graph_objs import Figure, Scattergl
+
+from src.gini_lorenz.bootstrap_gini import gini_confidence_interval
+from src.gini_lorenz.exact_gini import exact_gini, exact_lorenz, sort_limbs, to_limbs
+from src.gini_lorenz.lorenz_downsampling import downsample_lorenz
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -15,34 +21,56 @@ warnings.filterwarnings("ignore")
 class LorenzCurve:
 
     def __init__(self, lst: list) -> None:
-        self.lst = np.sort(np.array(lst))
+        values = np.array(lst)
+        self.limbs = None
+        if values.dtype == object:
+            # uint256 amounts beyond int64: sort and sum them exactly as limbs
+            self.limbs = sort_limbs(to_limbs(lst))
+            self.lst = np.sort(values.astype(np.float64))
+        else:
+            self.lst = np.sort(values)
 
-    def plot_lorenz(self) -> None:
+    def plot_lorenz(self, max_points: Optional[int] = 2000, tail_points: int = 100) -> None:
         """Plots the Lorenz curve given some list of values.
-        """                
+
+        With many holders, the curve is reduced to about max_points points with a bounded
+        error (see downsample_lorenz) and drawn with WebGL, so the size of the figure
+        does not grow with the number of holders. The Gini coefficient is still
+        computed from all values.
+
+        Args:
+            max_points (int, optional): Point budget of the curve, None to plot every holder. Defaults to 2000.
+            tail_points (int, optional): Number of top holders always plotted exactly. Defaults to 100.
+        """
         # normalisation and summation
-        vals = self.lst.cumsum() / self.lst.sum()
+        if self.limbs is not None:
+            vals = exact_lorenz(self.limbs)
+        else:
+            vals = self.lst.cumsum() / self.lst.sum()
         # add (0,0) to values
         plt_vals = np.insert(vals, 0, 0)
 
-        trace1 = {
-        "name": "Lorenz Curve", 
-        "x": np.linspace(0.0, 1.0, plt_vals.size),
-        "y": plt_vals}
-        trace2 = {
-        "name": "Line of equality", 
-        "x": [0, 1], 
-        "y": [0, 1]
-        }
-        data = Data([trace1, trace2])
-        txt = str(np.round(self.gini(plt_vals),2))
+        if max_points is None:
+            x, y, max_error = np.linspace(0.0, 1.0, plt_vals.size), plt_vals, 0.0
+        else:
+            x, y, max_error = downsample_lorenz(plt_vals, max_points, tail_points)
+
+        name = "Lorenz Curve"
+        if max_error:
+            name += f" ({x.size} of {plt_vals.size} points, error < {max_error:.2g})"
+        trace1 = Scattergl(name=name, x=x, y=y, mode="lines")
+        trace2 = Scattergl(name="Line of equality", x=[0, 1], y=[0, 1], mode="lines")
+        if self.limbs is not None:
+            txt = str(np.round(exact_gini(self.limbs),2))
+        else:
+            txt = str(np.round(self.gini(plt_vals),2))
         layout = {
         "title": f"Lorenz Curve - GINI: {txt}", 
         "xaxis": {"title": "Fraction of hodlers"}, 
         "yaxis": {"title": "Fraction of ILV owned"}, 
         "autosize": True
         }
-        fig = Figure(data=data, layout=layout)
+        fig = Figure(data=[trace1, trace2], layout=layout)
         fig.show()
 
     def gini(self, vals, norm=False):
@@ -63,4 +91,12 @@ class LorenzCurve:
         if norm:
             return (n/(n-1))*gini
         else:
-            return gini
\ No newline at end of file
+            return gini
+
+    def gini_confidence_interval(self, confidence=0.95, n_boot=10000, norm=False, seed=None, workers=None):
+        """Gini coefficient with a bootstrap confidence interval, see bootstrap_gini.
+
+        Returns:
+            Tuple[float, float, float]: The Gini coefficient, and the lower and upper bounds.
+        """
+        return gini_confidence_interval(self.lst, confidence, n_boot, norm, seed, workers=workers)
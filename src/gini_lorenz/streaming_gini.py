@@ -0,0 +1,169 @@
+"""
+Gini coefficient and Lorenz curve that follow a live feed of balance changes.
+"""
+
+import random
+from typing import Hashable, Optional, Tuple
+
+
+class _Node:
+    __slots__ = ("value", "priority", "left", "right", "count", "total")
+
+    def __init__(self, value):
+        self.value = value
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.count = 1
+        self.total = value
+
+
+def _count(node: Optional[_Node]) -> int:
+    return node.count if node else 0
+
+
+def _total(node: Optional[_Node]):
+    return node.total if node else 0
+
+
+def _update(node: _Node) -> _Node:
+    node.count = 1 + _count(node.left) + _count(node.right)
+    node.total = node.value + _total(node.left) + _total(node.right)
+    return node
+
+
+def _split(node: Optional[_Node], value, inclusive: bool) -> Tuple[Optional[_Node], Optional[_Node]]:
+    """Split a treap in values below `value` (or equal, if inclusive) and the rest."""
+    if node is None:
+        return None, None
+    if node.value < value or (inclusive and node.value == value):
+        left, right = _split(node.right, value, inclusive)
+        node.right = left
+        return _update(node), right
+    left, right = _split(node.left, value, inclusive)
+    node.left = right
+    return left, _update(node)
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    """Merge two treaps, all values of the left one being smaller."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+class StreamingGini:
+    """Gini coefficient of a set of holder balances under insert/update/remove.
+
+    The balances are kept in a treap (a randomised balanced search tree) with the count
+    and the sum of every subtree, next to the running rank-weighted sum
+    W = sum(i * x_i) over the ascending sorted balances. A balance change only
+    shifts the ranks of the larger balances by one, so W is updated from the subtree
+    sums in O(log n) and the Gini coefficient
+
+        G = 2 * W / (n * S) - (n + 1) / n
+
+    is read in O(1), without re-sorting. Python integers are used as they come,
+    so uint256 token amounts stay exact.
+    """
+
+    def __init__(self):
+        self.root: Optional[_Node] = None
+        # holder -> balance
+        self.balances = {}
+        self.total = 0
+        self.weighted_total = 0
+
+    def __len__(self) -> int:
+        return _count(self.root)
+
+    def _insert(self, value):
+        less_equal, greater = _split(self.root, value, inclusive=True)
+        # The new value goes after the equal ones, every greater value moves up one rank
+        self.weighted_total += (_count(less_equal) + 1) * value + _total(greater)
+        self.total += value
+        self.root = _merge(_merge(less_equal, _Node(value)), greater)
+
+    def _remove(self, value):
+        less, rest = _split(self.root, value, inclusive=False)
+        equal, greater = _split(rest, value, inclusive=True)
+        if equal is None:
+            self.root = _merge(less, greater)
+            raise KeyError(value)
+        # Remove the equal value with the highest rank
+        rank = _count(less) + _count(equal)
+        self.weighted_total -= rank * value + _total(greater)
+        self.total -= value
+        equal = _merge(equal.left, equal.right)
+        self.root = _merge(_merge(less, equal), greater)
+
+    def update(self, holder: Hashable, balance):
+        """Set the balance of a holder. A zero balance removes the holder."""
+        old = self.balances.pop(holder, None)
+        if old is not None:
+            self._remove(old)
+        if balance:
+            self.balances[holder] = balance
+            self._insert(balance)
+
+    def add(self, holder: Hashable, delta):
+        """Change the balance of a holder by delta."""
+        self.update(holder, self.balances.get(holder, 0) + delta)
+
+    def remove(self, holder: Hashable):
+        self.update(holder, 0)
+
+    def gini(self, norm: bool = False) -> float:
+        """Gini coefficient of the current balances.
+
+        Args:
+            norm (bool, optional): Normalize by n / (n - 1), as LorenzCurve.gini does. Defaults to False.
+
+        Returns:
+            float: Gini coefficient, 1.0 for a single holder as in LorenzCurve.gini.
+        """
+        n = len(self)
+        if n == 0:
+            raise ValueError("No holders")
+        if n == 1:
+            return 0.5*2
+        gini = (2 * self.weighted_total - (n + 1) * self.total) / (n * self.total)
+        if norm:
+            return (n/(n-1))*gini
+        else:
+            return gini
+
+    def prefix_sum(self, k: int):
+        """Sum of the k smallest balances."""
+        node = self.root
+        result = 0
+        while node is not None and k > 0:
+            left_count = _count(node.left)
+            if k <= left_count:
+                node = node.left
+            else:
+                result += _total(node.left) + node.value
+                k -= left_count + 1
+                node = node.right
+        return result
+
+    def lorenz(self, p: float) -> float:
+        """Lorenz curve ordinate: the share of the total held by the poorest fraction p of the holders.
+
+        Linearly interpolated between the holders, in O(log n).
+        """
+        n = len(self)
+        if n == 0:
+            raise ValueError("No holders")
+        position = p * n
+        k = int(position)
+        below = self.prefix_sum(k)
+        if k < n:
+            below += (position - k) * (self.prefix_sum(k + 1) - below)
+        return below / self.total
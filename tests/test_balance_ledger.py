@@ -0,0 +1,112 @@
+"""Balance ledger and snapshots fed with events out of block order.
+
+Per event type queries return all events of one type before the next type,
+so a chunk can apply an older block after a newer one.
+"""
+
+from src.contracts.balance_ledger import BalanceLedger
+from src.contracts.balance_snapshots import BalanceSnapshotIndex
+from src.contracts.follow import FollowUpdate, LedgerGini
+
+POOL = "pool"
+ALICE = "0xA11CE"
+
+
+def _out_of_order_ledger(**kwargs) -> BalanceLedger:
+    """Staked@5 and Staked@10, then Unstaked@7."""
+    ledger = BalanceLedger(**kwargs)
+    ledger.apply_record(5, POOL, {"event": "Staked", "address": ALICE, "amount": 100})
+    ledger.apply_record(10, POOL, {"event": "Staked", "address": ALICE, "amount": 50})
+    ledger.apply_record(7, POOL, {"event": "Unstaked", "address": ALICE, "amount": 30})
+    ledger.end_block(10)
+    return ledger
+
+
+def test_undo_log_in_block_order():
+    ledger = _out_of_order_ledger()
+    assert list(ledger.undo_log) == [5, 7, 10]
+    assert ledger.balances[POOL][ALICE] == 120
+
+
+def test_revert_since_out_of_order():
+    ledger = _out_of_order_ledger()
+    assert ledger.revert_since(8) == 1
+    assert ledger.balances[POOL][ALICE] == 70
+    assert list(ledger.undo_log) == [5, 7]
+    assert ledger.last_block == 7
+
+
+def test_revert_since_everything():
+    ledger = _out_of_order_ledger()
+    assert ledger.revert_since(0) == 3
+    assert ALICE not in ledger.balances[POOL]
+    assert ledger.undo_log == {}
+
+
+def test_prune_out_of_order():
+    ledger = _out_of_order_ledger()
+    ledger.prune(8)
+    assert list(ledger.undo_log) == [10]
+    assert ledger.undo_from == 8
+    assert ledger.revert_since(8) == 1
+    assert ledger.balances[POOL][ALICE] == 70
+
+
+def test_prune_by_undo_depth():
+    ledger = _out_of_order_ledger(undo_depth=4)
+    # Block 10 pruned everything before block 6
+    assert list(ledger.undo_log) == [7, 10]
+    assert ledger.undo_from == 6
+
+
+def test_restore_sorts_undo_log(tmp_path):
+    fname = str(tmp_path / "ledger.json")
+    ledger = _out_of_order_ledger(fname=fname)
+    ledger.save()
+    restored = BalanceLedger(fname=fname)
+    restored.restore()
+    assert list(restored.undo_log) == [5, 7, 10]
+    restored.revert_since(8)
+    assert restored.balances[POOL][ALICE] == 70
+
+
+def test_iter_balances_at_out_of_order(tmp_path):
+    snapshots = BalanceSnapshotIndex(str(tmp_path))
+    _out_of_order_ledger(snapshots=snapshots)
+    assert [block_num for block_num, _, _, _ in snapshots.changes] == [5, 7, 10]
+    balances = {block_num: dict(balances[POOL])
+                for block_num, balances in snapshots.iter_balances_at([5, 8, 10])}
+    assert balances == {5: {ALICE: 100}, 8: {ALICE: 70}, 10: {ALICE: 120}}
+
+
+def test_iter_balances_at_across_checkpoints(tmp_path):
+    snapshots = BalanceSnapshotIndex(str(tmp_path), every_changes=2)
+    ledger = _out_of_order_ledger(snapshots=snapshots)
+    ledger.apply_record(14, POOL, {"event": "Staked", "address": ALICE, "amount": 5})
+    ledger.apply_record(12, POOL, {"event": "Unstaked", "address": ALICE, "amount": 20})
+    ledger.end_block(14)
+    assert snapshots.checkpoints == [0, 10, 14]
+    balances = {block_num: balances.get(POOL, {}).get(ALICE)
+                for block_num, balances in snapshots.iter_balances_at([4, 7, 11, 12, 14])}
+    assert balances == {4: None, 7: 70, 11: 120, 12: 100, 14: 105}
+
+
+def test_snapshot_revert_since_out_of_order(tmp_path):
+    snapshots = BalanceSnapshotIndex(str(tmp_path))
+    ledger = _out_of_order_ledger(snapshots=snapshots)
+    ledger.revert_since(8)
+    assert snapshots.balances_at(10)[POOL] == {ALICE: 70}
+
+
+def test_ledger_gini_touched_out_of_order():
+    ledger = BalanceLedger()
+    ledger.apply_record(5, POOL, {"event": "Staked", "address": ALICE, "amount": 100})
+    ledger.end_block(5)
+    gini = LedgerGini(ledger)
+    ledger.apply_record(10, POOL, {"event": "Staked", "address": "0xB0B", "amount": 50})
+    ledger.apply_record(7, POOL, {"event": "Staked", "address": "0xCA401", "amount": 30})
+    ledger.end_block(10)
+    gini(FollowUpdate(6, 10, 10, [], None))
+    incremental = gini.gini
+    gini.resync()
+    assert incremental == gini.gini
@@ -0,0 +1,43 @@
+"""Error bounds of the timestamps answered by the block timestamp index."""
+
+import datetime
+
+from src.contracts.block_timestamp_index import BlockTimestampIndex
+
+
+def _index(tmp_path) -> BlockTimestampIndex:
+    index = BlockTimestampIndex(str(tmp_path / "timestamps.json"))
+    index.add(100, datetime.datetime.utcfromtimestamp(1000))
+    index.add(200, datetime.datetime.utcfromtimestamp(2200))
+    return index
+
+
+def _fetch(block_nums):
+    return {block_num: datetime.datetime.utcfromtimestamp(5000) for block_num in block_nums}
+
+
+def test_resolve_reports_error_bounds(tmp_path):
+    errors = {}
+    result = _index(tmp_path).resolve([100, 150, 300], _fetch, max_error=600, errors=errors)
+    assert sorted(result) == [100, 150, 300]
+    # Block 150 is at least 50 s after block 100 and 50 s before block 200
+    assert errors == {100: 0.0, 150: 550.0, 300: 0.0}
+
+
+def test_resolve_fetches_estimates_over_max_error(tmp_path):
+    errors = {}
+    fetched = []
+    index = _index(tmp_path)
+    result = index.resolve([150], lambda block_nums: fetched.extend(block_nums) or _fetch(block_nums),
+                           max_error=500, errors=errors)
+    assert fetched == [150]
+    assert result[150] == datetime.datetime.utcfromtimestamp(5000)
+    assert errors == {150: 0.0}
+
+
+def test_lookup_exact_only(tmp_path):
+    errors = {}
+    result, missing = _index(tmp_path).lookup([100, 150], errors=errors)
+    assert list(result) == [100]
+    assert missing == [150]
+    assert errors == {100: 0.0}
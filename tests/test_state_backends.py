@@ -0,0 +1,124 @@
+"""Rolling back reorganised blocks in the scanner state backends."""
+
+import datetime
+import os
+
+import pytest
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from src.contracts.columnar_event_scanner import ColumnarState
+from src.contracts.json_event_scanner import JSONifiedState
+from src.contracts.sqlite_event_scanner import SQLiteState
+
+STAKER = "0x00000000000000000000000000000000000000A1"
+WHEN = datetime.datetime(2022, 1, 1)
+
+
+def _staked(block_number: int) -> AttributeDict:
+    return AttributeDict({
+        "event": "Staked",
+        "args": AttributeDict({"_by": STAKER, "_from": STAKER, "amount": 10 ** 18}),
+        "address": "0x00000000000000000000000000000000000000B0",
+        "blockNumber": block_number,
+        "logIndex": 0,
+        "transactionHash": HexBytes(block_number.to_bytes(32, "big")),
+    })
+
+
+class _JSONBackend:
+    def __init__(self, path, journaled):
+        self.path, self.journaled = path, journaled
+
+    def open(self):
+        state = JSONifiedState(journaled=self.journaled)
+        state.fname = os.path.join(self.path, "state.json")
+        state.journal_fname = state.fname + ".journal"
+        state.restore()
+        return state
+
+    @staticmethod
+    def blocks(state):
+        return sorted(state.state["blocks"])
+
+
+class _SQLiteBackend:
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        state = SQLiteState(os.path.join(self.path, "state.sqlite"))
+        state.restore()
+        return state
+
+    @staticmethod
+    def blocks(state):
+        return [row[0] for row in state.conn.execute("SELECT DISTINCT block_number FROM events ORDER BY 1")]
+
+
+class _ColumnarBackend:
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        state = ColumnarState(os.path.join(self.path, "columns"), partition_size=10)
+        state.restore()
+        return state
+
+    @staticmethod
+    def blocks(state):
+        return sorted(set(state.read(["block"])["block"].tolist()))
+
+
+@pytest.fixture(params=["json", "json-journaled", "sqlite", "columnar"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        return _SQLiteBackend(str(tmp_path))
+    if request.param == "columnar":
+        return _ColumnarBackend(str(tmp_path))
+    return _JSONBackend(str(tmp_path), journaled=request.param == "json-journaled")
+
+
+def _scan(state, chunks):
+    """Feed chunks of (start block, end block, blocks with an event) to the state."""
+    for start_block, end_block, block_numbers in chunks:
+        state.start_chunk(start_block, end_block - start_block + 1)
+        for block_number in block_numbers:
+            state.process_event(WHEN, _staked(block_number))
+        state.end_chunk(end_block)
+
+
+def test_delete_data_rewinds_last_scanned_block(backend):
+    state = backend.open()
+    _scan(state, [(1, 10, [5]), (11, 20, [12, 18]), (21, 30, [25])])
+    state.delete_data(12)
+    assert state.get_last_scanned_block() == 11
+    state.save()
+    assert backend.blocks(state) == [5]
+
+
+def test_rescan_after_delete_data_survives_restart(backend):
+    state = backend.open()
+    _scan(state, [(1, 10, [5]), (11, 20, [12, 18]), (21, 30, [25])])
+    state.delete_data(12)
+    _scan(state, [(12, 22, [14])])
+    if isinstance(state, SQLiteState):
+        state.close()
+
+    restored = backend.open()
+    assert restored.get_last_scanned_block() == 22
+    assert backend.blocks(restored) == [5, 14]
+
+
+@pytest.mark.parametrize("backend", ["json-journaled", "sqlite", "columnar"], indirect=True)
+def test_delete_data_is_durable(backend):
+    """A crash between the rollback and the rescan does not resume past the deleted blocks."""
+    state = backend.open()
+    _scan(state, [(1, 10, [5]), (11, 20, [12, 18]), (21, 30, [25])])
+    state.delete_data(12)
+    if isinstance(state, SQLiteState):
+        state.close()
+
+    restored = backend.open()
+    assert restored.get_last_scanned_block() == 11
+    assert backend.blocks(restored) == [5]